@@ -29,47 +29,112 @@ parser.add_argument("-r","--robot_number",
                     dest="robot_number",
                     help="Robot number where data was generated (1, 2, 3, etc). Defaults to empty if only one robot is in use.",
                     default="")
+parser.add_argument("--backend",
+                    action="store",
+                    dest="backend",
+                    choices=["keras", "frozen", "auto"],
+                    help="how to load the QR model: keras h5, optimized graph from src.retnet.export, or the graph if exported.",
+                    default="keras")
+parser.add_argument("--quantized",
+                    action="store_true",
+                    dest="quantized",
+                    help="with the frozen or auto backend, use the graph exported with int8 weights (src.retnet.export export --quantize). The weights are dequantized when loaded, so this saves disk space, not time.")
+parser.add_argument("--intra_op_threads",
+                    action="store",
+                    dest="intra_op_threads",
+                    type=int,
+                    help="tensorflow threads per op. Defaults to tensorflow's choice.",
+                    default=None)
+parser.add_argument("--inter_op_threads",
+                    action="store",
+                    dest="inter_op_threads",
+                    type=int,
+                    help="tensorflow threads running ops in parallel. Defaults to tensorflow's choice.",
+                    default=None)
+parser.add_argument("--preview_retention_days",
+                    action="store",
+                    dest="preview_retention_days",
+                    type=float,
+                    help="days to keep proxy videos and contact sheets in data/videos/preview. Negative keeps them forever.",
+                    default=30)
 args = parser.parse_args()
 print(args)
 
 # set robot
 robot = "robot" + str(args.robot_number) + "/"
 boxes_per_shelf = args.boxes_per_shelf
-sf.init(robot, boxes_per_shelf)
-
-# check if there are experiments that were wanted from junk_review and re_merge them into current_exp
-# remove junk from previous robot run in case items were sent to junk review
-sf.re_merge()
-sf.clear_junk()
+preview_retention_days = args.preview_retention_days if args.preview_retention_days >= 0 else None
+config = sf.init(robot, boxes_per_shelf, args.backend, args.intra_op_threads, args.inter_op_threads, preview_retention_days,
+                 args.quantized)
 
 current_exp_list = []
-data_path_list = sf.listdir_nohidden(sf.MOUNTED_BUCKET_STAGING_PATH)
+data_path_list = sf.listdir_nohidden(config.mounted_bucket_staging_path)
 
 # sort in ascending order by value
 # in order to create a value representative of the date the sort_date function is used
 data_path_list.sort(key=sf.sort_date)
 print(data_path_list)
 
+# an interrupted run may already have moved some of its positions to junk, which must not be cleared before review
+resuming = not args.transfer and len(data_path_list) > 0 and sf.open_journal(config, os.path.splitext(data_path_list[0])[0]).started
+
+# check if there are experiments that were wanted from junk_review and re_merge them into current_exp
+# remove junk from previous robot run in case items were sent to junk review
+if not resuming:
+    sf.re_merge(config)
+    sf.clear_junk(config)
+
 if args.transfer:
-    current_exp_list = sf.update(current_exp_list)
-    sf.final_transfer(current_exp_list)
+    current_exp_list = sf.update(config, current_exp_list)
+    sf.final_transfer(config, current_exp_list)
 else:
     data_path = data_path_list[0]
-    # unzip and move images to unsorted_unlabeled
-    sf.transfer_to_instance(data_path)
-
-    current_exp_list = sf.update(current_exp_list)
     run_name = os.path.splitext(data_path)[0]
     print(run_name)
-    sf.sort(run_name, run_name[-1:])
-    sf.label(run_name)
+
+    # the journal of a run that was interrupted lets it resume where it stopped
+    journal = sf.open_journal(config, run_name)
+    if journal.started:
+        print("Resuming " + run_name + " from its journal.")
+
+    # unzip and move images to unsorted_unlabeled
+    if not journal.is_done("transfer"):
+        sf.transfer_to_instance(config, data_path)
+        journal.mark_done("transfer")
+
+    # copy the next run to local scratch while this one is processed
+    if len(data_path_list) > 1:
+        sf.prefetch_staged_zip(config, data_path_list[1])
+
+    # final_transfer needs the experiment sizes from before this run's images were added
+    before = journal.find("current_exp")
+    if before is None:
+        current_exp_list = sf.update(config, current_exp_list)
+        journal.record("current_exp", experiments=current_exp_list)
+    else:
+        current_exp_list = before["experiments"]
+
+    if not journal.is_done("sort"):
+        sf.sort(config, run_name, run_name[-1:], journal)
+    if not journal.is_done("label"):
+        sf.label(config, run_name, journal)
+
+    # encode this run's frames now so final_transfer only has to join segments
+    sf.encode_segments(config)
 
     # safely removes zip of current run
-    sf.clear_staging_bucket(data_path)        
+    archived = sf.clear_staging_bucket(config, data_path)
 
-    review_needed = sf.junk_review()
+    review_needed = sf.junk_review(config)
 
     if not review_needed:
-        sf.final_transfer(current_exp_list, stabilize = not args.do_not_stabilize)
+        sf.final_transfer(config, current_exp_list, stabilize = not args.do_not_stabilize)
     else:
         print("skipping final transfer, there are junk review items to be dealt with\n*****************")
+
+    # let the archive move and the prefetch of the next run finish before exiting
+    sf.wait_for_background_io()
+
+    # the zip is gone from staging, so a zip staged later under the same name is a new run
+    if archived.exception() is None:
+        journal.finish()
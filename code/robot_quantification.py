@@ -0,0 +1,146 @@
+"""
+
+    Entry point of headless quantification.
+    Traces root tips of many experiments in parallel from
+    saved seed/germination snapshots.
+
+"""
+
+import os
+# no display on the instances, plots are never shown
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import src.myutilities.quantification as q
+import argparse
+
+
+parser = argparse.ArgumentParser(description="this is a headless tip tracing script")
+parser.add_argument("experiments",
+                    nargs="*",
+                    help="experiment numbers to trace. Defaults to every experiment with a snapshot.")
+parser.add_argument("-s", "--source",
+                    action="store",
+                    dest="source",
+                    help="directory in pre_quantification holding the experiments (stabilized or unstabilized).",
+                    default="stabilized")
+parser.add_argument("--snapshots",
+                    action="store",
+                    dest="snapshots",
+                    help="directory holding <experiment>.npz seed snapshots. Defaults to snapshots/ in pre_quantification.",
+                    default=None)
+parser.add_argument("-l", "--length",
+                    action="store",
+                    dest="length",
+                    type=int,
+                    help="number of frames to track after germination. Defaults to all.",
+                    default=None)
+parser.add_argument("-w", "--workers",
+                    action="store",
+                    dest="workers",
+                    type=int,
+                    help="number of worker processes. Defaults to the number of CPUs.",
+                    default=None)
+parser.add_argument("-m", "--memory_budget",
+                    action="store",
+                    dest="memory_budget",
+                    type=float,
+                    help="memory in GB the running experiments may use together. Defaults to no limit.",
+                    default=None)
+parser.add_argument("--lease_ttl",
+                    action="store",
+                    dest="lease_ttl",
+                    type=float,
+                    help="hours after which an experiment leased by a machine that stopped responding is retried.",
+                    default=6)
+parser.add_argument("--lease_dir",
+                    action="store",
+                    dest="lease_dir",
+                    help="directory of lease and done files. Point every machine at the same shared directory to split experiments between them. Defaults to leases/ in the local quantification output path.",
+                    default=None)
+parser.add_argument("--threshold_multiplier",
+                    action="store",
+                    dest="threshold_multiplier",
+                    type=float,
+                    default=1.5)
+parser.add_argument("--bound_radius",
+                    action="store",
+                    dest="bound_radius",
+                    type=int,
+                    help="half size of the tip search window. Defaults to 30, or 15 with --tracker predictive.",
+                    default=None)
+parser.add_argument("--stabilize",
+                    action="store_const",
+                    const=True,
+                    dest="stabilize",
+                    help="read the raw pngs through stored python stabilization transforms (use with -s unstabilized). Defaults to the snapshot's setting.",
+                    default=None)
+parser.add_argument("--tracker",
+                    action="store",
+                    dest="tracker",
+                    choices=["full", "pyramid", "adaptive", "predictive"],
+                    help="tracking mode. pyramid finds the tip on a downsampled window first and refines it at full resolution. adaptive skips frames while the root grows slowly and interpolates their tips. predictive centers a smaller window on where the tip is expected from its velocity.",
+                    default="full")
+parser.add_argument("--pyramid_factor",
+                    action="store",
+                    dest="pyramid_factor",
+                    type=int,
+                    help="downsampling of the coarse step of the pyramid tracker.",
+                    default=2)
+parser.add_argument("--max_step",
+                    action="store",
+                    dest="max_step",
+                    type=int,
+                    help="most frames the adaptive tracker advances at once.",
+                    default=4)
+parser.add_argument("--slow_speed",
+                    action="store",
+                    dest="slow_speed",
+                    type=float,
+                    help="tip movement in pixels per frame up to which the adaptive tracker skips frames.",
+                    default=1.0)
+parser.add_argument("--max_radius",
+                    action="store",
+                    dest="max_radius",
+                    type=int,
+                    help="largest window the predictive tracker grows to when it loses the tip. Defaults to 4 * bound_radius.",
+                    default=None)
+parser.add_argument("--compare",
+                    action="store_true",
+                    help="do not save anything, trace every experiment with the full tracker at bound_radius 30 and with --tracker and report tip distances and speedup.")
+args = parser.parse_args()
+if args.bound_radius is None:
+    args.bound_radius = 15 if args.tracker == "predictive" else 30
+print(args)
+
+tracker_options = {"full": {},
+                   "pyramid": {"pyramid_factor": args.pyramid_factor},
+                   "adaptive": {"max_step": args.max_step, "slow_speed": args.slow_speed},
+                   "predictive": {"max_radius": args.max_radius}}[args.tracker]
+
+experiments = q.find_experiments(args.source, args.snapshots, args.experiments or None)
+print([e.name for e in experiments])
+
+if args.compare:
+    for experiment in experiments:
+        print(q.compare_tracking(experiment,
+                                 length=args.length,
+                                 threshold_multiplier=args.threshold_multiplier,
+                                 bound_radius=args.bound_radius,
+                                 stabilize=args.stabilize,
+                                 tracker=args.tracker,
+                                 tracker_options=tracker_options,
+                                 reference_bound_radius=30))
+else:
+    memory_budget = None if args.memory_budget is None else int(args.memory_budget * 2**30)
+    results = q.run(experiments,
+                    max_workers=args.workers,
+                    memory_budget=memory_budget,
+                    lease_ttl=args.lease_ttl * 60 * 60,
+                    lease_dir=args.lease_dir,
+                    length=args.length,
+                    threshold_multiplier=args.threshold_multiplier,
+                    bound_radius=args.bound_radius,
+                    stabilize=args.stabilize,
+                    tracker=args.tracker,
+                    tracker_options=tracker_options)
+    print(str(len(results)) + " experiments traced.")
@@ -0,0 +1,113 @@
+"""
+    Module with the content hash index that keeps merges into current_exp from duplicating frames.
+
+    Every experiment keeps a hidden .frame_hashes.json mapping its frame names
+    to a hash of their png bytes. Frames that are not in the index yet are hashed
+    in parallel the next time the experiment is merged into, so the index never
+    has to be rebuilt from scratch. Before label() or re_merge() append frames to
+    an experiment, the incoming frames are hashed and any frame whose bytes are
+    already in the experiment, or earlier in the same batch, is skipped.
+
+    xxhash is used when it is installed, blake2b from hashlib otherwise. An index
+    written with the other algorithm is rebuilt.
+
+"""
+
+import os
+import json
+import hashlib
+import concurrent.futures
+
+from src.myutilities import util
+
+try:
+    import xxhash
+    ALGORITHM = "xxh64"
+except ImportError:
+    xxhash = None
+    ALGORITHM = "blake2b"
+
+HASH_INDEX = ".frame_hashes.json"
+BLOCK_SIZE = 1 << 20
+
+
+def hash_file(path):
+    h = xxhash.xxh64() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_files(paths, max_workers=None):
+    """ hashes of the files, in the order of paths """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(hash_file, paths))
+
+
+def load_index(exp_path):
+    """ frame name -> hash of an experiment, empty if it has no index or one of another algorithm """
+    try:
+        with open(os.path.join(exp_path, HASH_INDEX)) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if index.get("algorithm") != ALGORITHM:
+        return {}
+    return index["frames"]
+
+
+def save_index(exp_path, frames):
+    path = os.path.join(exp_path, HASH_INDEX)
+    with open(path + ".part", "w") as f:
+        json.dump({"algorithm": ALGORITHM, "frames": frames}, f)
+    os.replace(path + ".part", path)
+
+
+def update_index(exp_path, max_workers=None):
+    """ Hash the frames of the experiment that are not indexed yet, forget the ones that are gone, and save the index """
+    indexed = load_index(exp_path)
+    names = util.frame_names(exp_path)
+    frames = {name: indexed[name] for name in names if name in indexed}
+    missing = [name for name in names if name not in frames]
+    for name, digest in zip(missing, hash_files([os.path.join(exp_path, name) for name in missing], max_workers)):
+        frames[name] = digest
+    if frames != indexed:
+        save_index(exp_path, frames)
+    return frames
+
+
+def find_duplicates(paths, exp_path, max_workers=None):
+    """
+        Split incoming frame files into the ones to merge into an experiment and the duplicates to skip.
+
+        Returns (kept, duplicates), where kept is a list of (path, hash) in the order of paths and
+        duplicates a list of (path, name of the frame with the same bytes). That frame is either in the
+        experiment or an earlier incoming one.
+    """
+    existing = update_index(exp_path, max_workers) if os.path.isdir(exp_path) else {}
+    seen = {digest: name for name, digest in existing.items()}
+    kept = []
+    duplicates = []
+    for path, digest in zip(paths, hash_files(paths, max_workers)):
+        if digest in seen:
+            duplicates.append((path, seen[digest]))
+        else:
+            seen[digest] = os.path.basename(path)
+            kept.append((path, digest))
+    return kept, duplicates
+
+
+def record(exp_path, hashes):
+    """ add frame name -> hash of frames merged into the experiment to its index """
+    frames = load_index(exp_path)
+    frames.update(hashes)
+    save_index(exp_path, frames)
+
+
+def write_report(path, skipped):
+    """ Write the skipped duplicates, a list of dicts with experiment, frame and duplicate_of, as json """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"skipped": skipped}, f, indent=4)
+    print(str(len(skipped)) + " duplicate frames skipped, see " + path)
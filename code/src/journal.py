@@ -0,0 +1,99 @@
+"""
+    Module with the append-only journal that makes the sorting pipeline resumable.
+
+    Every run gets a journal file of json lines. Before a stage moves anything it
+    records the moves it is about to make, and after every step it records that
+    the step is done. A restarted robot_image_sorting.py reads the journal, skips
+    finished steps, and replays recorded moves that have not happened yet
+    instead of planning or detecting them again. Once the run's zip is removed
+    from staging the journal is finished and moved to <path>/finished/, so a zip
+    staged later under the same name starts a new run.
+
+"""
+
+import os
+import json
+import shutil
+
+
+class RunJournal:
+    """ Journal of one robot run, kept in <path>/<run name>.jsonl until the run is finished """
+
+    FINISHED = "finished"
+
+    def __init__(self, path, run_name):
+        self.run_name = run_name
+        self.path = os.path.join(path, run_name + ".jsonl")
+        self.finished_path = os.path.join(path, self.FINISHED, run_name + ".jsonl")
+        os.makedirs(path, exist_ok=True)
+        self.entries = self._read()
+        if self.is_done(self.FINISHED):
+            # the process died between finishing the run and retiring its journal
+            self._retire()
+
+    def _read(self):
+        entries = []
+        good = 0
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line.decode("utf-8")))
+                    except ValueError:
+                        break
+                    good += len(line)
+        except FileNotFoundError:
+            return entries
+        if good < os.path.getsize(self.path):
+            # the last line is cut off if the process died while writing it, drop it so new entries start on a fresh line
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+        return entries
+
+    def record(self, event, **fields):
+        entry = dict(fields, event=event)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries.append(entry)
+        return entry
+
+    def find(self, event, **fields):
+        """ last entry of the event whose fields match, or None """
+        for entry in reversed(self.entries):
+            if entry["event"] == event and all(entry.get(k) == v for k, v in fields.items()):
+                return entry
+        return None
+
+    @property
+    def started(self):
+        return len(self.entries) > 0
+
+    def is_done(self, step):
+        return self.find("done", step=step) is not None
+
+    def mark_done(self, step):
+        self.record("done", step=step)
+
+    def finish(self):
+        """ Record that the whole run is done and retire the journal, the next run of this name starts empty """
+        self.mark_done(self.FINISHED)
+        self._retire()
+
+    def _retire(self):
+        os.makedirs(os.path.dirname(self.finished_path), exist_ok=True)
+        os.replace(self.path, self.finished_path)
+        self.entries = []
+
+
+def apply_moves(moves):
+    """
+        Make recorded (source, destination) moves that have not happened yet. A move whose
+        source is gone and whose destination exists already happened before a restart.
+    """
+    for source, destination in moves:
+        if os.path.exists(source):
+            shutil.move(source, destination)
+        elif not os.path.exists(destination):
+            print("WARNING: " + source + " is missing and was never moved to " + destination)
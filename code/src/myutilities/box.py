@@ -9,8 +9,18 @@ from plantcv import plantcv as pcv
 import csv
 import src.myutilities.constants as c
 import os
+import json
 from matplotlib import pyplot as plt
-from src.myutilities.image import Image
+from src.myutilities.image import Roi
+import src.myutilities.image as image_util
+from src.myutilities import tip_tracer
+from src.myutilities import stabilization
+from src.myutilities import results
+from src.myutilities import projection
+from src.myutilities import frame_stats
+from src.myutilities import timeline
+
+SNAPSHOT_VERSION = 1
 
 class Box:
     """The box class defines the data derived from a single magenta box in an experiment.
@@ -23,9 +33,12 @@ class Box:
     """
     
     #This is the list where the raw images will be stored in memory. This will be quite large, which is why the call to the garbage collector is necessary between analysis of each box.
-    images = []
+    #It stays None until an operation actually needs pixels (see the images property), so a box restored from a snapshot costs nothing to create.
+    _images = None
+    _frame_stats = None
     
-    def __init__(self, path, save_path = c.QUANTIFICATION_OUT_PATH):
+    def __init__(self, path, save_path = c.QUANTIFICATION_OUT_PATH, load_images : bool = True, stabilize : bool = False,
+                 time_window : tuple = None):
         """
         Attributes
         ----------
@@ -34,6 +47,15 @@ class Box:
             argument. a string containing the full path of the directory containing the raw images the box is going to load into memory
         _save_path : str
             argument. the directory where post-tracking data is stored. Defaults to QUANTIFICATION_OUT_PATH in the constants.py module
+        load_images : bool
+            argument. load every image now. If false, images are loaded the first time they are accessed.
+        stabilize : bool
+            argument. read the raw pngs through the stored stabilization transforms (estimated first if missing), see
+            the stabilization module. Frames are then read and stabilized when indexed instead of all held in memory.
+        time_window : tuple
+            argument. (start, end) unix times or datetimes. Only the frames taken in [start, end) are loaded, found with the
+            experiment's timeline (see the timeline module). Frame indices then count from the first frame of the window.
+            Either end may be None.
         _qr_number : str
             the experiment number of the box, parsed from the full path, and kept as a string
         my_list : list
@@ -46,15 +68,51 @@ class Box:
         self._path = path 
         self._qr_number = os.path.basename(os.path.normpath(self._path))
         self._save_path = os.path.normpath(save_path) + f"/{self._qr_number}"
-        my_list = util.listdir_nohidden(self._path)
-        my_list = [self._path + l for l in my_list]
+        self.seeds = [] # Seed objects
+        self.stabilize = stabilize
+        self.time_window = None if time_window is None else tuple(timeline.to_unix_time(t) for t in time_window)
+        self._window_positions = None
+        self._window_names = None
+        if load_images:
+            self._images = self._load_images()
+
+    def _load_images(self):
+        if self.stabilize:
+            return stabilization.FrameSequence(self._path, frames = None if self.time_window is None else self.frame_names())
+        my_list = self.frame_names()
+        my_list = [os.path.join(self._path, l) for l in my_list]
         with concurrent.futures.ThreadPoolExecutor() as executor:
             all_images = executor.map(io.read_image_single_channel, my_list)
-        self.images = [img for img in all_images] # numpy array of images, grayscale mode
-        self.seeds = [] # Seed objects
+        return [img for img in all_images] # numpy array of images, grayscale mode
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = self._load_images()
+        return self._images
+
+    @images.setter
+    def images(self, images):
+        self._images = images
+
+    @property
+    def frame_stats(self):
+        """
+        Cached histograms of the frames for exact per-frame medians and percentiles, see frame_stats.FrameStats. Read from
+        the experiment folder, computed and stored there first if needed. None for stabilized boxes, whose warped frames do
+        not match the stored statistics of the pngs.
+        """
+        if self.stabilize:
+            return None
+        if self._frame_stats is None:
+            stats = frame_stats.FrameStats.get(self._path)
+            if self.time_window is not None:
+                stats = frame_stats.FrameStats(stats.histograms[self.window_positions()], self.frame_names())
+            self._frame_stats = stats
+        return self._frame_stats
     
         
-    def init_seeds(self, seed_model: retnet.SeedModel, automatic : bool = True):
+    def init_seeds(self, seed_model: retnet.SeedModel, automatic : bool = True, tile_size : int = None, tile_overlap : int = 256):
         """
         This method optionally runs automatic seed detection. It can also manually define regions of seeds. It then creates the appropriate number of seed objects associated with the respective box objects.
         
@@ -64,6 +122,10 @@ class Box:
             This is the trained retinanet model for detecting seeds in image
         automatic : bool
             true: attempt automatic seed detection. false: use manual seed detection.
+        tile_size : int
+            optional tile size for high-resolution tiled detection, see retnet.SeedModel.detect
+        tile_overlap : int
+            overlap between detection tiles
         """
         
         seed_model._confidence_cutoff = .3
@@ -75,7 +137,7 @@ class Box:
             initial_image[:,0:startx] = 0
             initial_image[:,(startx+2000):x] = 0
             seeds_full, scores = seed_model.detect(image_arr=cv2.cvtColor(initial_image, cv2.COLOR_GRAY2BGR),
-                                          sort=True)
+                                          sort=True, tile_size=tile_size, tile_overlap=tile_overlap)
             
             disp = cv2.cvtColor(self.images[0], cv2.COLOR_GRAY2BGR)
             plt.imshow(disp)
@@ -91,27 +153,20 @@ class Box:
             
             res = sorted(sorted(range(len(scores)), key = lambda sub: scores[sub])[-int(num_seeds):])
               
-            seeds = []
-            for index in res:
-                seeds.append(seeds_full[index])   
-            print(len(seeds))
-          
+            # regions of the chosen seeds in one array, the seeds keep views of its rows
+            regions = np.array([seeds_full[index].bounds for index in res], dtype=np.int64).reshape(-1, 4)
+            print(len(regions))
+
+            height, width = np.shape(self.images[0])[:2]
+            inside = ((regions[:, image_util.Y1] > .1 * height) & (regions[:, image_util.Y1] < .9 * height) &
+                      (regions[:, image_util.X1] > .1 * width) & (regions[:, image_util.X1] < .9 * width))
+            image_util.pad_bounds(regions, left=50, right=50, top=50, bottom=100)
 
-            for count, seed in enumerate(seeds):
-                if ((seed.y1 > (.1 * np.shape(self.images[0])[0])) and (seed.y1 < (.9 * np.shape(self.images[0])[0]))):
-                    if ((seed.x1 > (.1 * np.shape(self.images[0])[1])) and (seed.x1 < (.9 * np.shape(self.images[0])[1]))):
-                        self.seeds.append(Seed(seed, self._qr_number, count + 1))
+            for count in np.flatnonzero(inside):
+                self.seeds.append(Seed(Roi.view(regions[count]), self._qr_number, int(count) + 1))
 
             for s in self.seeds:
-                s.final_x1 = s.final_x1 - 50
-                s.final_x2 = s.final_x2 + 50
-                s.final_y1 = s.final_y1 - 50
-                s.final_y2 = s.final_y2 + 100
-                s.x1 = s.x1 - 50
-                s.x2 = s.x2 + 50
-                s.y1 = s.y1 - 50
-                s.y2 = s.y2 + 100
-                cv2.rectangle(disp,(s.final_x1, s.final_y1),(s.final_x2,s.final_y2),(255,0,0),5)
+                cv2.rectangle(disp,(s.region.x1, s.region.y1),(s.region.x2,s.region.y2),(255,0,0),5)
 
             plt.imshow(disp)
             plt.show()
@@ -196,7 +251,7 @@ class Box:
                         print("Type (r) or (y)")
                 
                 if cont == "y":
-                    self.seeds.append(Seed(Image(germ_region, x1 = int(left_x), y1 = int(top_y), x2 = int(right_x), y2 = int(bottom_y)), self._qr_number, s))
+                    self.seeds.append(Seed(Roi(x1 = int(left_x), y1 = int(top_y), x2 = int(right_x), y2 = int(bottom_y)), self._qr_number, s))
                     break
          
 
@@ -206,21 +261,59 @@ class Box:
         if save_path is None:
             save_path = self._save_path
         for seed in self.seeds:
-            seed.germination_detection(self.images, count, save_path, threshold_multiplier = threshold_multiplier, automatic = automatic)
+            seed.germination_detection(self.images, count, save_path, threshold_multiplier = threshold_multiplier, save_tip_sample = save_tip_sample, automatic = automatic, stats = lambda: self.frame_stats)
             count += 1
 
     #Call to seed tip trace
     #seed.tip_trace_pcv(b.images, length = 250)
-    def tip_trace_pcv(self, length : int = None, threshold_multiplier : float = 1.5, bound_radius : int = 30):
+    def tip_trace_pcv(self, length : int = None, threshold_multiplier : float = 1.5, bound_radius : int = 30, tracker : str = "full", **tracker_options):
+        """
+        Track the root tips of all germinated seeds, see track_tips, and write a tip video of every seed.
+        """
+        for count, seed, _ in self.track_tips(length = length, threshold_multiplier = threshold_multiplier, bound_radius = bound_radius,
+                                              tracker = tracker, **tracker_options):
+            seed.make_video(self.images, c.QUANTIFICATION_OUT_PATH + "/stabilized_videos_single_seed" + f"/{self._qr_number}_{count}.mp4", trace_tip=True)
+
+    def track_tips(self, length : int = None, threshold_multiplier : float = 1.5, bound_radius : int = 30, tracker : str = "full", **tracker_options):
+        """
+        Track the root tips of all germinated seeds. Frames are visited once, in order, and every seed whose tracking range
+        covers a frame is advanced on it, so each frame is read once no matter how many seeds the box holds.
+
+        Parameters
+        ----------
+        tracker : str
+            tracking mode, a key of tip_tracer.TRACKERS. "full" traces every frame at full resolution, "pyramid" coarse to fine
+        **tracker_options
+            passed to the tracker, e.g. pyramid_factor
+
+        Returns
+        -------
+        list
+            (1-based position in the box, seed, finished tracker) of every tracked seed
+        """
+        tracked = []
         count = 1
         for seed in self.seeds:
             if seed.germination_indicator:
-                seed.tip_trace_pcv(self.images, length = length, tot_length = len(self.images), threshold_multiplier = threshold_multiplier, bound_radius = bound_radius)
-                seed.make_video(self.images, c.QUANTIFICATION_OUT_PATH + "/stabilized_videos_single_seed" + f"/{self._qr_number}_{count}.mp4", trace_tip=True)
+                tracked.append((count, seed, seed.start_tracking(length = length, tot_length = len(self.images), threshold_multiplier = threshold_multiplier, bound_radius = bound_radius,
+                                                                 tracker = tracker, **tracker_options)))
             count = count + 1
-            #seed.tip_trace(self.images, tip_model, length=length, save_path=self._save_path)
-            # TODO remove break
-            # break
+
+        trackers = [t for _, _, t in tracked]
+        if trackers:
+            for frame_index in range(min(t.start_frame for t in trackers), max(t.end_frame for t in trackers)):
+                active = [t for t in trackers if t.wants(frame_index)]
+                if not active:
+                    if all(t.done for t in trackers):
+                        break
+                    continue
+                image = self.images[frame_index]
+                for t in active:
+                    t.update(frame_index, image)
+
+        for count, seed, t in tracked:
+            seed.finish_tracking(t)
+        return tracked
 
 
     def set_images(self, images):
@@ -243,23 +336,7 @@ class Box:
             # break
 
     def to_json(self):
-        # for x in range(len(self.images)):
-        #     self.images[x] = self.images[x].tolist()
-        #
-        #
-        # print(type(self.images[0]))
-        return json.dumps(self, default = self._serialize_json,
-                          sort_keys=True, indent=4)
-
-        pass
-
-    
-    # helper method
-    def _serialize_json(self):
-        return {
-            'path': self._path,
-            'qr_number': self._qr_number
-        }
+        return json.dumps(self.to_dict(), sort_keys=True, indent=4)
 
     # note can get rid of the qr_number since that is derived from path
     def to_dict(self):
@@ -267,26 +344,149 @@ class Box:
         return {
             "path": self._path,
             "qr_number": self._qr_number,
-            "save_path": self._save_path,
+            "save_path": os.path.dirname(self._save_path),
+            "stabilize": self.stabilize,
+            "time_window": self.time_window,
             "seeds": seeds
         }
 
-
-
-
     @classmethod
     def from_dict(cls, dct: dict):
-        box = cls(dct.get("path"), dct.get("save_path"))
+        # images are not needed to restore the seeds, they are loaded when first used
+        box = cls(dct.get("path"), dct.get("save_path"), load_images=False, stabilize=dct.get("stabilize", False),
+                  time_window=dct.get("time_window"))
         # need to save seed_coordinates to avoid running init_seeds
         # running init_seeds would require passing seed_model
         seeds = dct.get("seeds")
         final_seeds = []
         for seed_dct in seeds:
-            seed = Seed.from_dict(seed_dct, box.images[0])
+            seed = Seed.from_dict(seed_dct)
             final_seeds.append(seed)
         box.seeds = final_seeds
         return box
 
+    def save_snapshot(self, snapshot_path : str = None):
+        """
+        Save the tracking state of the box and its seeds (seed regions, germination frames and points, tip coordinates and
+        curling frames) to an uncompressed npz file. No image data is written.
+
+        Parameters
+        ----------
+        snapshot_path : str
+            file to write. Defaults to snapshot.npz in the box save path.
+
+        Returns
+        -------
+        str
+            path of the written snapshot
+        """
+        if snapshot_path is None:
+            snapshot_path = os.path.join(self._save_path, "snapshot.npz")
+        os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+
+        def none_to(value, default = -1):
+            return default if value is None else value
+
+        def ragged(arrays):
+            arrays = [np.asarray(a, dtype=np.int64).reshape(-1, 2) for a in arrays]
+            offsets = np.cumsum([0] + [len(a) for a in arrays])
+            values = np.concatenate(arrays) if arrays else np.empty((0, 2), dtype=np.int64)
+            return values, offsets
+
+        tip_coords_pcv, tip_coords_pcv_offsets = ragged([s.tip_coords_pcv for s in self.seeds])
+        tip_coords, tip_coords_offsets = ragged([s.tip_coords for s in self.seeds])
+        tip_interpolated = np.concatenate([np.zeros(0, dtype=bool)] + [np.asarray(s.tip_interpolated, dtype=bool) for s in self.seeds])
+        tip_residuals = np.concatenate([np.zeros(0)] + [np.asarray(s.tip_residuals, dtype=np.float64) for s in self.seeds])
+        tip_growths = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.asarray(s.tip_growths, dtype=np.int64) for s in self.seeds])
+        
+        # write through a file object so numpy does not append .npz to the name
+        with open(snapshot_path, "wb") as f:
+            np.savez(f,
+                     version=np.array(SNAPSHOT_VERSION),
+                     path=np.array(self._path),
+                     save_path=np.array(os.path.dirname(self._save_path)),
+                     stabilize=np.array(self.stabilize),
+                     time_window=np.array([np.nan if t is None else t for t in (self.time_window or (None, None))], dtype=np.float64),
+                     qr_number=np.array([str(s.qr_number) for s in self.seeds], dtype=str),
+                     seed_number=np.array([s.seed_number for s in self.seeds], dtype=np.int64),
+                     region=np.array([s.region.bounds for s in self.seeds], dtype=np.int64).reshape(-1, 4),
+                     roi=np.array([s.bounds for s in self.seeds], dtype=np.int64).reshape(-1, 4),
+                     germination_frame=np.array([s.germination_frame for s in self.seeds], dtype=np.int64),
+                     germination_xy=np.array([[none_to(s.germination_x), none_to(s.germination_y)] for s in self.seeds], dtype=np.int64).reshape(-1, 2),
+                     germination_indicator=np.array([s.germination_indicator for s in self.seeds], dtype=bool),
+                     germination_not_found=np.array([s.germination_not_found for s in self.seeds], dtype=bool),
+                     curling_start_frame=np.array([none_to(s.curling_start_frame) for s in self.seeds], dtype=np.int64),
+                     tip_coords_pcv=tip_coords_pcv,
+                     tip_coords_pcv_offsets=tip_coords_pcv_offsets,
+                     tip_interpolated=tip_interpolated,
+                     tip_residuals=tip_residuals,
+                     tip_growths=tip_growths,
+                     tip_coords=tip_coords,
+                     tip_coords_offsets=tip_coords_offsets)
+        return snapshot_path
+
+    @classmethod
+    def load_snapshot(cls, snapshot_path : str, path : str = None, save_path : str = None, stabilize : bool = None):
+        """
+        Restore a box and its seeds from a snapshot written by save_snapshot. Images are not read until they are needed.
+
+        Parameters
+        ----------
+        snapshot_path : str
+            snapshot file
+        path : str
+            optional override of the directory containing the raw images, e.g. if the experiment was moved
+        save_path : str
+            optional override of the post-tracking save directory
+        stabilize : bool
+            optional override of whether frames are read through the stabilization transforms. Seed coordinates are
+            only valid in the frames they were found in
+        """
+        with np.load(snapshot_path, allow_pickle=False) as data:
+            if int(data["version"]) != SNAPSHOT_VERSION:
+                raise ValueError("Unsupported snapshot version " + str(data["version"]))
+            if path is None:
+                path = str(data["path"])
+            if save_path is None:
+                save_path = str(data["save_path"])
+            if stabilize is None:
+                stabilize = bool(data["stabilize"]) if "stabilize" in data.files else False
+            time_window = None
+            if "time_window" in data.files and not np.isnan(data["time_window"]).all():
+                time_window = tuple(None if np.isnan(t) else float(t) for t in data["time_window"])
+            box = cls(path, save_path, load_images=False, stabilize=stabilize, time_window=time_window)
+
+            def none_from(value, default = -1):
+                return None if value == default else int(value)
+
+            regions = data["region"].astype(np.int64)
+            for i in range(len(data["seed_number"])):
+                seed = Seed(Roi.view(regions[i]), str(data["qr_number"][i]), int(data["seed_number"][i]))
+                seed.bounds[:] = data["roi"][i]
+                seed._tracking_start_frame = int(data["germination_frame"][i])
+                seed.germination_x = none_from(data["germination_xy"][i][0])
+                seed.germination_y = none_from(data["germination_xy"][i][1])
+                seed.germination_indicator = bool(data["germination_indicator"][i])
+                seed.germination_not_found = bool(data["germination_not_found"][i])
+                seed.curling_start_frame = none_from(data["curling_start_frame"][i])
+                offsets = data["tip_coords_pcv_offsets"]
+                tip_coords_pcv = data["tip_coords_pcv"][offsets[i]:offsets[i + 1]]
+                seed.tip_coords_pcv = tip_coords_pcv if len(tip_coords_pcv) else []
+                if "tip_interpolated" in data.files:
+                    seed.tip_interpolated = data["tip_interpolated"][offsets[i]:offsets[i + 1]].tolist()
+                else:
+                    seed.tip_interpolated = [False] * len(tip_coords_pcv)
+                if "tip_residuals" in data.files:
+                    seed.tip_residuals = data["tip_residuals"][offsets[i]:offsets[i + 1]].tolist()
+                    seed.tip_growths = data["tip_growths"][offsets[i]:offsets[i + 1]].tolist()
+                else:
+                    seed.tip_residuals = [np.nan] * len(tip_coords_pcv)
+                    seed.tip_growths = [0] * len(tip_coords_pcv)
+                offsets = data["tip_coords_offsets"]
+                seed.tip_coords = data["tip_coords"][offsets[i]:offsets[i + 1]].tolist()
+                box.seeds.append(seed)
+        return box
+
     # override
     # def default(self, obj):
     #     if isinstance(obj, np.ndarray):
@@ -317,10 +517,7 @@ class Box:
                         print("Invalid response.")
                 if save1 == "y":
                     print("Saving coordinates.")
-                    with open(c.QUANTIFICATION_OUT_PATH + "tip_coordinates/" + f"/{self._qr_number}_{count}" + ".csv", 'w') as myfile:
-                        wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
-                        wr.writerow(s.tip_coords_pcv)
-                        #do some other saving stuff
+                    self.save_tip_coordinates(s, count, curled = False)
                 elif save1 =="c":
                     first = 0
                     last = len(self.images) - 1
@@ -360,38 +557,151 @@ class Box:
                             last = mid
                             
                     print("Saving coordinates.")
-                    coords = s.tip_coords_pcv[:(s.curling_start_frame - s._tracking_start_frame)]
-                    coords[-1,0] = 100000
-                    coords[-1,1] = 100000
-                    with open(c.QUANTIFICATION_OUT_PATH + "tip_coordinates/" + f"/{self._qr_number}_{count}" + ".csv", 'w') as myfile:
-                        wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
-                        wr.writerow(coords)
-                        #do some other saving stuff
-                    
+                    self.save_tip_coordinates(s, count)
 
-class Seed(Image):
+    def save_tracking(self):
+        """
+        Non-interactive counterpart of validate_save_tracking. Saves the tip coordinates of every germinated seed, truncated
+        at the curling frame for seeds that have one.
 
+        Returns
+        -------
+        list
+            paths of the saved csv files
+        """
+        paths = []
+        count = 0
+        for s in self.seeds:
+            count = count + 1
+            if(s.germination_indicator and not s.germination_not_found and len(s.tip_coords_pcv) > 0):
+                paths.append(self.save_tip_coordinates(s, count))
+        return paths
 
-    def __init__(self, mi: Image, qr_number, seed_number):
-        super().__init__(mi.image, mi.crop, mi.x1, mi.x2, mi.y1, mi.y2)
+    def save_tip_coordinates(self, seed, count : int, curled : bool = None):
+        """
+        Store the tip coordinates of a seed in the results store (see results.py), with frame indices and timestamps, and
+        write them to tip_coordinates/<qr number>_<count>.csv in QUANTIFICATION_OUT_PATH as before.
+
+        Parameters
+        ----------
+        seed : Seed
+            traced seed
+        count : int
+            1-based position of the seed in the box
+        curled : bool
+            truncate the coordinates at the curling frame and mark the last one with 100000. Defaults to whether the seed
+            has a curling frame.
+        """
+        coords = np.asarray(seed.tip_coords_pcv)
+        if curled is None:
+            curled = seed.curling_start_frame is not None
+        frame_names, positions = None, None
+        if self._path and os.path.isdir(self._path):
+            if self.time_window is None:
+                frame_names = self.frame_names()
+            else:
+                # the store keeps frame indices within the whole experiment, not within the window
+                positions = self.window_positions()
+                frame_names = timeline.Timeline.load(self._path, verify=False).names
+        results.write_seed(self._qr_number, seed, count, frame_names, positions=positions, curled=curled)
+        if curled:
+            coords = np.copy(coords[:(seed.curling_start_frame - seed._tracking_start_frame)])
+            coords[-1,0] = results.CURLING_MARKER
+            coords[-1,1] = results.CURLING_MARKER
+        path = os.path.join(c.QUANTIFICATION_OUT_PATH, "tip_coordinates", f"{self._qr_number}_{count}.csv")
+        with open(path, 'w') as myfile:
+            wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
+            wr.writerow(coords)
+        return path
+
+    def frame_names(self):
+        """file names of the experiment's frames, or of the frames in the time window, in frame order"""
+        if self.time_window is None:
+            return util.frame_names(self._path)
+        self.window_positions()
+        return list(self._window_names)
+
+    def window_positions(self):
+        """positions among all frames of the experiment of the frames in the time window"""
+        if self._window_positions is None:
+            frames = timeline.Timeline.load(self._path)
+            self._window_positions = frames.window(*self.time_window)
+            names = frames.names
+            self._window_names = [names[i] for i in self._window_positions]
+        return self._window_positions
+
+    def _frames(self):
+        """the loaded images, or the paths of the pngs if they are not loaded, so streaming reductions do not load them all"""
+        if self._images is not None or self.stabilize:
+            return self.images
+        return [os.path.join(self._path, f) for f in self.frame_names()]
+
+    def temporal_summary(self, start : int = 0, stop : int = None, roi : Roi = None, workers : int = projection.WORKERS):
+        """
+        Max, min, mean and variance images of the frames of the box in one pass, see projection.summarize.
+
+        Parameters
+        ----------
+        start, stop : int
+            range of frames to summarize, defaults to all of them
+        roi : Roi
+            optional region of the frames to summarize
+        """
+        return projection.summarize(self._frames(), start, stop, roi = roi, workers = workers)
+
+    def quantify_max_intensity_projection(self, threshold_multiplier : float = 1.5, save : bool = False):
+        """
+        Root-occupied area of every germinated seed, from the max intensity projection of its frames, see
+        Seed.quantify_max_intensity_projection.
+
+        Parameters
+        ----------
+        save : bool
+            also save the projection images of each seed to projection_seed<count> in the save path
+
+        Returns
+        -------
+        dict
+            root area in pixels by 1-based position of the seed in the box
+        """
+        areas = {}
+        frames = self._frames()
+        for count, s in enumerate(self.seeds, 1):
+            if s.germination_indicator and not s.germination_not_found:
+                s.max_intensity_projection(frames)
+                areas[count] = s.quantify_max_intensity_projection(threshold_multiplier = threshold_multiplier)
+                if save:
+                    projection.save_summary(s.projection, self._save_path + f"/projection_seed{count}")
+        return areas
+                    
+
+class Seed(Roi):
+    """
+    A seed of a box. The seed itself is the region currently searched for its root, which moves while tracking, and region
+    is where the seed was found. Neither holds a frame, crops are taken from the images passed in.
+    """
+
+    def __init__(self, region: Roi, qr_number, seed_number):
+        super().__init__(*region.bounds)
         self.germination_indicator = False
         self.germination_not_found = False
         self._tracking_start_frame = 0
         self.germination_x = None
         self.germination_y = None
         self.tip_coords_pcv = []
+        self.tip_interpolated = []
+        self.tip_residuals = []
+        self.tip_growths = []
         self.tip_coords = []
         self.qr_number = qr_number
         self.seed_number = seed_number
         self.final_trace_img = None
         self.curling_start_frame = None
+        self.projection = None
+        self.root_area = None
 
-        # keep these and store in database to recreate this Seed object
-
-        self.final_x1 = mi.x1
-        self.final_x2 = mi.x2
-        self.final_y1 = mi.y1
-        self.final_y2 = mi.y2
+        # keep this and store in database to recreate this Seed object
+        self.region = region
 
 
     @property
@@ -405,170 +715,161 @@ class Seed(Image):
         else:
             raise ValueError("Set germination frame to int above 0")
 
-    def germination_detection(self, images, seed_number,  save_path : str, threshold_multiplier : float = 1.5, save_tip_sample: bool = False, automatic : bool = True):
+    def germination_detection(self, images, seed_number,  save_path : str, threshold_multiplier : float = 1.5, save_tip_sample: bool = False, automatic : bool = True, min_confidence : float = 0.8, stats = None):
+        """
+        Find the germination frame and point of the seed. In automatic mode the seed ROI of every frame is scored at once by
+        tip_tracer.germination_detection_init, and only seeds detected with a confidence below min_confidence fall back to the
+        interactive bisection. The frame medians of the interactive mode are taken from stats() if given, a function returning the
+        frame_stats.FrameStats or None, so the statistics are only loaded for seeds that need the interactive mode.
+        """
         if automatic:
-            self._tracking_start_frame, self.germination_x, self.germination_y = \
-                myutilities.tip_tracer.germination_detection_init(self, images, c.TMP_SHOWCASE_PATH, seed_number)
-            if save_tip_sample:
-                tip_corners = self.get_transform_crop_coords(self.germination_x - 30, self.germination_x + 30,
-                                                            self.germination_y - 30, self.germination_y + 30)
-                image = images[self._tracking_start_frame]
-                cv2.rectangle(image, (tip_corners.x1, tip_corners.y1), (tip_corners.x2, tip_corners.y2),
-                              c.COLOR_WHITE, c.MARKER_THICKNESS, cv2.LINE_AA)
-
-                io.save_image(io.to_pil(image), save_path + f"/germination_seed{seed_number}.png")
-        else:
-            print("Finding germination frame for seed " + str(seed_number))
-            first = 0
-            last = len(images) - 1
+            frame, x, y, confidence = tip_tracer.germination_detection_init(self, images, threshold_multiplier = threshold_multiplier)
+            if frame is not None and confidence >= min_confidence:
+                print("Seed " + str(seed_number) + " germinated at frame " + str(frame) + " (confidence " + str(round(confidence, 2)) + ")")
+                self.germination_indicator = True
+                self._tracking_start_frame = frame
+                self.germination_x = x
+                self.germination_y = y
+                if save_tip_sample:
+                    tip_corners = self.get_transform_crop_coords(self.germination_x - self.x1 - 30, self.germination_x - self.x1 + 30,
+                                                                self.germination_y - self.y1 - 30, self.germination_y - self.y1 + 30)
+                    image = cv2.cvtColor(images[self._tracking_start_frame], cv2.COLOR_GRAY2BGR)
+                    cv2.rectangle(image, (tip_corners.x1, tip_corners.y1), (tip_corners.x2, tip_corners.y2),
+                                  c.COLOR_WHITE, c.MARKER_THICKNESS, cv2.LINE_AA)
+
+                    io.save_image(io.to_pil(image), save_path + f"/germination_seed{seed_number}.png")
+                return
+            print("Automatic germination detection not confident for seed " + str(seed_number) + " (confidence " + str(round(confidence, 2)) + "), switching to manual.")
+        self._manual_germination_detection(images, seed_number, threshold_multiplier, stats)
+
+    def _manual_germination_detection(self, images, seed_number, threshold_multiplier : float = 1.5, stats = None):
+        print("Finding germination frame for seed " + str(seed_number))
+        first = 0
+        last = len(images) - 1
+        while True:
+            mid = int((first + last)/2)
+            plt.imshow(images[mid][self.y1:self.y2, self.x1:self.x2])
+            plt.show()
             while True:
-                mid = int((first + last)/2)
-                plt.imshow(images[mid][self.y1:self.y2, self.x1:self.x2])
+                direction = input("Is germination (b)efore, (a)fter, (h)ere, do you need to (r)estart, or does it not germinate (x)?")
+                if direction == "b" or direction == "a" or direction == "h" or direction == "r" or direction == "x":
+                    break
+                else:
+                    print("Invalid character")
+            if direction == "h":
+                direction = input("To confirm this as germination frame, hit (h) again, or any other key to continue searching.")
+                if direction == "h":
+                    self.germination_indicator = True
+                    self._tracking_start_frame = mid
+                    break
+            elif direction == "x":
+                direction = input("To confirm seed did not germinate, hit (x) again, or any other key to continue searching.")
+                if direction == "x":
+                    break
+            elif direction == "r":
+                first = 0
+                last = len(images) - 1
+            elif direction == "a":
+                first = mid
+            elif direction == "b":
+                last = mid
+            
+        if self.germination_indicator:                    
+            proposed = np.copy(images[self._tracking_start_frame][self.y1:self.y2, self.x1:self.x2])
+            stats = stats() if stats is not None else None
+            median = stats.median(mid) if stats is not None else frame_stats.median(images[mid])
+            threshold_light = pcv.threshold.binary(gray_img=proposed, threshold=median*threshold_multiplier , max_value=255, object_type='light')
+            binary_img = pcv.median_blur(gray_img=threshold_light, ksize=5)
+            fill_image = pcv.fill(bin_img=binary_img, size=10)
+            skeleton = pcv.morphology.skeletonize(mask=fill_image)
+            tips_img = pcv.morphology.find_tips(skel_img=skeleton, mask=fill_image)
+            locs = np.argwhere(tips_img > 0)
+                         
+            
+            i = len(locs) - 1
+            while i < len(locs):
+                copy = np.copy(proposed)
+                copy[(locs[i][0]-3):(locs[i][0]+3), (locs[i][1]-3):(locs[i][1]+3)] = 0
+                plt.imshow(copy)
                 plt.show()
                 while True:
-                    direction = input("Is germination (b)efore, (a)fter, (h)ere, do you need to (r)estart, or does it not germinate (x)?")
-                    if direction == "b" or direction == "a" or direction == "h" or direction == "r" or direction == "x":
+                    response = input("Is this the germination point? (y) or (n)")
+                    if response == "y" or response == "n":
                         break
                     else:
                         print("Invalid character")
-                if direction == "h":
-                    direction = input("To confirm this as germination frame, hit (h) again, or any other key to continue searching.")
-                    if direction == "h":
-                        self.germination_indicator = True
-                        self._tracking_start_frame = mid
-                        break
-                elif direction == "x":
-                    direction = input("To confirm seed did not germinate, hit (x) again, or any other key to continue searching.")
-                    if direction == "x":
+                if response == "y":
+                    response = input("Confirm germination is here by pressing (y), any other key to keep searching.")
+                    if response == "y":
+                        self.germination_x = locs[i][1] + self.x1
+                        self.germination_y = locs[i][0] + self.y1
                         break
-                elif direction == "r":
-                    first = 0
-                    last = len(images) - 1
-                elif direction == "a":
-                    first = mid
-                elif direction == "b":
-                    last = mid
-                
-            if self.germination_indicator:                    
-                proposed = np.copy(images[self._tracking_start_frame][self.y1:self.y2, self.x1:self.x2])
-                threshold_light = pcv.threshold.binary(gray_img=proposed, threshold=np.median(images[mid])*threshold_multiplier , max_value=255, object_type='light')
-                binary_img = pcv.median_blur(gray_img=threshold_light, ksize=5)
-                fill_image = pcv.fill(bin_img=binary_img, size=10)
-                skeleton = pcv.morphology.skeletonize(mask=fill_image)
-                tips_img = pcv.morphology.find_tips(skel_img=skeleton, mask=fill_image)
-                locs = np.argwhere(tips_img > 0)
-                             
-                
-                i = len(locs) - 1
-                while i < len(locs):
-                    copy = np.copy(proposed)
-                    copy[(locs[i][0]-3):(locs[i][0]+3), (locs[i][1]-3):(locs[i][1]+3)] = 0
-                    plt.imshow(copy)
-                    plt.show()
+                if i == 0:
                     while True:
-                        response = input("Is this the germination point? (y) or (n)")
-                        if response == "y" or response == "n":
+                        response = input("This was the last position in the list of candidate germination points. Loop through again (l) or mark as not found (n).")
+                        if response == "l" or response == "n":
                             break
                         else:
                             print("Invalid character")
-                    if response == "y":
-                        response = input("Confirm germination is here by pressing (y), any other key to keep searching.")
-                        if response == "y":
-                            self.germination_x = locs[i][1] + self.x1
-                            self.germination_y = locs[i][0] + self.y1
-                            break
-                    if i == 0:
-                        while True:
-                            response = input("This was the last position in the list of candidate germination points. Loop through again (l) or mark as not found (n).")
-                            if response == "l" or response == "n":
-                                break
-                            else:
-                                print("Invalid character")
+                    if response == "n":
+                        response = input("To confirm germination was not properly found, press (n), or any other key to continue searching.")
                         if response == "n":
-                            response = input("To confirm germination was not properly found, press (n), or any other key to continue searching.")
-                            if response == "n":
-                                self.germination_not_found = True
-                        else:
-                            i = len(locs) 
-                    i -= 1
-                
-                              
+                            self.germination_not_found = True
+                    else:
+                        i = len(locs) 
+                i -= 1
+            
                           
-    def tip_trace_pcv(self, images_param, length : int = None, tot_length : int = None, threshold_multiplier : float = 1.5, bound_radius : int = 30):
+                      
+    def tip_trace_pcv(self, images_param, length : int = None, tot_length : int = None, threshold_multiplier : float = 1.5, bound_radius : int = 30,
+                      tracker : str = "full", **tracker_options):
         """
         Method to start tracking the root tip from the identified point of germination saved in each seed object.
         """
-        
-       
-        # preprocess is a tuple of parameters in a specific order ex. ("blur", "canny", "resize")
-        # images = images_param.copy() # IMPORTANT BUG FIX, pass by reference, aka lists are mutable
         images = images_param
-        if length > tot_length - self.germination_frame:
-            print("Requested length is longer than there is data for this seed. Will track as many frames as possible.")
-            length = tot_length - self.germination_frame
-            
-        #coords = self.get_transform_crop_coords(x1=self.germination_x, y1=self.germination_y)
-        #self.transform_crop_coords(self.germination_x - bound_radius, self.germination_x + bound_radius, self.germination_y - bound_radius, self.germination_y + bound_radius)
-#         self.transform_crop_coords(-bound_radius, +bound_radius,-bound_radius, +bound_radius)
-#         self.germination_x = int((coords.x1 + coords.x2)/2)
-#         self.germination_y = int((coords.y1 + coords.y2)/2)
-        self.x1 = self.germination_x - bound_radius
-        self.x2 = self.germination_x + bound_radius
-        self.y1 = self.germination_y - bound_radius
-        self.y2 = self.germination_y + bound_radius
-        
-        tip_coords = []
-        tip_coords.append([self.germination_x, self.germination_y])
-        last_x = bound_radius
-        last_y = bound_radius
-        try:
-            count = 0
-            for image in images[self._tracking_start_frame:(self._tracking_start_frame + length)]:
-                image = image[self.y1:self.y2, self.x1:self.x2]
-
-                threshold_light = pcv.threshold.binary(gray_img=image, threshold=np.median(image)*threshold_multiplier, max_value=255, object_type='light') #try mean?
-                binary_img = pcv.median_blur(gray_img=threshold_light, ksize=5)
-                fill_image = pcv.fill(bin_img=binary_img, size=10)
-                skeleton = pcv.morphology.skeletonize(mask=fill_image)
-                tips_img = pcv.morphology.find_tips(skel_img=skeleton, mask=fill_image)
-                #tips_img = tips_img[20:-20, 20:-20]
-                locs = np.argwhere(tips_img > 0)
-                
-                #Here we take the index of the identified end-points and use np.linalg.norm to find the identified endpoint closest to the last identified tip.
-                #This solves a problem when roots grow somewhat horizontally and the old way of just choosing the bottom-most endpoint would fail because sometimes the 
-                #root starts to grow transiently upward as it circumnutates, which puts the actual tip above the endpoint found where the shootward section of the ro
-                x = locs[np.argmin([np.linalg.norm([last_y, last_x] - l) for l in locs])][1]
-                y = locs[np.argmin([np.linalg.norm([last_y, last_x] - l) for l in locs])][0]
-                
-                #old algorithm which fails when the root circumnutates while growing mostly horizontal
-#                 x = locs[np.argmax(locs, axis =0)[0]][1]
-#                 y = locs[np.argmax(locs, axis =0)[0]][0]
-                
+        tracker = self.start_tracking(length = length, tot_length = len(images) if tot_length is None else tot_length,
+                                      threshold_multiplier = threshold_multiplier, bound_radius = bound_radius,
+                                      tracker = tracker, **tracker_options)
+        for frame_index in range(tracker.start_frame, tracker.end_frame):
+            if tracker.done:
+                break
+            if tracker.wants(frame_index):
+                tracker.update(frame_index, images[frame_index])
+        self.finish_tracking(tracker)
+
+    def start_tracking(self, length : int = None, tot_length : int = None, threshold_multiplier : float = 1.5, bound_radius : int = 30,
+                       tracker : str = "full", **tracker_options):
+        """
+        Create the tip tracker for this seed, starting at the germination frame and point. tracker names the tracking mode in
+        tip_tracer.TRACKERS, tracker_options are passed to it.
 
-                #self.transform_crop_coords(x, x, y, y)
-                self.transform_crop_coords(x - bound_radius, x + bound_radius, y - bound_radius, y + bound_radius)
-                tip_coords.append([int((self.x2 + self.x1)/2), int((self.y2 + self.y1)/2)])
-                last_x = x
-                last_y = y
-                count = count + 1
-        except Exception as e: print(e)
-            
-        
-        #print(tip_coords)
-        self.tip_coords_pcv = tip_coords
+        Returns
+        -------
+        tip_tracer.TipTracker
+            tracker to be fed frames, then passed to finish_tracking
+        """
+        if length is None or length > tot_length - self.germination_frame:
+            if length is not None:
+                print("Requested length is longer than there is data for this seed. Will track as many frames as possible.")
+            length = tot_length - self.germination_frame
+        return tip_tracer.TRACKERS[tracker](self.germination_x, self.germination_y, self._tracking_start_frame, length,
+                                            threshold_multiplier = threshold_multiplier, bound_radius = bound_radius, **tracker_options)
+
+    def finish_tracking(self, tracker : tip_tracer.TipTracker):
+        """Store the results of a finished tracker. The seed crop is left on the last tracking window, as it always was."""
+        self.x1, self.x2, self.y1, self.y2 = tracker.x1, tracker.x2, tracker.y1, tracker.y2
+        self.tip_coords_pcv = tracker.tip_coords
+        self.tip_interpolated = tracker.interpolated
+        self.tip_residuals = tracker.residuals
+        self.tip_growths = tracker.growths
         
     def make_video(self, images, path: str, trace_tip: bool = True):
 
-        # pass by value immutable types, pass by reference mutable types
-        # images list is mutable and passed by reference so there is a need to copy the list in order to avoid overwriting
-
-        # convert to numpy object, this will keep self.images integrity
-        #frames = np.array(images)
-        frames = images.copy()
-        
+        # slicing gives a new list for both a list of frames and a stabilization.FrameSequence, every frame is copied
+        # below before lines are drawn into it, so the images of the box are never overwritten
         final_frames = []
 
-        frames = frames[(self._tracking_start_frame):(len(self.tip_coords_pcv) + self._tracking_start_frame - 1)]
+        frames = images[(self._tracking_start_frame):(len(self.tip_coords_pcv) + self._tracking_start_frame - 1)]
         
         #print(len(frames))
         
@@ -595,7 +896,8 @@ class Seed(Image):
 
             for x in range(len(frames)):
 
-                frame = frames[x]
+                # copy so the lines are not drawn into the shared images of the box
+                frame = np.copy(frames[x])
                 #ret,frame = cv2.threshold(frame,np.median(frame),255,cv2.THRESH_TOZERO)
                 original = np.copy(frame)
                 black = np.zeros_like(frame)
@@ -642,37 +944,71 @@ class Seed(Image):
 
 
 
-    def max_intensity_projection(self):
-        pass
+    def projection_roi(self, margin : int = 50):
+        """the seed region grown to hold every traced tip with margin pixels to spare"""
+        if len(self.tip_coords_pcv) == 0:
+            return self.region.copy()
+        tips = np.asarray(self.tip_coords_pcv)
+        x1, y1 = tips.min(axis=0) - margin
+        x2, y2 = tips.max(axis=0) + margin
+        return Roi(min(x1, self.region.x1), max(x2, self.region.x2), min(y1, self.region.y1), max(y2, self.region.y2))
 
-    def quantify_max_intensity_projection(self):
-        pass
+    def temporal_summary(self, images, start : int = None, stop : int = None, margin : int = 50, workers : int = projection.WORKERS):
+        """
+        Max, min, mean and variance images of the seed over time, computed in one streaming pass, see projection.summarize.
+
+        Parameters
+        ----------
+        images : sequence
+            frames of the box, or the paths of its pngs
+        start, stop : int
+            range of frames, defaults to germination up to the end of tracking, or to the last frame if not traced
+        margin : int
+            see projection_roi
+        """
+        if start is None:
+            start = self._tracking_start_frame
+        if stop is None:
+            stop = start + len(self.tip_coords_pcv) if len(self.tip_coords_pcv) else len(images)
+        return projection.summarize(images, start, stop, roi = self.projection_roi(margin), workers = workers)
+
+    def max_intensity_projection(self, images, **kwargs):
+        """
+        Max intensity projection of the seed region, see temporal_summary for the arguments. The whole summary is kept in
+        self.projection for quantify_max_intensity_projection.
+        """
+        self.projection = self.temporal_summary(images, **kwargs)
+        return self.projection.max
+
+    def quantify_max_intensity_projection(self, images = None, threshold_multiplier : float = 1.5):
+        """
+        Area in pixels the root occupied at some point, from the max and min projections, see projection.occupied_mask.
+        Uses the projection of the last max_intensity_projection call unless images are given.
+        """
+        if images is not None:
+            self.max_intensity_projection(images)
+        elif self.projection is None:
+            raise ValueError("No projection of seed " + str(self.seed_number) + " yet, pass images")
+        self.root_area = int(np.count_nonzero(projection.occupied_mask(self.projection, threshold_multiplier)))
+        return self.root_area
 
     def to_dict(self):
         tip_coords = self.tip_coords
         if isinstance(tip_coords, np.ndarray):
             tip_coords = tip_coords.tolist()
-        # print(type(tip_coords), type(tip_coords[0]), type(tip_coords[0][0]))
-        print(type(tip_coords))
-        if tip_coords:
-            print(type(tip_coords))
-            # print(tip_coords)
-            print(type(tip_coords[0]))
-            print(type(tip_coords[0][0]))
-        print(type(self._tracking_start_frame), type(self.germination_x), type(self.germination_y), type(self.qr_number), type(self.seed_number))
         tip_coords = [self.array_to_dict(i) for i in tip_coords]
 
         return {
             "germination_frame":self._tracking_start_frame,
-            "germination_x": int(self.germination_x),
-            "germination_y": int(self.germination_y),
+            "germination_x": None if self.germination_x is None else int(self.germination_x),
+            "germination_y": None if self.germination_y is None else int(self.germination_y),
             "tip_coords": tip_coords,
             "qr_number": self.qr_number,
             "seed_number": self.seed_number,
-            "x1": int(self.final_x1),
-            "x2": int(self.final_x2),
-            "y1": int(self.final_y1),
-            "y2": int(self.final_y2)
+            "x1": self.region.x1,
+            "x2": self.region.x2,
+            "y1": self.region.y1,
+            "y2": self.region.y2
         }
 
     @staticmethod
@@ -684,11 +1020,10 @@ class Seed(Image):
         return dct.get("coord")
 
     @classmethod
-    def from_dict(cls, dct: dict, image):
-        mi = Image(image)
-        mi.set_crop(dct.get("x1"), dct.get("x2"), dct.get("y1"), dct.get("y2"))
-        seed = cls(mi, dct.get("qr_number"), dct.get("seed_number"))
-        seed._germination_frame = dct.get("germination_frame")
+    def from_dict(cls, dct: dict):
+        region = Roi(dct.get("x1"), dct.get("x2"), dct.get("y1"), dct.get("y2"))
+        seed = cls(region, dct.get("qr_number"), dct.get("seed_number"))
+        seed._tracking_start_frame = dct.get("germination_frame")
         seed.germination_x = dct.get("germination_x")
         seed.germination_y = dct.get("germination_y")
 
@@ -17,12 +17,24 @@ QUANTIFICATION_IN_PATH = os.path.join(INSTALL_PATH, "data", "pre_quantification"
 #LOCAL quantification data location
 QUANTIFICATION_OUT_PATH = os.path.join(INSTALL_PATH, "data", "post_quantification")
 
+#columnar tip coordinate store, see results.py
+RESULTS_PATH = os.path.join(QUANTIFICATION_OUT_PATH, "results")
+
 #Stabilized video path
 STABILIZED_VIDEO_PATH = os.path.join(INSTALL_PATH, "processed_bucket", "stabilized_videos")
 
 #traced tips path local
 TRACED_TIPS_VIDS_PATH_LOCAL = os.path.join(INSTALL_PATH, "data", "post_quantification", "stabilized_videos_single_seed")
 
+#traced tips path in the mounted video bucket, or a gs:// url to upload with gsutil
+TRACED_TIPS_VIDS_BUCKET_PATH = os.path.join(INSTALL_PATH, "data", "videos", "stabilized_videos_single_seed")
+
+#Rstudio server user folder (Rstudio Server requires a dedicated non-super user)
+RSTUDIO_OUT_PATH = os.path.join("/home", "rstudio", "post_quantification")
+
+#local manifests recording what has already been synced
+SYNC_MANIFEST_PATH = os.path.join(INSTALL_PATH, "data", "sync_manifests")
+
 #robot data path. Add robot number and "/master_data/"
 ROBOT_DATA_PATH =  os.path.join(INSTALL_PATH, "data", "robot")
 
@@ -1,33 +1,163 @@
 import numpy as np
 from typing import NamedTuple
 
-class Image:
+
+class Coords(NamedTuple):
+    x1: int
+    x2: int
+    y1: int
+    y2: int
+
+
+# column order of the bounds arrays used by Roi and the batch functions below
+X1, X2, Y1, Y2 = range(4)
+
+
+class Roi:
+    """
+    Rectangular region of a frame, stored as an int array of [x1, x2, y1, y2] in frame coordinates.
+
+    A Roi never holds the frame it refers to. It can wrap a row of an (n, 4) bounds array without copying it, so the regions of
+    all seeds of a box can live in one array and be transformed together with the batch functions of this module.
+    """
+    __slots__ = ("bounds",)
+
+    def __init__(self, x1: int = 0, x2: int = 0, y1: int = 0, y2: int = 0):
+        self.bounds = np.array([x1, x2, y1, y2], dtype=np.int64)
+
+    @classmethod
+    def view(cls, bounds: np.ndarray):
+        """Roi sharing the memory of a length 4 row of a bounds array, writes to either are seen by both"""
+        roi = cls.__new__(cls)
+        roi.bounds = bounds
+        return roi
+
+    def copy(self):
+        return Roi(*self.bounds)
+
+    @property
+    def x1(self):
+        return int(self.bounds[X1])
+
+    @x1.setter
+    def x1(self, value):
+        self.bounds[X1] = value
+
+    @property
+    def x2(self):
+        return int(self.bounds[X2])
+
+    @x2.setter
+    def x2(self, value):
+        self.bounds[X2] = value
+
+    @property
+    def y1(self):
+        return int(self.bounds[Y1])
+
+    @y1.setter
+    def y1(self, value):
+        self.bounds[Y1] = value
+
+    @property
+    def y2(self):
+        return int(self.bounds[Y2])
+
+    @y2.setter
+    def y2(self, value):
+        self.bounds[Y2] = value
+
+    @property
+    def coords(self):
+        return Coords(*(int(v) for v in self.bounds))
+
+    def crop_of(self, image: np.ndarray):
+        """view of the region in image, clipped at the top and left edge"""
+        return image[max(self.y1, 0):self.y2, max(self.x1, 0):self.x2]
+
+    def transform_crop_coords(self, x1: int, x2: int, y1: int, y2: int):
+        """move the region to x1:x2, y1:y2 relative to its current top left corner"""
+        self.bounds[:] = self.bounds[[X1, X1, Y1, Y1]] + (x1, x2, y1, y2)
+
+    def set_crop(self, x1: int, x2: int, y1: int, y2: int):
+        self.bounds[:] = (x1, x2, y1, y2)
+
+    def get_transform_crop_coords(self, x1: int = 0, x2: int = 0, y1: int = 0, y2: int = 0):
+        """frame coordinates of x1:x2, y1:y2 given relative to the top left corner of the region"""
+        return Coords(self.x1 + x1, self.x1 + x2, self.y1 + y1, self.y1 + y2)
+
+    def pad(self, left: int = 0, right: int = 0, top: int = 0, bottom: int = 0):
+        self.bounds += (-left, right, -top, bottom)
+
+    def __iter__(self):
+        return iter(self.coords)
+
+    def __repr__(self):
+        return type(self).__name__ + repr(tuple(self.coords))
+
+
+class Image(Roi):
+    """A frame together with the region of it that is of interest. crop is a view into the frame, not a copy."""
+    __slots__ = ("image", "_crop")
+
     def __init__(self, image: np.ndarray,
                  crop=None, x1=None, x2=None, y1=None, y2=None):
+        super().__init__(*(0 if v is None else v for v in (x1, x2, y1, y2)))
         self.image = image
-        self.crop = crop
-        self.x1 = x1
-        self.x2 = x2
-        self.y1 = y1
-        self.y2 = y2
+        self._crop = crop
+
+    @property
+    def crop(self):
+        if self._crop is not None:
+            return self._crop
+        if self.image is None:
+            return None
+        return self.image[self.y1:self.y2, self.x1:self.x2]
 
     def transform_crop_coords(self, x1: int, x2: int, y1: int, y2: int):
-        self.x2 = self.x1 + x2
-        self.x1 = self.x1 + x1
-        self.y2 = self.y1 + y2
-        self.y1 = self.y1 + y1
-        self.crop = self.image[self.y1:self.y2, self.x1:self.x2]
+        super().transform_crop_coords(x1, x2, y1, y2)
+        self._crop = None
 
     def set_crop(self, x1: int, x2: int, y1: int, y2: int):
-        self.x1 = x1
-        self.x2 = x2
-        self.y1 = y1
-        self.y2 = y2
-        self.crop = self.image[y1:y2, x1:x2]
+        super().set_crop(x1, x2, y1, y2)
+        self._crop = None
+
+
+def boxes_to_bounds(boxes: np.ndarray, origin: Roi = None):
+    """
+    Convert detector boxes to bounds arrays.
+
+    Parameters
+    ----------
+    boxes : np.ndarray
+        (n, 4) array of [x1, y1, x2, y2] boxes as returned by retinanet, may be float
+    origin : Roi
+        region the boxes were detected in. Boxes are shifted by its top left corner into frame coordinates
+
+    Returns
+    -------
+    np.ndarray
+        (n, 4) int64 array of [x1, x2, y1, y2] rows
+    """
+    bounds = np.asarray(boxes).reshape(-1, 4)[:, [0, 2, 1, 3]].astype(np.int64)
+    if origin is not None:
+        bounds += origin.bounds[[X1, X1, Y1, Y1]]
+    return bounds
+
+
+def pad_bounds(bounds: np.ndarray, left: int = 0, right: int = 0, top: int = 0, bottom: int = 0):
+    """grow every row of an (n, 4) bounds array in place"""
+    bounds += np.array([-left, right, -top, bottom], dtype=bounds.dtype)
+    return bounds
 
-    def get_transform_crop_coords(self, x1: int = 0, x2: int = 0, y1: int = 0, y2: int = 0):
-        coords = NamedTuple("Coords", [("x1", int), ("x2", int), ("y1", int), ("y2", int)])
-        return coords(self.x1 + x1, self.x1 + x2, self.y1 + y1, self.y1 + y2)
 
+def clip_bounds(bounds: np.ndarray, shape):
+    """clip every row of an (n, 4) bounds array in place to a frame of the given (height, width, ...) shape"""
+    bounds[:, X1:X2 + 1] = np.clip(bounds[:, X1:X2 + 1], 0, shape[1])
+    bounds[:, Y1:Y2 + 1] = np.clip(bounds[:, Y1:Y2 + 1], 0, shape[0])
+    return bounds
 
 
+def views(bounds: np.ndarray):
+    """one Roi per row of an (n, 4) bounds array, sharing its memory"""
+    return [Roi.view(row) for row in bounds]
@@ -46,9 +46,8 @@ def make_video_cv2(frames: List[np.ndarray], save_path:str, filename:str=""):
     video.release()
 
 def make_video_ffmpeg(save_path : str):
-    os.chdir(save_path)
     command = 'ffmpeg -framerate 15 -pattern_type glob -i \'*.png\' -pix_fmt yuv420p outfile.mp4'
-    subprocess.call(command, shell=True)
+    subprocess.call(command, shell=True, cwd=save_path)
 
 def save_plot(fig, save_path : str):
     fig.savefig(save_path)
\ No newline at end of file
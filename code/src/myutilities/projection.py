@@ -0,0 +1,151 @@
+"""
+Module with streaming reductions of frames over time: max, min, mean and variance images
+
+Frames are visited once and only the running images are kept, so summarizing a whole experiment needs the memory of a
+few frames instead of a stacked copy of all of them. The frame range is split into one contiguous part per worker, the
+parts are reduced in parallel and their summaries merged.
+
+"""
+
+import os
+import concurrent.futures
+import numpy as np
+import cv2
+
+import src.myutilities.io as io
+from src.myutilities import stabilization
+from src.myutilities import frame_stats
+
+# parts reduced in parallel. Every worker keeps one summary, two float64 images and two frame sized images
+WORKERS = 4
+
+
+class TemporalSummary:
+    """
+    Running per-pixel max, min, mean and variance of frames of one shape.
+
+    The mean and variance are updated with Welford's method, and two summaries of different frames are combined with merge,
+    which gives the same result as updating one summary with all the frames.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.max = None
+        self.min = None
+        self._mean = None
+        self._m2 = None
+
+    def update(self, frame: np.ndarray):
+        if self.count == 0:
+            self.max = np.array(frame)
+            self.min = np.array(frame)
+            self._mean = frame.astype(np.float64)
+            self._m2 = np.zeros(np.shape(frame), dtype=np.float64)
+            self.count = 1
+            return self
+        np.maximum(self.max, frame, out=self.max)
+        np.minimum(self.min, frame, out=self.min)
+        self.count += 1
+        delta = frame - self._mean
+        self._mean += delta / self.count
+        delta *= frame - self._mean
+        self._m2 += delta
+        return self
+
+    def merge(self, other):
+        """add the frames summarized by other to this summary"""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.max, self.min, self._mean, self._m2 = other.count, other.max, other.min, other._mean, other._m2
+            return self
+        np.maximum(self.max, other.max, out=self.max)
+        np.minimum(self.min, other.min, out=self.min)
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        self._m2 += other._m2 + delta ** 2 * (self.count * other.count / count)
+        self._mean += delta * (other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def variance(self):
+        """population variance of every pixel, None before the first frame"""
+        if self.count == 0:
+            return None
+        return self._m2 / self.count
+
+
+def _reader(frames):
+    """function returning a frame by index. frames may also be a list of png paths, which are then read when needed"""
+    if isinstance(frames, stabilization.FrameSequence):
+        return frames.read
+
+    def read(index):
+        frame = frames[index]
+        if isinstance(frame, str):
+            return io.read_image_single_channel(frame)
+        return frame
+    return read
+
+
+def summarize(frames, start: int = 0, stop: int = None, roi=None, workers: int = WORKERS):
+    """
+    Summarize frames[start:stop] in one pass.
+
+    Parameters
+    ----------
+    frames : sequence
+        grayscale frames, e.g. Box.images, or paths of the pngs to read them from
+    roi : image.Roi
+        optional region the summary is restricted to, clipped at the top and left frame edge
+    workers : int
+        number of parts of the frame range reduced in parallel
+
+    Returns
+    -------
+    TemporalSummary
+        summary of the frames, or of their roi
+    """
+    stop = len(frames) if stop is None else min(stop, len(frames))
+    read = _reader(frames)
+
+    def reduce_part(indices):
+        summary = TemporalSummary()
+        for index in indices:
+            frame = read(index)
+            summary.update(frame if roi is None else roi.crop_of(frame))
+        return summary
+
+    parts = [part for part in np.array_split(np.arange(start, max(start, stop)), max(1, workers)) if len(part)]
+    if len(parts) <= 1:
+        return reduce_part(parts[0] if parts else [])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(parts)) as executor:
+        summaries = list(executor.map(reduce_part, parts))
+    summary = summaries[0]
+    for other in summaries[1:]:
+        summary.merge(other)
+    return summary
+
+
+def occupied_mask(summary: TemporalSummary, threshold_multiplier: float = 1.5):
+    """
+    Pixels that were bright in some frame but not in all of them, i.e. that a growing root moved into. Bright is above the
+    median of the max projection times threshold_multiplier, as in tip_tracer.find_tips. Pixels bright in every frame, like
+    the seed itself, are left out.
+    """
+    threshold = frame_stats.median(summary.max) * threshold_multiplier
+    mask = ((summary.max > threshold) & ~(summary.min > threshold)).astype(np.uint8) * 255
+    return cv2.medianBlur(mask, 5) > 0
+
+
+def save_summary(summary: TemporalSummary, path: str):
+    """write the max, min, mean and standard deviation images of a summary as pngs into the directory path"""
+    os.makedirs(path, exist_ok=True)
+    images = {"max": summary.max, "min": summary.min, "mean": summary.mean, "std": np.sqrt(summary.variance)}
+    for name, image in images.items():
+        io.save_image_from_array(np.clip(np.rint(image), 0, 255).astype(np.uint8), os.path.join(path, name + ".png"))
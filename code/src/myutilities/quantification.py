@@ -0,0 +1,311 @@
+"""
+Module for running tip tracing on many experiments without a notebook
+
+Experiments are read from QUANTIFICATION_IN_PATH together with the seed/germination snapshots written by
+Box.save_snapshot. Every experiment is claimed with a lease file before it is traced, so several machines sharing the
+directory split the work between them, and is traced in a worker process. Workers are only started while the estimated
+memory of all running experiments fits in the memory budget.
+
+"""
+
+import os
+import time
+import socket
+import threading
+import concurrent.futures
+from typing import NamedTuple
+from PIL import Image as Pillow
+import numpy as np
+
+import src.myutilities.constants as c
+from src.myutilities import util
+from src.myutilities import results as results_store
+
+LEASE_SUFFIX = ".lease"
+DONE_SUFFIX = ".done"
+# decoded grayscale frames plus working copies made while tracing and drawing videos
+MEMORY_OVERHEAD = 1.5
+
+
+class Experiment(NamedTuple):
+    name: str
+    image_path: str
+    snapshot_path: str
+
+
+def find_experiments(source: str = "stabilized", snapshot_dir: str = None, names: list = None):
+    """
+    Parameters
+    ----------
+    source : str
+        directory within QUANTIFICATION_IN_PATH holding the experiment folders. Usually "stabilized" or "unstabilized"
+    snapshot_dir : str
+        directory holding <experiment>.npz snapshots. Defaults to snapshots/ in QUANTIFICATION_IN_PATH
+    names : list
+        optional experiment names to restrict to
+
+    Returns
+    -------
+    list
+        Experiment tuples for every experiment folder that has a snapshot
+    """
+    in_path = os.path.join(c.QUANTIFICATION_IN_PATH, source)
+    if snapshot_dir is None:
+        snapshot_dir = os.path.join(c.QUANTIFICATION_IN_PATH, "snapshots")
+    if names is None:
+        names = util.listdir_nohidden(in_path)
+    experiments = []
+    for name in names:
+        image_path = os.path.join(in_path, str(name), "")
+        snapshot_path = os.path.join(snapshot_dir, str(name) + ".npz")
+        if not os.path.isdir(image_path):
+            print("Experiment " + str(name) + " not found in " + in_path)
+        elif not os.path.isfile(snapshot_path):
+            print("No seed snapshot for experiment " + str(name) + ", run seed and germination detection first.")
+        else:
+            experiments.append(Experiment(str(name), image_path, snapshot_path))
+    return experiments
+
+
+def estimate_memory(experiment: Experiment):
+    """
+    :param experiment: Experiment tuple
+    :return: estimated bytes needed to trace the experiment, from the frame count and the size of the first frame
+    """
+    frames = util.frame_names(experiment.image_path)
+    if not frames:
+        return 0
+    with Pillow.open(os.path.join(experiment.image_path, frames[0])) as first:
+        width, height = first.size
+    return int(len(frames) * width * height * MEMORY_OVERHEAD)
+
+
+def lease_owner():
+    return socket.gethostname() + ":" + str(os.getpid())
+
+
+def acquire_lease(lease_dir: str, name: str, ttl: float):
+    """
+    Atomically claim an experiment. A lease that has not been renewed for ttl seconds is considered abandoned and may be
+    taken over.
+
+    :return: True if the lease is now held by this process
+    """
+    os.makedirs(lease_dir, exist_ok=True)
+    path = os.path.join(lease_dir, name + LEASE_SUFFIX)
+    if os.path.exists(os.path.join(lease_dir, name + DONE_SUFFIX)):
+        return False
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(path) < ttl:
+                return False
+            # only one machine can win the rename of an abandoned lease
+            stale = path + "." + lease_owner().replace(":", "_") + ".stale"
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.path.getmtime(stale) < ttl:
+            # somebody else took the lease over between our checks, give it back unless a new lease was created meanwhile,
+            # which a rename would overwrite
+            try:
+                os.link(stale, path)
+            except OSError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        print("Taking over abandoned lease for experiment " + name)
+        return acquire_lease(lease_dir, name, ttl)
+    with os.fdopen(fd, "w") as f:
+        f.write(lease_owner())
+    return True
+
+
+def renew_lease(lease_dir: str, name: str):
+    try:
+        os.utime(os.path.join(lease_dir, name + LEASE_SUFFIX))
+    except FileNotFoundError:
+        print("Lease for experiment " + name + " disappeared.")
+
+
+def release_lease(lease_dir: str, name: str, done: bool = False):
+    if done:
+        with open(os.path.join(lease_dir, name + DONE_SUFFIX), "w") as f:
+            f.write(lease_owner())
+    try:
+        os.remove(os.path.join(lease_dir, name + LEASE_SUFFIX))
+    except FileNotFoundError:
+        pass
+
+
+def quantify_experiment(experiment: Experiment, length: int = None, threshold_multiplier: float = 1.5,
+                        bound_radius: int = 30, stabilize: bool = None, tracker: str = "full", tracker_options: dict = None):
+    """
+    Trace one experiment in the current process: restore the box from its snapshot, track all seeds, write the tip videos
+    and tip coordinates the same way validate_save_tracking does, and snapshot the results. stabilize overrides whether the
+    frames are read through the stored stabilization transforms, None keeps the snapshot's setting. tracker and
+    tracker_options select the tracking mode, see Box.track_tips.
+
+    :return: dict summarizing the run
+    """
+    # imported here so the parent process does not load the models' dependencies
+    from src.myutilities.box import Box
+
+    start = time.time()
+    box = Box.load_snapshot(experiment.snapshot_path, path=experiment.image_path, save_path=c.QUANTIFICATION_OUT_PATH,
+                            stabilize=stabilize)
+    box.tip_trace_pcv(length=length, threshold_multiplier=threshold_multiplier, bound_radius=bound_radius,
+                      tracker=tracker, **(tracker_options or {}))
+    saved = box.save_tracking()
+    box.save_snapshot()
+    return {"experiment": experiment.name, "seeds": len(box.seeds), "saved": saved, "seconds": time.time() - start}
+
+
+def compare_tracking(experiment: Experiment, length: int = None, threshold_multiplier: float = 1.5, bound_radius: int = 30,
+                     stabilize: bool = None, tracker: str = "pyramid", tracker_options: dict = None,
+                     reference: str = "full", reference_options: dict = None, reference_bound_radius: int = None):
+    """
+    Trace one experiment with two tracking modes and measure how far the tips of the tracker are from those of the reference
+    and how much faster it is. Nothing is saved. Frames are loaded before timing so both modes only pay for tracing.
+    The reference uses reference_bound_radius, default bound_radius.
+
+    :return: dict with the times of both modes, the speedup, the mean, 95th percentile and max tip distance in pixels over
+        the frames both modes traced, the frames the reference traced that the tracker lost, and for the predictive
+        tracker the mean and 95th percentile distance of the tips from their predictions and the window growths
+    """
+    from src.myutilities.box import Box
+
+    box = Box.load_snapshot(experiment.snapshot_path, path=experiment.image_path, stabilize=stabilize)
+    # read the frames now so neither mode is timed loading them
+    box.images
+    if reference_bound_radius is None:
+        reference_bound_radius = bound_radius
+    runs = {}
+    for name, mode, options, radius in (("reference", reference, reference_options, reference_bound_radius),
+                                        ("tracker", tracker, tracker_options, bound_radius)):
+        start = time.time()
+        tracked = box.track_tips(length=length, threshold_multiplier=threshold_multiplier, bound_radius=radius,
+                                 tracker=mode, **(options or {}))
+        runs[name] = (time.time() - start, {count: np.asarray(t.tip_coords, dtype=float).reshape(-1, 2) for count, _, t in tracked})
+    residuals = np.concatenate([np.zeros(0)] + [np.asarray(t.residuals, dtype=float) for _, _, t in tracked])
+    residuals = residuals[~np.isnan(residuals)]
+    growths = int(sum(sum(t.growths) for _, _, t in tracked))
+
+    (reference_seconds, reference_tips), (seconds, tips) = runs["reference"], runs["tracker"]
+    distances = []
+    lost = 0
+    for count, expected in reference_tips.items():
+        found = tips.get(count, np.empty((0, 2)))
+        n = min(len(expected), len(found))
+        distances.append(np.linalg.norm(expected[:n] - found[:n], axis=1))
+        lost += len(expected) - n
+    distances = np.concatenate(distances) if distances else np.empty(0)
+    return {"experiment": experiment.name, "reference": reference, "tracker": tracker, "tracker_options": tracker_options or {},
+            "reference_seconds": reference_seconds, "seconds": seconds,
+            "speedup": reference_seconds / seconds if seconds > 0 else None,
+            "frames_compared": int(len(distances)), "frames_lost": int(lost),
+            "mean_error": float(distances.mean()) if len(distances) else None,
+            "p95_error": float(np.percentile(distances, 95)) if len(distances) else None,
+            "max_error": float(distances.max()) if len(distances) else None,
+            "mean_residual": float(residuals.mean()) if len(residuals) else None,
+            "p95_residual": float(np.percentile(residuals, 95)) if len(residuals) else None,
+            "window_growths": growths}
+
+
+def run(experiments: list, max_workers: int = None, memory_budget: int = None, lease_ttl: float = 6 * 60 * 60,
+        lease_dir: str = None, **kwargs):
+    """
+    Trace experiments in parallel worker processes.
+
+    Parameters
+    ----------
+    experiments : list
+        Experiment tuples, e.g. from find_experiments
+    max_workers : int
+        number of worker processes. Default is the number of CPUs
+    memory_budget : int
+        bytes the running experiments may use together. An experiment larger than the budget still runs, alone.
+        Default is no limit
+    lease_ttl : float
+        seconds after which a lease that is not renewed is considered abandoned. Leases are renewed while held
+    lease_dir : str
+        shared directory for lease and done files. Defaults to leases/ in QUANTIFICATION_OUT_PATH
+    **kwargs
+        passed to quantify_experiment
+
+    Returns
+    -------
+    list
+        summaries of the experiments traced by this machine
+    """
+    if lease_dir is None:
+        lease_dir = os.path.join(c.QUANTIFICATION_OUT_PATH, "leases")
+    for d in ("tip_coordinates", "stabilized_videos_single_seed"):
+        os.makedirs(os.path.join(c.QUANTIFICATION_OUT_PATH, d), exist_ok=True)
+
+    pending = sorted(((estimate_memory(e), e) for e in experiments), key=lambda x: x[0], reverse=True)
+    held = set()
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(lease_ttl / 3):
+            with lock:
+                for name in held:
+                    renew_lease(lease_dir, name)
+
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+
+    workers = max_workers or os.cpu_count() or 1
+    results = []
+    running = {}
+    memory_in_use = 0
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                # largest experiments first, skipping those that do not fit until nothing else is running
+                for item in list(pending):
+                    if len(running) >= workers:
+                        break
+                    memory, experiment = item
+                    if memory_budget is not None and running and memory_in_use + memory > memory_budget:
+                        continue
+                    pending.remove(item)
+                    if not acquire_lease(lease_dir, experiment.name, lease_ttl):
+                        print("Experiment " + experiment.name + " is done or leased by another machine, skipping.")
+                        continue
+                    with lock:
+                        held.add(experiment.name)
+                    print("Starting experiment " + experiment.name + " (~" + str(memory // 2**20) + " MB)")
+                    future = executor.submit(quantify_experiment, experiment, **kwargs)
+                    running[future] = (memory, experiment)
+                    memory_in_use += memory
+                if not running:
+                    continue
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    memory, experiment = running.pop(future)
+                    memory_in_use -= memory
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print("Experiment " + experiment.name + " failed: " + repr(e))
+                        release_lease(lease_dir, experiment.name)
+                    else:
+                        print("Experiment " + experiment.name + " finished in " + str(round(result["seconds"])) + " s")
+                        results.append(result)
+                        release_lease(lease_dir, experiment.name, done=True)
+                    with lock:
+                        held.discard(experiment.name)
+    finally:
+        stop.set()
+        with lock:
+            for name in held:
+                release_lease(lease_dir, name)
+        # workers only write the meta of their experiments, collect them into the index once
+        if os.path.isdir(c.RESULTS_PATH):
+            results_store.build_index()
+    return results
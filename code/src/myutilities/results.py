@@ -0,0 +1,342 @@
+"""
+Module storing traced tip coordinates as typed columns, one row per tracked frame
+
+Every experiment has a folder in RESULTS_PATH with one raw little-endian binary file per column (see COLUMNS for the
+types, readable from R with readBin) and a meta.json with its row count, seeds and frame and time ranges. Rows are only
+ever appended; saving a seed again rewrites that experiment without the seed's old rows first. index.json in RESULTS_PATH
+collects the meta of every experiment, so queries across experiments only open the experiments that can match. It is
+rebuilt when loaded if any meta.json changed since, so saving a seed only writes its own experiment.
+
+The per-seed csv files of tip_coordinates/ are still written by Box.save_tip_coordinates, and export_seed_csv rebuilds
+one from the store.
+
+"""
+
+import os
+import csv
+import json
+import time
+from collections import OrderedDict
+import numpy as np
+
+import src.myutilities.constants as c
+from src.myutilities import util
+
+COLUMNS = OrderedDict([
+    ("seed", "<i4"),        # 1-based position of the seed in the box, as in the csv file names
+    ("frame", "<i4"),       # index of the frame within the experiment
+    ("timestamp", "<f8"),   # unix time the frame was taken, NaN if the frame name does not carry it
+    ("x", "<i4"),
+    ("y", "<i4"),
+    ("curling", "u1"),      # 1 from the row the root starts curling on
+    ("interpolated", "u1"), # 1 if the tip was interpolated between traced frames instead of found in its frame
+    ("residual", "<f4"),    # distance in pixels of the tip from where the tracker predicted it, NaN if not predicted
+    ("growths", "u1"),      # times the tracker doubled its search window before the tip was found
+])
+# value of columns added since rows were stored, for those rows. Other columns read as 0
+MISSING = {"residual": np.nan}
+META_FILE = "meta.json"
+INDEX_FILE = "index.json"
+# value the csv export writes on the last row before curling, as validate_save_tracking always did
+CURLING_MARKER = 100000
+
+
+def experiment_path(experiment: str, results_path: str = None):
+    return os.path.join(results_path or c.RESULTS_PATH, str(experiment))
+
+
+def frame_timestamps(frame_names: list):
+    """
+    :param frame_names: frame file names, NNNNNNNN_<unix time>.png as written by the sorting program
+    :return: float array of the times the frames were taken, NaN where the name has none (e.g. frames unspooled from video)
+    """
+    timestamps = np.full(len(frame_names), np.nan)
+    for i, name in enumerate(frame_names):
+        parts = os.path.splitext(name)[0].split("_", 1)
+        if len(parts) == 2:
+            try:
+                timestamps[i] = float(parts[1])
+            except ValueError:
+                pass
+    return timestamps
+
+
+def seed_rows(seed, count: int, frame_names: list = None, positions: np.ndarray = None, curled: bool = None):
+    """
+    Rows of a traced seed. The first tip coordinate is the germination point and every later one was found in the next
+    frame starting at the germination frame, so the first two rows share a frame.
+
+    Parameters
+    ----------
+    seed : Seed
+        traced seed
+    count : int
+        1-based position of the seed in the box
+    frame_names : list
+        frame file names of the experiment, for the timestamps
+    positions : np.ndarray
+        index within the experiment of every frame the seed was traced on, for seeds of a box loaded with a time window,
+        whose frame indices count from the start of the window
+    curled : bool
+        mark the rows from the curling frame on as curling. Defaults to whether the seed has a curling frame.
+
+    Returns
+    -------
+    dict
+        column name to array
+    """
+    coords = np.asarray(seed.tip_coords_pcv, dtype=np.int64).reshape(-1, 2)
+    n = len(coords)
+    start = seed._tracking_start_frame
+    frames = start + np.maximum(np.arange(n) - 1, 0)
+    curling = np.zeros(n, dtype=bool)
+    if curled is None:
+        curled = seed.curling_start_frame is not None
+    if curled and seed.curling_start_frame is not None:
+        curling = frames >= seed.curling_start_frame
+    if positions is not None:
+        frames = np.asarray(positions, dtype=np.int64)[frames]
+    if frame_names is not None:
+        timestamps = frame_timestamps(frame_names)
+        valid = frames < len(timestamps)
+        timestamp = np.full(n, np.nan)
+        timestamp[valid] = timestamps[frames[valid]]
+    else:
+        timestamp = np.full(n, np.nan)
+    interpolated = np.zeros(n, dtype=bool)
+    if len(getattr(seed, "tip_interpolated", [])) == n:
+        interpolated = np.asarray(seed.tip_interpolated, dtype=bool)
+    residual = np.full(n, np.nan)
+    growths = np.zeros(n, dtype=np.int64)
+    if len(getattr(seed, "tip_residuals", [])) == n and len(getattr(seed, "tip_growths", [])) == n:
+        residual = np.asarray(seed.tip_residuals, dtype=np.float64)
+        growths = np.minimum(seed.tip_growths, np.iinfo(COLUMNS["growths"]).max)
+    return {"seed": np.full(n, count), "frame": frames, "timestamp": timestamp,
+            "x": coords[:, 0], "y": coords[:, 1], "curling": curling, "interpolated": interpolated,
+            "residual": residual, "growths": growths}
+
+
+def stored_rows(path: str):
+    seed_path = os.path.join(path, "seed.bin")
+    return os.path.getsize(seed_path) // np.dtype(COLUMNS["seed"]).itemsize if os.path.exists(seed_path) else 0
+
+
+def read_columns(path: str, columns: list = None):
+    """ all rows of the columns (default all) stored in an experiment folder. Columns added since the rows were stored are 0, or MISSING """
+    result = {}
+    for name in columns or COLUMNS:
+        column_path = os.path.join(path, name + ".bin")
+        result[name] = np.fromfile(column_path, dtype=COLUMNS[name]) if os.path.exists(column_path) \
+            else np.full(stored_rows(path), MISSING.get(name, 0), COLUMNS[name])
+    return result
+
+
+def append_rows(path: str, rows: dict):
+    os.makedirs(path, exist_ok=True)
+    lengths = {len(rows[name]) for name in COLUMNS}
+    if len(lengths) != 1:
+        raise ValueError("columns have different lengths: " + str(lengths))
+    n = stored_rows(path)
+    for name, dtype in COLUMNS.items():
+        column_path = os.path.join(path, name + ".bin")
+        if n and not os.path.exists(column_path):
+            # column added since the experiment was first stored
+            np.full(n, MISSING.get(name, 0), dtype=dtype).tofile(column_path)
+        with open(column_path, "ab") as f:
+            np.asarray(rows[name]).astype(dtype).tofile(f)
+
+
+def rewrite_columns(path: str, keep: np.ndarray):
+    """ rewrite every column of an experiment with only the rows where keep is True """
+    columns = read_columns(path)
+    for name in COLUMNS:
+        tmp_path = os.path.join(path, name + ".bin.part")
+        columns[name][keep].tofile(tmp_path)
+        os.replace(tmp_path, os.path.join(path, name + ".bin"))
+
+
+def load_meta(path: str):
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_meta(path: str, experiment: str):
+    """ summarize the stored rows of an experiment in its meta.json """
+    columns = read_columns(path, ["seed", "frame", "timestamp"])
+    timestamps = columns["timestamp"][~np.isnan(columns["timestamp"])]
+    meta = {"experiment": str(experiment),
+            "rows": int(len(columns["seed"])),
+            "seeds": sorted(int(s) for s in np.unique(columns["seed"])),
+            "frames": [int(columns["frame"].min()), int(columns["frame"].max())] if len(columns["frame"]) else None,
+            "timestamps": [float(timestamps.min()), float(timestamps.max())] if len(timestamps) else None,
+            "updated": time.time()}
+    tmp_path = os.path.join(path, META_FILE + ".part")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=4)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+    return meta
+
+
+def write_seed(experiment: str, seed, count: int, frame_names: list = None, results_path: str = None, positions: np.ndarray = None,
+               curled: bool = None):
+    """
+    Store the tip coordinates of a seed, replacing any rows saved for it before. frame_names, positions and curled are
+    passed to seed_rows. The index picks the change up the next time it is loaded.
+
+    :return: number of rows written
+    """
+    path = experiment_path(experiment, results_path)
+    meta = load_meta(path)
+    if meta is not None and count in meta["seeds"]:
+        rewrite_columns(path, read_columns(path, ["seed"])["seed"] != count)
+    rows = seed_rows(seed, count, frame_names, positions, curled)
+    append_rows(path, rows)
+    write_meta(path, experiment)
+    return len(rows["seed"])
+
+
+def meta_stats(results_path: str):
+    """ [modification time in ns, size] of the meta.json of every experiment, to tell whether it changed """
+    stats = {}
+    for experiment in util.listdir_nohidden(results_path):
+        try:
+            st = os.stat(os.path.join(results_path, experiment, META_FILE))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        stats[experiment] = [st.st_mtime_ns, st.st_size]
+    return stats
+
+
+def build_index(results_path: str = None):
+    """ collect the meta.json of every experiment into index.json, with the meta_stats of the file it was read from """
+    results_path = results_path or c.RESULTS_PATH
+    index = {}
+    # stat before reading, so a meta.json written in between looks changed the next time the index is loaded
+    for experiment, stat in meta_stats(results_path).items():
+        meta = load_meta(os.path.join(results_path, experiment))
+        if meta is not None:
+            index[experiment] = dict(meta, meta_stat=stat)
+    tmp_path = os.path.join(results_path, INDEX_FILE + "." + str(os.getpid()) + ".part")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, os.path.join(results_path, INDEX_FILE))
+    return index
+
+
+def load_index(results_path: str = None, refresh: bool = False):
+    """ index.json, rebuilt first if refresh is set or an experiment's meta.json was added, removed or changed since """
+    results_path = results_path or c.RESULTS_PATH
+    if not os.path.isdir(results_path):
+        return {}
+    if not refresh:
+        try:
+            with open(os.path.join(results_path, INDEX_FILE)) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = None
+        if index is not None and {e: meta.get("meta_stat") for e, meta in index.items()} == meta_stats(results_path):
+            return index
+    return build_index(results_path)
+
+
+def query(experiments: list = None, seeds: list = None, frames: tuple = None, timestamps: tuple = None,
+          include_curling: bool = True, results_path: str = None, refresh: bool = False):
+    """
+    Rows across experiments matching all given filters.
+
+    Parameters
+    ----------
+    experiments : list
+        experiment numbers. Default is all
+    seeds : list
+        seed positions
+    frames : tuple
+        (first, last) frame index, inclusive
+    timestamps : tuple
+        (start, end) unix times, inclusive. Rows without a timestamp never match
+    include_curling : bool
+        keep rows from the curling frame on
+    refresh : bool
+        rebuild the index from the experiments' meta files first
+
+    Returns
+    -------
+    dict
+        column name to array, with an additional experiment column
+    """
+    results_path = results_path or c.RESULTS_PATH
+    index = load_index(results_path, refresh)
+    names = sorted(index) if experiments is None else [str(e) for e in experiments if str(e) in index]
+
+    def overlaps(span, bounds):
+        return bounds is None or (span is not None and span[0] <= bounds[1] and span[1] >= bounds[0])
+
+    parts = []
+    for name in names:
+        meta = index[name]
+        if seeds is not None and not set(seeds) & set(meta["seeds"]):
+            continue
+        if not overlaps(meta["frames"], frames) or not overlaps(meta["timestamps"], timestamps):
+            continue
+        columns = read_columns(os.path.join(results_path, name))
+        keep = np.ones(len(columns["seed"]), dtype=bool)
+        if seeds is not None:
+            keep &= np.isin(columns["seed"], seeds)
+        if frames is not None:
+            keep &= (columns["frame"] >= frames[0]) & (columns["frame"] <= frames[1])
+        if timestamps is not None:
+            keep &= (columns["timestamp"] >= timestamps[0]) & (columns["timestamp"] <= timestamps[1])
+        if not include_curling:
+            keep &= columns["curling"] == 0
+        part = {k: v[keep] for k, v in columns.items()}
+        part["experiment"] = np.full(int(keep.sum()), name)
+        parts.append(part)
+
+    if not parts:
+        result = {name: np.empty(0, dtype) for name, dtype in COLUMNS.items()}
+        result["experiment"] = np.empty(0, dtype=str)
+        return result
+    return {k: np.concatenate([p[k] for p in parts]) for k in ["experiment"] + list(COLUMNS)}
+
+
+def export_csv(csv_path: str, **kwargs):
+    """
+    Write the rows matching query(**kwargs) as one long csv with a header row.
+
+    :return: number of rows written
+    """
+    rows = query(**kwargs)
+    os.makedirs(os.path.dirname(os.path.abspath(csv_path)), exist_ok=True)
+    with open(csv_path, "w", newline="") as f:
+        wr = csv.writer(f)
+        wr.writerow(["experiment"] + list(COLUMNS))
+        for i in range(len(rows["experiment"])):
+            wr.writerow([rows["experiment"][i]] + [rows[name][i] for name in COLUMNS])
+    return len(rows["experiment"])
+
+
+def export_seed_csv(experiment: str, count: int, csv_path: str = None, results_path: str = None):
+    """
+    Rebuild the tip_coordinates/<experiment>_<count>.csv of a seed from the store: one quoted row of "[x y]" pairs. If
+    the root curled, the row keeps (curling frame - germination frame) pairs, the last one set to CURLING_MARKER, as
+    save_tip_coordinates writes it.
+
+    :return: path of the written csv
+    """
+    rows = query([experiment], seeds=[count], results_path=results_path)
+    coords = np.stack([rows["x"], rows["y"]], axis=1).astype(np.int64)
+    curling = rows["curling"].astype(bool)
+    if curling.any():
+        coords = coords[:rows["frame"][curling][0] - rows["frame"][0]]
+    if curling.any() and len(coords):
+        coords[-1, 0] = CURLING_MARKER
+        coords[-1, 1] = CURLING_MARKER
+    if csv_path is None:
+        csv_path = os.path.join(c.QUANTIFICATION_OUT_PATH, "tip_coordinates", f"{experiment}_{count}.csv")
+    with open(csv_path, "w") as f:
+        wr = csv.writer(f, quoting=csv.QUOTE_ALL)
+        wr.writerow(coords)
+    return csv_path
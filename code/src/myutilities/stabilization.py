@@ -0,0 +1,227 @@
+"""
+Module for stabilizing experiments in python instead of with a re-encoded ffmpeg vidstab video
+
+The global motion between consecutive frames is estimated with OpenCV phase correlation on frames decoded at reduced
+resolution, in parallel chunks. The camera path is smoothed with a moving average and the difference between the smoothed
+and the measured path is stored as one 2x3 affine transform per frame, in a hidden .stabilization.npz inside the
+experiment folder. FrameSequence applies the transforms while frames are read, so stabilized analysis works on the
+original pngs.
+
+    python -m src.myutilities.stabilization <experiment folder> [<experiment folder> ...]
+
+"""
+
+import os
+import argparse
+import collections.abc
+import concurrent.futures
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+from src.myutilities import util
+
+TRANSFORMS_FILE = ".stabilization.npz"
+TRANSFORMS_VERSION = 1
+# frames are decoded at 1/DOWNSCALE resolution for estimation. Sub-pixel peaks get unreliable beyond 2
+DOWNSCALE = 2
+REDUCED_GRAYSCALE_FLAGS = {1: cv2.IMREAD_GRAYSCALE,
+                           2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                           4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                           8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+CHUNK_SIZE = 64
+# frames on either side averaged into the smoothed camera path, like vidstabtransform's smoothing
+SMOOTHING_RADIUS = 10
+# phase correlation peaks below this are treated as no motion, e.g. when the lights were off
+MIN_RESPONSE = 0.05
+
+
+def transforms_path(exp_path: str):
+    return os.path.join(exp_path, TRANSFORMS_FILE)
+
+
+def estimate_shift(previous: np.ndarray, current: np.ndarray, window: np.ndarray = None):
+    """
+    :return: (dx, dy, response) translation of current relative to previous, in the pixels of the given frames
+    """
+    (dx, dy), response = cv2.phaseCorrelate(previous, current, window)
+    if response < MIN_RESPONSE:
+        return 0.0, 0.0, response
+    return dx, dy, response
+
+
+def _chunk_shifts(paths: list, downscale: int):
+    """ shifts between every pair of consecutive frames in paths """
+    flags = REDUCED_GRAYSCALE_FLAGS[downscale]
+    previous = np.float32(cv2.imread(paths[0], flags))
+    window = cv2.createHanningWindow(previous.shape[::-1], cv2.CV_32F)
+    shifts = []
+    for path in paths[1:]:
+        current = np.float32(cv2.imread(path, flags))
+        shifts.append(estimate_shift(previous, current, window))
+        previous = current
+    return shifts
+
+
+def smooth(path: np.ndarray, radius: int):
+    """ moving average of an (n, 2) camera path, with the ends padded by repetition. Radius 0 holds the first frame still """
+    if radius <= 0:
+        return np.repeat(path[:1], len(path), axis=0)
+    padded = np.pad(path, ((radius, radius), (0, 0)), mode="edge")
+    kernel = np.ones(2 * radius + 1) / (2 * radius + 1)
+    return np.stack([np.convolve(padded[:, i], kernel, mode="valid") for i in range(path.shape[1])], axis=1)
+
+
+def compute_transforms(exp_path: str, downscale: int = DOWNSCALE, chunk_size: int = CHUNK_SIZE,
+                       smoothing_radius: int = SMOOTHING_RADIUS, max_workers: int = None, save: bool = True):
+    """
+    Estimate the stabilizing transform of every frame of an experiment.
+
+    Parameters
+    ----------
+    exp_path : str
+        experiment folder of pngs
+    downscale : int
+        1, 2, 4 or 8. Frames are decoded at this fraction of their resolution for estimation
+    chunk_size : int
+        consecutive frames estimated by one worker. Chunks overlap by one frame
+    smoothing_radius : int
+        frames on either side averaged into the smoothed camera path. 0 holds the first frame still
+    max_workers : int
+        worker threads, default is the executor's
+    save : bool
+        write the transforms to the experiment's TRANSFORMS_FILE
+
+    Returns
+    -------
+    dict
+        frames (names), transforms ((n, 2, 3) float32 affine per frame, in full resolution pixels), shifts ((n - 1, 2)
+        measured shift between consecutive frames) and responses (phase correlation peak of every shift)
+    """
+    frames = util.frame_names(exp_path)
+    paths = [os.path.join(exp_path, f) for f in frames]
+    pairs = []
+    if len(paths) > 1:
+        chunks = [paths[i:i + chunk_size + 1] for i in range(0, len(paths) - 1, chunk_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk in executor.map(_chunk_shifts, chunks, [downscale] * len(chunks)):
+                pairs.extend(chunk)
+
+    shifts = np.array([p[:2] for p in pairs], dtype=np.float64).reshape(-1, 2) * downscale
+    responses = np.array([p[2] for p in pairs], dtype=np.float32)
+    camera_path = np.vstack([np.zeros((1, 2)), np.cumsum(shifts, axis=0)])
+    correction = smooth(camera_path, smoothing_radius) - camera_path
+
+    transforms = np.zeros((len(frames), 2, 3), dtype=np.float32)
+    transforms[:, 0, 0] = 1
+    transforms[:, 1, 1] = 1
+    transforms[:, :, 2] = correction
+    result = {"frames": np.array(frames), "transforms": transforms, "shifts": shifts.astype(np.float32),
+              "responses": responses}
+    if save:
+        tmp_path = transforms_path(exp_path) + ".part.npz"
+        np.savez_compressed(tmp_path, version=TRANSFORMS_VERSION, downscale=downscale,
+                            smoothing_radius=smoothing_radius, **result)
+        os.replace(tmp_path, transforms_path(exp_path))
+    return result
+
+
+def load_transforms(exp_path: str):
+    """
+    :return: (frame names, transforms) stored for the experiment, or None if there are none or the frames changed since
+    """
+    try:
+        with np.load(transforms_path(exp_path)) as data:
+            frames = data["frames"].tolist()
+            transforms = data["transforms"]
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+    if frames != util.frame_names(exp_path):
+        return None
+    return frames, transforms
+
+
+def get_transforms(exp_path: str, **kwargs):
+    """ stored transforms of the experiment, computed first if missing or stale. kwargs go to compute_transforms """
+    stored = load_transforms(exp_path)
+    if stored is None:
+        print("Estimating stabilization transforms for " + exp_path)
+        result = compute_transforms(exp_path, **kwargs)
+        stored = result["frames"].tolist(), result["transforms"]
+    return stored
+
+
+def warp(image: np.ndarray, transform: np.ndarray):
+    if not transform[:, 2].any():
+        return image
+    return cv2.warpAffine(image, transform, (image.shape[1], image.shape[0]), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+class FrameSequence(collections.abc.Sequence):
+    """
+    Frames of an experiment, read and stabilized when indexed. Behaves like the list of grayscale frames Box keeps, and
+    keeps the cache_size most recently read frames in memory.
+    """
+
+    def __init__(self, exp_path: str, transforms: np.ndarray = None, cache_size: int = 64, read_flags: int = cv2.IMREAD_GRAYSCALE,
+                 frames: list = None):
+        """
+        :param transforms: (n, 2, 3) transform per frame. Default is the stored transforms, computed if needed
+        :param frames: names of the frames to read, e.g. a time window. Default is every frame
+        """
+        selected = frames
+        if transforms is None:
+            frames, transforms = get_transforms(exp_path)
+        else:
+            frames = util.frame_names(exp_path)
+        if len(frames) != len(transforms):
+            raise ValueError(str(len(frames)) + " frames but " + str(len(transforms)) + " transforms in " + exp_path)
+        if selected is not None:
+            position = {name: i for i, name in enumerate(frames)}
+            transforms = transforms[[position[name] for name in selected]]
+            frames = selected
+        self.paths = [os.path.join(exp_path, f) for f in frames]
+        self.transforms = transforms
+        self.cache_size = cache_size
+        self.read_flags = read_flags
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("frame index out of range")
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+        image = self.read(index)
+        if self.cache_size:
+            self._cache[index] = image
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return image
+
+    def read(self, index: int):
+        """read and stabilize a frame without going through the cache, safe to call from several threads"""
+        return warp(cv2.imread(self.paths[index], self.read_flags), self.transforms[index])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="estimate and store stabilization transforms of experiments")
+    parser.add_argument("experiments", nargs="+", help="experiment folders of pngs")
+    parser.add_argument("--downscale", type=int, default=DOWNSCALE, choices=sorted(REDUCED_GRAYSCALE_FLAGS))
+    parser.add_argument("--smoothing_radius", type=int, default=SMOOTHING_RADIUS)
+    parser.add_argument("-w", "--workers", type=int, default=None)
+    args = parser.parse_args()
+    for experiment in args.experiments:
+        result = compute_transforms(experiment, downscale=args.downscale, smoothing_radius=args.smoothing_radius,
+                                    max_workers=args.workers)
+        correction = np.abs(result["transforms"][:, :, 2])
+        print(experiment + ": " + str(len(result["frames"])) + " frames, largest correction " +
+              str(np.round(correction.max(initial=0), 1)) + " px")
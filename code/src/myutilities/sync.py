@@ -0,0 +1,280 @@
+"""
+Module for incremental, content-hashed synchronization of files between directories
+
+A local manifest records the size, mtime and hash of every file at the time it was last synced to a
+destination. Files whose size and mtime are unchanged are skipped without being read, files whose
+content hash is unchanged are skipped without being copied, and everything else is copied in parallel.
+
+"""
+
+import os
+import json
+import fnmatch
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import concurrent.futures
+from abc import ABC, abstractmethod
+from typing import NamedTuple, List
+
+import src.myutilities.constants as c
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class SyncReport(NamedTuple):
+    copied: List[str]
+    skipped: List[str]
+    failed: List[str]
+    bytes_copied: int
+    bytes_saved: int
+
+
+class Destination(ABC):
+    """Location files are synced to. Subclasses only need to know how to check for and place a single file."""
+
+    @property
+    @abstractmethod
+    def id(self):
+        """string uniquely identifying the destination, used to key the manifest"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def exists(self, name: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, source_file: str, name: str):
+        raise NotImplementedError
+
+
+class LocalDestination(Destination):
+    """A directory on a local (or mounted) filesystem. Files are copied to a temporary name and renamed into place."""
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+
+    @property
+    def id(self):
+        return "local:" + self.path
+
+    def exists(self, name: str):
+        return os.path.isfile(os.path.join(self.path, name))
+
+    def put(self, source_file: str, name: str):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix="." + name + ".", suffix=".part", dir=self.path)
+        os.close(fd)
+        try:
+            shutil.copy2(source_file, tmp_path)
+            os.replace(tmp_path, os.path.join(self.path, name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class SudoDestination(LocalDestination):
+    """
+    A local directory this user may not write to, e.g. the home of another user. Files are copied to a temporary name and
+    renamed into place with sudo, which must be allowed without a password, since copies run in parallel.
+    """
+
+    SUDO = ["sudo", "-n"]
+
+    def put(self, source_file: str, name: str):
+        subprocess.run(self.SUDO + ["mkdir", "-p", self.path], check=True)
+        tmp_path = os.path.join(self.path, "." + name + ".part")
+        try:
+            subprocess.run(self.SUDO + ["cp", "--preserve=timestamps", source_file, tmp_path], check=True)
+            subprocess.run(self.SUDO + ["mv", "-f", tmp_path, os.path.join(self.path, name)], check=True)
+        except BaseException:
+            subprocess.run(self.SUDO + ["rm", "-f", tmp_path])
+            raise
+
+
+class GsutilDestination(Destination):
+    """
+    A cloud storage bucket prefix (gs://...). Object uploads are atomic, so no rename step is needed. The prefix is
+    listed once and existence is checked against that listing, instead of one request per file.
+    """
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self._listing = None
+        self._lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.url
+
+    def listing(self):
+        """names of the objects directly under the prefix, listed on first use"""
+        with self._lock:
+            if self._listing is None:
+                result = subprocess.run(["gsutil", "ls", self.url + "/"], stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, universal_newlines=True)
+                # ls fails with "matched no objects" for an empty or missing prefix
+                if result.returncode != 0 and "matched no objects" not in result.stderr:
+                    raise RuntimeError("Unable to list " + self.url + ": " + result.stderr.strip())
+                self._listing = {line[len(self.url) + 1:] for line in result.stdout.splitlines()
+                                 if line.startswith(self.url + "/")}
+            return self._listing
+
+    def exists(self, name: str):
+        return name in self.listing()
+
+    def put(self, source_file: str, name: str):
+        subprocess.run(["gsutil", "-q", "cp", source_file, self.url + "/" + name], check=True)
+        with self._lock:
+            if self._listing is not None:
+                self._listing.add(name)
+
+
+def destination(path: str):
+    """
+    Destination for a path: a bucket for gs:// urls, otherwise a local directory, written through sudo if this user may
+    not write to it.
+
+    Raises
+    ------
+    PermissionError
+        if the directory is not writable and sudo needs a password
+    """
+    if path.startswith("gs://"):
+        return GsutilDestination(path)
+    existing = os.path.abspath(path)
+    while not os.path.exists(existing):
+        existing = os.path.dirname(existing)
+    if os.access(existing, os.W_OK):
+        return LocalDestination(path)
+    if subprocess.run(SudoDestination.SUDO + ["true"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+        return SudoDestination(path)
+    raise PermissionError(existing + " is not writable and sudo needs a password. Run 'sudo -v' first or allow passwordless sudo.")
+
+
+def file_hash(path: str):
+    """
+    :param path: file path
+    :return: hex digest of the file contents
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def manifest_path(source_dir: str, destination: Destination, manifest_dir: str = None):
+    """Local manifest file for a source directory / destination pair"""
+    if manifest_dir is None:
+        manifest_dir = c.SYNC_MANIFEST_PATH
+    key = hashlib.blake2b((os.path.abspath(source_dir) + "\0" + destination.id).encode(), digest_size=8).hexdigest()
+    return os.path.join(manifest_dir, key + ".json")
+
+
+def load_manifest(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest: dict, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".part"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, sort_keys=True, indent=1)
+    os.replace(tmp_path, path)
+
+
+def sync(source_dir: str, destination: Destination, pattern: str = "*", names: list = None,
+         max_workers: int = None, manifest_dir: str = None, verbose: bool = True):
+    """
+    Copy new and changed files from source_dir to destination.
+
+    Parameters
+    ----------
+    source_dir : str
+        directory containing the files to sync. Hidden files are ignored.
+    destination : Destination
+        where files are copied to, e.g. LocalDestination(path)
+    pattern : str
+        glob pattern file names must match. Default is all files.
+    names : list
+        optional explicit list of file names to sync. Names missing from source_dir are reported as failed.
+    max_workers : int
+        size of the thread pool hashing, checking and copying files. Default is the ThreadPoolExecutor default.
+    manifest_dir : str
+        directory of the local manifests. Default is SYNC_MANIFEST_PATH in constants.py
+    verbose : bool
+        print a summary of the sync
+
+    Returns
+    -------
+    SyncReport
+    """
+    m_path = manifest_path(source_dir, destination, manifest_dir)
+    manifest = load_manifest(m_path)
+
+    if names is None:
+        names = [f for f in sorted(os.listdir(source_dir)) if not f.startswith('.') and fnmatch.fnmatch(f, pattern)]
+
+    def sync_file(name):
+        # runs in the pool, so hashing and remote existence checks overlap with the copies
+        path = os.path.join(source_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return "failed", None
+        if not os.path.isfile(path):
+            return "ignored", None
+        entry = manifest.get(name)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns \
+                and destination.exists(name):
+            return "skipped", entry
+        new_entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "hash": file_hash(path)}
+        if entry is not None and entry["size"] == st.st_size and entry["hash"] == new_entry["hash"] \
+                and destination.exists(name):
+            return "skipped", new_entry
+        destination.put(path, name)
+        return "copied", new_entry
+
+    copied = []
+    skipped = []
+    failed = []
+    bytes_copied = 0
+    bytes_saved = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(sync_file, name): name for name in names}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    status, entry = future.result()
+                except Exception as e:
+                    print("Unable to sync " + name + ": " + str(e))
+                    failed.append(name)
+                    continue
+                if status == "failed":
+                    failed.append(name)
+                elif status == "skipped":
+                    manifest[name] = entry
+                    skipped.append(name)
+                    bytes_saved += entry["size"]
+                elif status == "copied":
+                    manifest[name] = entry
+                    copied.append(name)
+                    bytes_copied += entry["size"]
+    finally:
+        save_manifest(manifest, m_path)
+
+    report = SyncReport(sorted(copied), sorted(skipped), sorted(failed), bytes_copied, bytes_saved)
+    if verbose:
+        print("Synced " + source_dir + " -> " + destination.id + ": " + str(len(report.copied)) + " copied (" +
+              str(report.bytes_copied) + " bytes), " + str(len(report.skipped)) + " unchanged (" +
+              str(report.bytes_saved) + " bytes saved), " + str(len(report.failed)) + " failed")
+    return report
@@ -0,0 +1,145 @@
+"""
+Module with the per-experiment timeline, the index from frame sequence numbers to capture times and file names
+
+The capture time of a frame is only in its name, NNNNNNNN_<unix time>.png as written by the sorting program. The
+timeline keeps sequence number, time and name of every frame as fixed size records in a hidden .timeline.bin inside the
+experiment folder. label() appends the frames it adds, so the directory is only listed and parsed again when the frames
+no longer match the records. Time windows are found with a binary search over the capture times.
+
+"""
+
+import os
+import datetime
+import numpy as np
+
+from src.myutilities import results
+from src.myutilities import util
+
+TIMELINE_FILE = ".timeline.bin"
+RECORD = np.dtype([("sequence", "<i8"), ("timestamp", "<f8"), ("name", "S64")])
+
+
+def timeline_path(exp_path: str):
+    return os.path.join(exp_path, TIMELINE_FILE)
+
+
+def to_unix_time(value):
+    """ unix time of a datetime, or the value itself if it already is a number or None """
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
+
+
+def records(names: list):
+    """ timeline records of frame names. Sequence is -1 and time NaN where the name does not carry them """
+    rows = np.zeros(len(names), dtype=RECORD)
+    rows["sequence"] = [int(name[:8]) if name[:8].isdigit() else -1 for name in names]
+    rows["timestamp"] = results.frame_timestamps(names)
+    rows["name"] = [name.encode() for name in names]
+    return rows
+
+
+def read(exp_path: str):
+    """ stored records of the experiment. A record cut off by an interrupted append is dropped """
+    path = timeline_path(exp_path)
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return np.zeros(0, dtype=RECORD)
+    if size % RECORD.itemsize:
+        with open(path, "r+b") as f:
+            f.truncate(size - size % RECORD.itemsize)
+    return np.fromfile(path, dtype=RECORD)
+
+
+def append(exp_path: str, names: list):
+    """ add frames that were added to the end of the experiment, in order. Builds the timeline if there is none yet """
+    if not os.path.exists(timeline_path(exp_path)):
+        build(exp_path)
+        return
+    with open(timeline_path(exp_path), "ab") as f:
+        records(names).tofile(f)
+
+
+def build(exp_path: str):
+    """ write the timeline of the experiment from its directory listing """
+    rows = records(util.frame_names(exp_path))
+    tmp_path = timeline_path(exp_path) + ".part"
+    rows.tofile(tmp_path)
+    os.replace(tmp_path, timeline_path(exp_path))
+    return rows
+
+
+def update(exp_path: str):
+    """
+    Records of every frame of the experiment. Frames added after the stored ones are appended, and the timeline is built
+    again if the stored frames are not the first frames of the experiment anymore.
+    """
+    rows = read(exp_path)
+    frames = util.frame_names(exp_path)
+    stored = [name.decode() for name in rows["name"]]
+    if frames[:len(stored)] != stored:
+        print("Timeline of " + exp_path + " does not match its frames, building it again.")
+        return build(exp_path)
+    if len(frames) > len(stored):
+        append(exp_path, frames[len(stored):])
+        rows = np.concatenate([rows, records(frames[len(stored):])])
+    return rows
+
+
+class Timeline:
+    """ Capture times of the frames of an experiment, in frame order, with O(log n) time window lookups """
+
+    def __init__(self, rows: np.ndarray):
+        self.rows = rows
+        self.timestamps = rows["timestamp"]
+        # frames are normally in time order already, otherwise the search runs over a sorted copy
+        timed = np.flatnonzero(~np.isnan(self.timestamps))
+        times = self.timestamps[timed]
+        if len(times) > 1 and (np.diff(times) < 0).any():
+            order = np.argsort(times, kind="stable")
+            timed, times = timed[order], times[order]
+        self._positions = timed
+        self._times = times
+
+    @classmethod
+    def load(cls, exp_path: str, verify: bool = True):
+        """ timeline of an experiment. Without verify the stored records are trusted and the directory is not listed """
+        if not verify and os.path.exists(timeline_path(exp_path)):
+            return cls(read(exp_path))
+        return cls(update(exp_path))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def names(self):
+        return [name.decode() for name in self.rows["name"]]
+
+    def window(self, start=None, end=None):
+        """
+        Positions in frame order of the frames taken in [start, end). start and end are unix times or datetimes, None leaves
+        that side open. Frames without a capture time are never in a window.
+        """
+        start, end = to_unix_time(start), to_unix_time(end)
+        first = 0 if start is None else np.searchsorted(self._times, start, side="left")
+        last = len(self._times) if end is None else np.searchsorted(self._times, end, side="left")
+        return np.sort(self._positions[first:max(first, last)])
+
+    def frame_at(self, time):
+        """ position of the last frame taken at or before time, or None if there is none """
+        i = np.searchsorted(self._times, to_unix_time(time), side="right")
+        return int(self._positions[i - 1]) if i > 0 else None
+
+    def durations(self, positions=None):
+        """
+        Seconds from each frame until the next one of positions (default all frames). The last frame, and frames without a
+        capture time, get the median interval.
+        """
+        times = self.timestamps if positions is None else self.timestamps[positions]
+        gaps = np.diff(times)
+        valid = gaps[np.isfinite(gaps) & (gaps > 0)]
+        typical = float(np.median(valid)) if len(valid) else 1.0
+        durations = np.append(gaps, typical)
+        durations[~(np.isfinite(durations) & (durations > 0))] = typical
+        return durations
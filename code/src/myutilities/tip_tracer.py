@@ -0,0 +1,359 @@
+"""
+Module with the image processing used to find germination and trace root tips
+
+"""
+
+import numpy as np
+import cv2
+from plantcv import plantcv as pcv
+
+from src.myutilities import frame_stats
+
+
+def roi_stack(images, x1: int, x2: int, y1: int, y2: int):
+    """
+    :param images: sequence of grayscale frames
+    :return: (frames, height, width) array holding the same y1:y2, x1:x2 crop of every frame
+    """
+    x1 = max(x1, 0)
+    y1 = max(y1, 0)
+    height, width = np.shape(images[0][y1:y2, x1:x2])
+    stack = np.empty((len(images), height, width), dtype=images[0].dtype)
+    for i, image in enumerate(images):
+        stack[i] = image[y1:y2, x1:x2]
+    return stack
+
+
+def germination_scores(stack: np.ndarray, threshold_multiplier: float = 1.5, baseline_frames: int = 5, change_delta: int = 25):
+    """
+    Per-frame scores of how much a seed ROI has changed since the start of the experiment, computed in one pass over the stack.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        (frames, height, width) ROI stack from roi_stack
+    threshold_multiplier : float
+        pixels brighter than the frame median times this value count as bright (root or seed)
+    baseline_frames : int
+        number of leading frames treated as ungerminated
+    change_delta : int
+        grey levels a pixel must differ from the baseline by to count as changed
+
+    Returns
+    -------
+    change : np.ndarray
+        fraction of the ROI that differs from the mean baseline frame by more than change_delta
+    area : np.ndarray
+        fraction of the ROI that is bright in the frame but was not bright in the baseline
+    bright : np.ndarray
+        (frames, height, width) boolean bright masks
+    baseline_bright : np.ndarray
+        (height, width) boolean mask of pixels that were bright in the baseline (the seed itself)
+    """
+    frames = len(stack)
+    baseline_frames = max(1, min(baseline_frames, frames))
+    thresholds = frame_stats.medians(np.array([frame_stats.histogram(frame) for frame in stack])) * threshold_multiplier
+    bright = stack > thresholds[:, None, None]
+    baseline_bright = bright[:baseline_frames].mean(axis=0) > 0.5
+    area = (bright & ~baseline_bright).mean(axis=(1, 2))
+    baseline = stack[:baseline_frames].mean(axis=0, dtype=np.float32)
+    change = (np.abs(stack - baseline) > change_delta).mean(axis=(1, 2))
+    return change, area, bright, baseline_bright
+
+
+def germination_detection_init(seed, images, threshold_multiplier: float = 1.5, baseline_frames: int = 5,
+                               n_sigma: float = 4, min_pixels: int = 20, persistence: int = 3):
+    """
+    Automatic germination detection. The first frame whose change and new bright area scores both rise above the baseline
+    noise, and stay there for `persistence` frames, is the germination frame. The germination point is the new bright pixel
+    farthest from the seed, i.e. the tip of the emerging radicle.
+
+    Parameters
+    ----------
+    seed : Seed
+        seed whose x1:x2, y1:y2 region is searched
+    images : list
+        all frames of the box
+    threshold_multiplier : float
+        see germination_scores
+    baseline_frames : int
+        see germination_scores
+    n_sigma : float
+        how many standard deviations of baseline noise a score must exceed
+    min_pixels : int
+        minimum number of new bright and changed pixels, regardless of noise
+    persistence : int
+        number of consecutive frames the scores must stay high
+
+    Returns
+    -------
+    tuple
+        (germination frame, germination x, germination y, confidence between 0 and 1). Frame and point are None if nothing
+        was found. Coordinates are in full frame pixels.
+    """
+    stack = roi_stack(images, seed.x1, seed.x2, seed.y1, seed.y2)
+    change, area, bright, baseline_bright = germination_scores(stack, threshold_multiplier, baseline_frames)
+    baseline_frames = max(1, min(baseline_frames, len(stack)))
+
+    min_fraction = min_pixels / stack[0].size
+    area_threshold = area[:baseline_frames].mean() + n_sigma * area[:baseline_frames].std() + min_fraction
+    change_threshold = change[:baseline_frames].mean() + n_sigma * change[:baseline_frames].std() + min_fraction
+    candidate = (area > area_threshold) & (change > change_threshold)
+    candidate[:baseline_frames] = False
+
+    persistence = max(1, min(persistence, len(stack)))
+    sustained = np.convolve(candidate.astype(int), np.ones(persistence, dtype=int), mode="valid") == persistence
+    if not sustained.any():
+        return None, None, None, 0.0
+    frame = int(np.argmax(sustained))
+
+    # the root should stay visible from germination on, so the fraction of later frames that agree is the confidence
+    confidence = float(candidate[frame:].mean())
+
+    new_bright = np.argwhere(bright[frame] & ~baseline_bright)
+    seed_pixels = np.argwhere(baseline_bright)
+    if len(seed_pixels):
+        center = seed_pixels.mean(axis=0)
+    else:
+        center = np.array(np.shape(baseline_bright)) / 2
+    y, x = new_bright[np.argmax(np.linalg.norm(new_bright - center, axis=1))]
+    return frame, int(x) + max(seed.x1, 0), int(y) + max(seed.y1, 0), confidence
+
+
+def find_tips(image: np.ndarray, threshold_multiplier: float = 1.5, threshold: float = None, blur_ksize: int = 5, fill_size: int = 10):
+    """
+    :param image: grayscale crop around a root
+    :param threshold_multiplier: pixels brighter than the crop median times this value are root
+    :param threshold: grey level used instead of the crop median times threshold_multiplier
+    :param blur_ksize: median blur of the binary image, removes noise thinner than about half of it
+    :param fill_size: objects smaller than this many pixels are removed
+    :return: (n, 2) array of (y, x) skeleton endpoints within the crop
+    """
+    if threshold is None:
+        threshold = frame_stats.median(image)*threshold_multiplier #try mean?
+    threshold_light = pcv.threshold.binary(gray_img=image, threshold=threshold, max_value=255, object_type='light')
+    binary_img = pcv.median_blur(gray_img=threshold_light, ksize=blur_ksize)
+    fill_image = pcv.fill(bin_img=binary_img, size=fill_size)
+    skeleton = pcv.morphology.skeletonize(mask=fill_image)
+    tips_img = pcv.morphology.find_tips(skel_img=skeleton, mask=fill_image)
+    return np.argwhere(tips_img > 0)
+
+
+class TipTracker:
+    """
+    Tracks a single root tip one frame at a time, starting from the germination point.
+
+    The tracker does not own any frames. Whoever drives it calls update() with every frame index for which wants() is true,
+    in increasing order, which lets Box advance all of its seeds in a single pass over the frames.
+    """
+
+    def __init__(self, germination_x: int, germination_y: int, start_frame: int, length: int,
+                 threshold_multiplier: float = 1.5, bound_radius: int = 30):
+        self.start_frame = start_frame
+        self.end_frame = start_frame + length
+        self.threshold_multiplier = threshold_multiplier
+        self.bound_radius = bound_radius
+        self.x1 = germination_x - bound_radius
+        self.x2 = germination_x + bound_radius
+        self.y1 = germination_y - bound_radius
+        self.y2 = germination_y + bound_radius
+        self.tip_coords = [[germination_x, germination_y]]
+        # True for tip coordinates that were interpolated instead of found in their frame
+        self.interpolated = [False]
+        # per tip coordinate, the distance in pixels of the tip from where it was predicted, NaN if it was not predicted,
+        # and how often the search window was doubled before the tip was found
+        self.residuals = [np.nan]
+        self.growths = [0]
+        self.done = length <= 0
+        self._last_x = bound_radius
+        self._last_y = bound_radius
+
+    def wants(self, frame_index: int):
+        return not self.done and self.start_frame <= frame_index < self.end_frame
+
+    def update(self, frame_index: int, image: np.ndarray):
+        """Find the tip in the next frame and re-center the search window on it. Tracking stops at the first failure."""
+        try:
+            x, y = self.locate(image)
+        except Exception as e:
+            print(e)
+            self.done = True
+            return
+        self.advance(frame_index, x, y)
+
+    def locate(self, image: np.ndarray):
+        """(x, y) of the tip in the current search window of image. Raises if no tip is found"""
+        locs = find_tips(image[self.y1:self.y2, self.x1:self.x2], self.threshold_multiplier)
+
+        #Here we take the index of the identified end-points and use np.linalg.norm to find the identified endpoint closest to the last identified tip.
+        #This solves a problem when roots grow somewhat horizontally and the old way of just choosing the bottom-most endpoint would fail because sometimes the
+        #root starts to grow transiently upward as it circumnutates, which puts the actual tip above the endpoint found where the shootward section of the root is.
+        y, x = locs[np.argmin(np.linalg.norm(np.array([self._last_y, self._last_x]) - locs, axis=1))]
+        return x, y
+
+    def advance(self, frame_index: int, x: int, y: int, residual: float = np.nan, growths: int = 0):
+        """Record the tip found at (x, y) of the search window and re-center the window on it"""
+        r = self.bound_radius
+        self.x2 = self.x1 + x + r
+        self.x1 = self.x1 + x - r
+        self.y2 = self.y1 + y + r
+        self.y1 = self.y1 + y - r
+        self.tip_coords.append([int((self.x2 + self.x1)/2), int((self.y2 + self.y1)/2)])
+        self.interpolated.append(False)
+        self.residuals.append(residual)
+        self.growths.append(growths)
+        self._last_x = x
+        self._last_y = y
+        if frame_index + 1 >= self.end_frame:
+            self.done = True
+
+
+class PyramidTipTracker(TipTracker):
+    """
+    Tracks like TipTracker, coarse to fine. The tip is first found in the search window downsampled by pyramid_factor, then
+    refined at full resolution in a window of refine_radius around that estimate. Both steps threshold at the median of the
+    full search window, as TipTracker does. Frames where either step finds no tip are traced at full resolution instead,
+    and counted in fallbacks. Windows that would be smaller than MIN_COARSE_SIZE pixels downsampled are always traced at
+    full resolution, a root there is only a pixel or two wide.
+    """
+
+    MIN_COARSE_SIZE = 16
+
+    def __init__(self, germination_x: int, germination_y: int, start_frame: int, length: int,
+                 threshold_multiplier: float = 1.5, bound_radius: int = 30, pyramid_factor: int = 2, refine_radius: int = None):
+        super().__init__(germination_x, germination_y, start_frame, length, threshold_multiplier, bound_radius)
+        self.pyramid_factor = pyramid_factor
+        self.refine_radius = max(4, bound_radius // pyramid_factor) if refine_radius is None else refine_radius
+        self.fallbacks = 0
+
+    def locate(self, image: np.ndarray):
+        window = image[self.y1:self.y2, self.x1:self.x2]
+        if min(window.shape[:2]) < self.MIN_COARSE_SIZE * self.pyramid_factor:
+            return super().locate(image)
+        try:
+            return self._locate_coarse_to_fine(window)
+        except Exception:
+            self.fallbacks += 1
+            return super().locate(image)
+
+    def _locate_coarse_to_fine(self, window: np.ndarray):
+        f = self.pyramid_factor
+        threshold = frame_stats.median(window) * self.threshold_multiplier
+        # the blur and fill sizes shrink with the image so thin roots survive
+        small = cv2.resize(window, None, fx=1 / f, fy=1 / f, interpolation=cv2.INTER_AREA)
+        locs = find_tips(small, threshold=threshold, blur_ksize=max(1, 5 // f) | 1, fill_size=max(1, 10 // f ** 2))
+        y, x = locs[np.argmin(np.linalg.norm(np.array([self._last_y, self._last_x]) / f - locs, axis=1))]
+        estimate_x, estimate_y = int(x * f + f // 2), int(y * f + f // 2)
+
+        r = self.refine_radius
+        x0, y0 = max(estimate_x - r, 0), max(estimate_y - r, 0)
+        locs = find_tips(window[y0:estimate_y + r, x0:estimate_x + r], threshold=threshold)
+        y, x = locs[np.argmin(np.linalg.norm(np.array([estimate_y - y0, estimate_x - x0]) - locs, axis=1))]
+        return x0 + x, y0 + y
+
+
+class AdaptiveTipTracker(TipTracker):
+    """
+    Tracks like TipTracker, but only in every step-th frame while the root grows slowly. After every traced frame the step
+    doubles, up to max_step, if the tip moved at most slow_speed pixels per frame since the last traced frame, and drops
+    back to every frame otherwise. A tip not found after skipping frames is looked for again in the next frame, traced
+    every frame from then on, and only a failure without skipping stops tracking.
+
+    Tips of skipped frames are interpolated linearly between the traced frames around them and flagged in interpolated, so
+    tip_coords still has one coordinate per frame. The last frame is always traced.
+    """
+
+    def __init__(self, germination_x: int, germination_y: int, start_frame: int, length: int,
+                 threshold_multiplier: float = 1.5, bound_radius: int = 30, max_step: int = 4, slow_speed: float = 1.0):
+        super().__init__(germination_x, germination_y, start_frame, length, threshold_multiplier, bound_radius)
+        self.max_step = max_step
+        self.slow_speed = slow_speed
+        self.step = 1
+        self.retries = 0
+        self._traced_frame = start_frame - 1
+        self._next_frame = start_frame
+
+    def wants(self, frame_index: int):
+        return super().wants(frame_index) and frame_index >= self._next_frame
+
+    def update(self, frame_index: int, image: np.ndarray):
+        try:
+            x, y = self.locate(image)
+        except Exception as e:
+            if self.step == 1:
+                print(e)
+                self.done = True
+                return
+            # the tip may have left the window while frames were skipped, look again in the next frame
+            self.retries += 1
+            self.step = 1
+            self._next_frame = frame_index + 1
+            self.done = self._next_frame >= self.end_frame
+            return
+
+        gap = frame_index - self._traced_frame
+        last = np.array(self.tip_coords[-1])
+        self.advance(frame_index, x, y)
+        tip = np.array(self.tip_coords[-1])
+        if gap > 1:
+            fractions = np.arange(1, gap)[:, None] / gap
+            filled = np.rint(last + (tip - last) * fractions).astype(int).tolist()
+            self.tip_coords[-1:-1] = filled
+            self.interpolated[-1:-1] = [True] * len(filled)
+            self.residuals[-1:-1] = [np.nan] * len(filled)
+            self.growths[-1:-1] = [0] * len(filled)
+
+        if np.linalg.norm(tip - last) <= self.slow_speed * gap:
+            self.step = min(self.step * 2, self.max_step)
+        else:
+            self.step = 1
+        self._traced_frame = frame_index
+        self._next_frame = min(frame_index + self.step, self.end_frame - 1)
+
+
+class PredictiveTipTracker(TipTracker):
+    """
+    Tracks like TipTracker, but centers the search window on where the tip is expected instead of where it was. The tip is
+    predicted to keep its velocity, which is smoothed over the frames by velocity_gain, so a fast root stays in a window of
+    a few times its growth per frame and bound_radius can be smaller than TipTracker needs. When no tip is found the
+    window is doubled, up to max_radius (default 4 * bound_radius), before tracking stops.
+
+    residuals holds the distance in pixels of every tip from its prediction, and growths the window doublings it took.
+    """
+
+    def __init__(self, germination_x: int, germination_y: int, start_frame: int, length: int,
+                 threshold_multiplier: float = 1.5, bound_radius: int = 30, velocity_gain: float = 0.5, max_radius: int = None):
+        super().__init__(germination_x, germination_y, start_frame, length, threshold_multiplier, bound_radius)
+        self.velocity_gain = velocity_gain
+        self.max_radius = 4 * bound_radius if max_radius is None else max_radius
+        self.velocity = np.zeros(2)
+
+    def update(self, frame_index: int, image: np.ndarray):
+        last = np.array(self.tip_coords[-1], dtype=float)
+        predicted_x, predicted_y = np.rint(last + self.velocity).astype(int)
+        r = self.bound_radius
+        growths = 0
+        while True:
+            self.x1, self.x2 = max(predicted_x - r, 0), predicted_x + r
+            self.y1, self.y2 = max(predicted_y - r, 0), predicted_y + r
+            # the endpoint closest to the prediction is taken
+            self._last_x, self._last_y = predicted_x - self.x1, predicted_y - self.y1
+            try:
+                x, y = self.locate(image)
+                break
+            except Exception as e:
+                if r >= self.max_radius:
+                    print(e)
+                    self.done = True
+                    return
+                r = min(2 * r, self.max_radius)
+                growths += 1
+
+        tip = np.array([self.x1 + x, self.y1 + y], dtype=float)
+        residual = float(np.linalg.norm(tip - (predicted_x, predicted_y)))
+        self.velocity += self.velocity_gain * (tip - last - self.velocity)
+        self.advance(frame_index, x, y, residual, growths)
+
+
+# tracking modes of Box.tip_trace_pcv and Seed.start_tracking
+TRACKERS = {"full": TipTracker, "pyramid": PyramidTipTracker, "adaptive": AdaptiveTipTracker, "predictive": PredictiveTipTracker}
@@ -1,4 +1,5 @@
 import src.myutilities.constants as c
+import src.myutilities.sync as sync
 import subprocess
 import shutil
 import time
@@ -18,29 +19,35 @@ def listdir_nohidden(path):
     return [f for f in sorted(os.listdir(path)) if not f.startswith('.')]
 
 
+def frame_names(exp_path):
+    """
+    :param exp_path: experiment directory
+    :return: file names of the png frames of the experiment, in frame order. Frame indices of the box, the stabilization
+        transforms, the frame statistics and the timeline all count over this list, so other files in the folder do not
+        shift them
+    """
+    return [f for f in listdir_nohidden(exp_path) if f.endswith(".png")]
+
+
 def sync_for_rstudio():
-    """Wrapper for rsync. Syncs csv files of tip coordinates to Rstudio user folder (because Rstudio Server requires a dedicated non-super user).
-    The source and destination directories are set in the constants.py file variables QUANTIFICATION_OUT_PATH and RSTUDIO_OUT_PATH, respectively.
+    """Syncs csv files of tip coordinates to Rstudio user folder (because Rstudio Server requires a dedicated non-super user).
+    Only new or changed files are copied. The folder belongs to the Rstudio user, so unless it is writable the files are copied
+    with sudo, which must not ask for a password (run sudo -v first). The source and destination directories are set in the
+    constants.py file variables QUANTIFICATION_OUT_PATH and RSTUDIO_OUT_PATH, respectively.
     """
     
-    in_path = c.QUANTIFICATION_OUT_PATH + "tip_coordinates/"
-    out_path = c.RSTUDIO_OUT_PATH + "tip_coordinates/"
-    command = "sudo rsync -t " +  in_path + "*.csv " + out_path
-    subprocess.call(command,shell=True)
-    print(command)
+    in_path = os.path.join(c.QUANTIFICATION_OUT_PATH, "tip_coordinates")
+    out_path = os.path.join(c.RSTUDIO_OUT_PATH, "tip_coordinates")
+    return sync.sync(in_path, sync.destination(out_path), pattern="*.csv")
     
 
-#NEED TO TROUBLESHOOT THIS
 def sync_traced_tips():
-    """Wrapper for rsync. Syncs traced tip videos to bucket.
-    The source and destination directories are set in the constants.py file variables QUANTIFICATION_OUT_PATH and TRACED_TIPS_VIDS_PATH, respectively.
+    """Syncs traced tip videos to bucket. Only new or changed videos are copied, with gsutil if TRACED_TIPS_VIDS_BUCKET_PATH is a gs:// url.
+    The source and destination directories are set in the constants.py file variables QUANTIFICATION_OUT_PATH and TRACED_TIPS_VIDS_BUCKET_PATH, respectively.
     """
     
-    in_path = c.QUANTIFICATION_OUT_PATH + "stabilized_videos_single_seed/"
-    out_path = c.TRACED_TIPS_VIDS_BUCKET_PATH
-    command = "gsutil rsync " +  in_path + " " + out_path
-    subprocess.call(command,shell=True)
-    print(command)
+    in_path = os.path.join(c.QUANTIFICATION_OUT_PATH, "stabilized_videos_single_seed")
+    return sync.sync(in_path, sync.destination(c.TRACED_TIPS_VIDS_BUCKET_PATH))
     
 def archive(source : str):
     """Function to clear out pre_quantification_stabilized directory and move experiment folders to pre_quantificaiton archive. Need to build in a way to clear
@@ -153,9 +160,9 @@ def unspool_video(full_path : str, out_dir : str, remove : bool = False):
     if (remove):
         os.remove(full_path)
     
-def copy_videos(video_list : tuple, source = "unstabilized", dest = c.QUANTIFICATION_IN_PATH + "to_unspool//"):
+def copy_videos(video_list : tuple, source = "unstabilized", dest = os.path.join(c.QUANTIFICATION_IN_PATH, "to_unspool")):
     """
-    This function copies videos from the cloud bucket to a local directory.
+    This function copies videos from the cloud bucket to a local directory. Videos already copied and unchanged are skipped.
     
     Parameters
     ----------
@@ -166,17 +173,17 @@ def copy_videos(video_list : tuple, source = "unstabilized", dest = c.QUANTIFICA
     source  : str
         Location from where to copy videos (stabilized or unstabilized)
     """
-    for v in video_list:
+    if source == "stabilized":
+        in_path = c.STABILIZED_VIDEO_PATH
+    else:
+        in_path = c.VIDEO_BUCKET_PATH
+    report = sync.sync(in_path, sync.LocalDestination(dest), names=[str(v) + ".mp4" for v in video_list])
+    for name in report.failed:
         if source == "stabilized":
-            try:
-                shutil.copyfile(c.STABILIZED_VIDEO_PATH + str(v) + ".mp4", dest + str(v) + ".mp4") 
-            except:
-                print("Unable to copy video " + str(v) +". Perhaps you are trying to move a video from stabilized directory that wasn't stabilized?")
+            print("Unable to copy video " + name +". Perhaps you are trying to move a video from stabilized directory that wasn't stabilized?")
         else:
-            try:
-                shutil.copyfile(c.VIDEO_BUCKET_PATH + str(v) + ".mp4", dest + str(v) + ".mp4") 
-            except:
-                print("Unable to copy video " + str(v) +". Perhaps there was a type?")
+            print("Unable to copy video " + name +". Perhaps there was a typo?")
+    return report
                 
 def empty_trash():
     """
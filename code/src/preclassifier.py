@@ -0,0 +1,152 @@
+"""
+    Module with a cheap pre-classifier that recognizes empty box positions
+    (placeholders or missing boxes) before the QR retinanet is run on them.
+
+    A few downsampled frames of every position are reduced to two features:
+    the fraction of magenta box color and the density of edges. A position is
+    confidently empty when both are far below anything seen on an occupied
+    position of this robot before. The thresholds are calibrated from the
+    outcomes of the detector on earlier positions, so nothing is skipped
+    until enough positions have been seen. Once enough empty positions have
+    been seen too, a threshold is raised to halfway between the two classes
+    where they do not overlap, and the error rates of the thresholds on both
+    classes are reported.
+
+"""
+
+import os
+import json
+import random
+import numpy as np
+import cv2
+
+# OpenCV hue runs 0-180, magenta is around 150
+MAGENTA_LOWER = (135, 80, 50)
+MAGENTA_UPPER = (175, 255, 255)
+FRAMES_PER_POSITION = 3
+READ_FLAGS = cv2.IMREAD_REDUCED_COLOR_8
+# occupied positions the thresholds need before anything is skipped
+MIN_CALIBRATION_SAMPLES = 20
+# thresholds are this fraction of the 1st percentile of occupied positions
+CALIBRATION_MARGIN = 0.5
+# empty positions needed before they move the thresholds, their 99th percentile must stay below the occupied 1st
+MIN_EMPTY_SAMPLES = 10
+MAX_CALIBRATION_SAMPLES = 500
+# fraction of positions classified empty that are still run through the detector to check the calibration
+AUDIT_RATE = 0.1
+
+FEATURES = ("magenta_coverage", "edge_density")
+
+
+def frame_features(image):
+    """ features of a single BGR frame """
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    magenta = cv2.inRange(hsv, MAGENTA_LOWER, MAGENTA_UPPER)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    median = float(np.median(gray))
+    edges = cv2.Canny(gray, max(0, 0.66 * median), min(255, 1.33 * median))
+    return np.array([np.count_nonzero(magenta) / magenta.size, np.count_nonzero(edges) / edges.size])
+
+
+def position_features(image_paths, read_frame):
+    """
+        Features of a box position, averaged over FRAMES_PER_POSITION of its frames
+        decoded at reduced resolution with read_frame(path, flags).
+    """
+    sample = random.sample(image_paths, min(FRAMES_PER_POSITION, len(image_paths)))
+    features = [frame_features(read_frame(p, READ_FLAGS)) for p in sample]
+    return dict(zip(FEATURES, np.mean(features, axis=0).tolist()))
+
+
+class PreClassifier:
+    """ Thresholds calibrated from the labelled positions of a robot, kept in a json file """
+
+    def __init__(self, path, robot):
+        self.path = path
+        self.robot = robot
+        try:
+            with open(path) as f:
+                self._all = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._all = {}
+        self.samples = self._all.setdefault(robot, {"occupied": [], "empty": []})
+        self.thresholds = self.calibrate()
+        self.error_rates = self.calibration_error_rates()
+        self.decisions = {}
+
+    def calibrate(self):
+        """ thresholds below which a position is confidently empty, or None while there are too few samples """
+        occupied = self.samples["occupied"]
+        if len(occupied) < MIN_CALIBRATION_SAMPLES:
+            return None
+        empty = self.samples["empty"]
+        thresholds = {}
+        for f in FEATURES:
+            lowest_occupied = float(np.percentile([s[f] for s in occupied], 1))
+            thresholds[f] = lowest_occupied * CALIBRATION_MARGIN
+            if len(empty) >= MIN_EMPTY_SAMPLES:
+                highest_empty = float(np.percentile([s[f] for s in empty], 99))
+                if highest_empty < lowest_occupied:
+                    thresholds[f] = max(thresholds[f], (highest_empty + lowest_occupied) / 2)
+        return thresholds
+
+    def calibration_error_rates(self):
+        """
+            fraction of the occupied samples the thresholds call empty (positions that would
+            be skipped wrongly) and of the empty samples they do not (positions run needlessly)
+        """
+        if self.thresholds is None:
+            return None
+        occupied, empty = self.samples["occupied"], self.samples["empty"]
+        return {"occupied_called_empty": float(np.mean([self.is_empty(s) for s in occupied])),
+                "empty_not_called_empty": float(np.mean([not self.is_empty(s) for s in empty])) if empty else None}
+
+    def is_empty(self, features):
+        if self.thresholds is None:
+            return False
+        return all(features[f] < t for f, t in self.thresholds.items())
+
+    def record(self, position, features, skipped, occupied=None):
+        """
+            Keep the decision for the run report, and the detector outcome (if the
+            detector ran) as a calibration sample for later runs.
+        """
+        self.decisions[position] = {"features": features, "skipped": skipped, "occupied": occupied}
+        if occupied is not None:
+            samples = self.samples["occupied" if occupied else "empty"]
+            samples.append(features)
+            del samples[:-MAX_CALIBRATION_SAMPLES]
+
+    def save(self):
+        tmp_path = self.path + ".part"
+        with open(tmp_path, "w") as f:
+            json.dump(self._all, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def report(self, report_path=None):
+        """ print the thresholds and decisions of this run, and optionally write them to a json file """
+        classified_empty = [p for p, d in self.decisions.items() if self.is_empty(d["features"])]
+        skipped = [p for p, d in self.decisions.items() if d["skipped"]]
+        # audited positions the classifier called empty but the detector found a QR code on
+        missed = [p for p in classified_empty if self.decisions[p]["occupied"]]
+        report = {"robot": self.robot,
+                  "thresholds": self.thresholds,
+                  "calibration_error_rates": self.error_rates,
+                  "calibration_samples": {k: len(v) for k, v in self.samples.items()},
+                  "positions": len(self.decisions),
+                  "skipped": skipped,
+                  "audit_disagreements": missed,
+                  "decisions": self.decisions}
+        if self.thresholds is None:
+            print("Pre-classifier not calibrated yet (" + str(len(self.samples["occupied"])) + "/" +
+                  str(MIN_CALIBRATION_SAMPLES) + " occupied samples), no positions skipped.")
+        else:
+            print("Pre-classifier thresholds: " + str(self.thresholds) + ", error rates on the calibration samples: " +
+                  str(self.error_rates))
+            print("Pre-classifier skipped " + str(len(skipped)) + " of " + str(len(self.decisions)) +
+                  " positions, audit disagreements: " + str(missed))
+        if report_path is not None:
+            os.makedirs(os.path.dirname(report_path), exist_ok=True)
+            with open(report_path, "w") as f:
+                json.dump(report, f, indent=1)
+        return report
@@ -0,0 +1,110 @@
+"""
+    Module that decodes the QR code of a box once the QR retinanet has found it.
+
+    Only the detected crop (plus a margin) is decoded. The crop is rescaled so a QR
+    module is QR_TARGET_MODULE_SIZE pixels wide, then the preprocessing variants are
+    tried until zbar reads the code, in the order that has worked best on this robot
+    so far. OpenCV's QRCodeDetector is the last resort.
+
+"""
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+import cv2
+from pyzbar.pyzbar import decode, ZBarSymbol
+
+# fraction of the detected box added on every side of the crop, so the quiet zone is included
+QR_CROP_MARGIN = 0.15
+# modules across the codes printed on the boxes (version 1)
+QR_MODULES = 21
+QR_TARGET_MODULE_SIZE = 10
+QR_OPENCV_FALLBACK = True
+
+# preprocessing variants, given the rescaled crop and its blurred version. Listed in the order used before there are any statistics.
+QR_PREPROCESSING = OrderedDict([
+    ("blur", lambda crop, blur: blur),
+    ("adaptive_mean_69", lambda crop, blur: cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 69, 2)),
+    ("adaptive_gaussian_69", lambda crop, blur: cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 69, 2)),
+    ("otsu", lambda crop, blur: cv2.threshold(blur, 0, 255, cv2.THRESH_OTSU)[1]),
+    ("adaptive_mean_89", lambda crop, blur: cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 89, 2)),
+    ("adaptive_mean_31", lambda crop, blur: cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 31, 11)),
+    ("adaptive_gaussian_55", lambda crop, blur: cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 55, 11)),
+    ("raw", lambda crop, blur: crop),
+])
+
+
+class QrDecodeStats:
+    """ Per-robot counts of attempts and successes of every preprocessing variant, kept in a json file """
+
+    def __init__(self, path, robot):
+        self.path = path
+        self.robot = robot
+        try:
+            with open(path) as f:
+                self._all = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._all = {}
+        self.counts = self._all.setdefault(robot, {})
+
+    def record(self, variant, success):
+        attempts, successes = self.counts.get(variant, [0, 0])
+        self.counts[variant] = [attempts + 1, successes + int(success)]
+
+    def order(self):
+        """ variants by estimated success rate, ties keep the default order """
+        def rate(variant):
+            attempts, successes = self.counts.get(variant, [0, 0])
+            return (successes + 1) / (attempts + 2)
+        return sorted(QR_PREPROCESSING, key=rate, reverse=True)
+
+    def save(self):
+        tmp_path = self.path + ".part"
+        with open(tmp_path, "w") as f:
+            json.dump(self._all, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def qr_crop(gray, box, margin=QR_CROP_MARGIN):
+    """
+        Crop the detected box (x1, y1, x2, y2) with a margin out of a grayscale frame
+        and rescale it so a module is QR_TARGET_MODULE_SIZE pixels wide.
+    """
+    x1, y1, x2, y2 = [int(v) for v in box[:4]]
+    pad_x = int((x2 - x1) * margin)
+    pad_y = int((y2 - y1) * margin)
+    height, width = np.shape(gray)[:2]
+    crop = gray[max(y1 - pad_y, 0):min(y2 + pad_y, height), max(x1 - pad_x, 0):min(x2 + pad_x, width)]
+    if crop.size == 0:
+        return crop
+    scale = QR_MODULES * QR_TARGET_MODULE_SIZE / max(x2 - x1, y2 - y1, 1)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(crop, None, fx=scale, fy=scale, interpolation=interpolation)
+
+
+def decode_qr(gray, box, stats=None):
+    """
+        Decode the QR code inside the detected box of a grayscale frame.
+        Returns (decoded string, name of the variant that worked), or (None, None).
+    """
+    crop = qr_crop(gray, box)
+    if crop.size == 0:
+        return None, None
+    blur = cv2.GaussianBlur(crop, (3, 3), 0)
+
+    order = stats.order() if stats is not None else list(QR_PREPROCESSING)
+    for name in order:
+        barcode = decode(QR_PREPROCESSING[name](crop, blur), symbols=[ZBarSymbol.QRCODE])
+        if stats is not None:
+            stats.record(name, len(barcode) > 0)
+        if len(barcode) > 0:
+            return barcode[0].data.decode("utf-8", "replace"), name
+
+    if QR_OPENCV_FALLBACK:
+        data, _, _ = cv2.QRCodeDetector().detectAndDecode(crop)
+        if stats is not None:
+            stats.record("opencv", bool(data))
+        if data:
+            return data, "opencv"
+    return None, None
@@ -0,0 +1,216 @@
+"""
+Module to export the retinanet models to frozen, optimized inference graphs for CPU-only instances
+
+    python -m src.retnet.export export ../data/models/SeedInference.h5 [--quantize]
+    python -m src.retnet.export benchmark ../data/models/SeedInference.h5 image1.png image2.png [--quantize]
+
+Exporting freezes the variables of the inference h5 into constants, strips CheckNumerics nodes and folds constants and
+batch norms. Identity nodes are kept: the detection filtering of the model runs in a tf.map_fn loop, whose Identity nodes
+carry its control flow, and the output tensors may be Identity ops themselves. With --quantize the weights are stored as
+int8 after training. This is weight-only quantization: the weights are dequantized to float when the graph is loaded and
+every op still computes in float, so it shrinks the graph file about 4x but does not speed up inference. The graph is
+written next to the h5 with a json file naming its input and output tensors, and FrozenGraph loads it with a
+predict_on_batch method, so it can stand in for the keras model. benchmark compares its detections with the keras model's.
+
+"""
+
+import os
+import json
+import time
+import threading
+import argparse
+import numpy as np
+import cv2
+import tensorflow as tf
+import keras
+from keras_retinanet import models
+from keras_retinanet.utils.image import preprocess_image, resize_image
+from tensorflow.tools.graph_transforms import TransformGraph
+
+TRANSFORMS = ["remove_nodes(op=CheckNumerics)",
+              "fold_constants(ignore_errors=true)",
+              "fold_batch_norms",
+              "fold_old_batch_norms"]
+# int8 storage of the weights only, they are dequantized to float when the graph is loaded
+QUANTIZE_TRANSFORMS = ["quantize_weights"]
+
+
+def session_config(intra_op_threads: int = None, inter_op_threads: int = None):
+    """
+    :param intra_op_threads: threads used inside a single op, e.g. a convolution. None lets tensorflow decide
+    :param inter_op_threads: threads used to run independent ops in parallel. None lets tensorflow decide
+    :return: tf.ConfigProto
+    """
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    if intra_op_threads is not None:
+        config.intra_op_parallelism_threads = intra_op_threads
+    if inter_op_threads is not None:
+        config.inter_op_parallelism_threads = inter_op_threads
+    return config
+
+
+def get_session(intra_op_threads: int = None, inter_op_threads: int = None):
+    """ session for the keras backend, see session_config """
+    return tf.Session(config=session_config(intra_op_threads, inter_op_threads))
+
+
+def frozen_graph_path(model_path: str, quantized: bool = False):
+    """
+    :param model_path: path of the keras h5 model
+    :return: path of the exported graph for that model
+    """
+    return os.path.splitext(model_path)[0] + ("_int8" if quantized else "") + ".pb"
+
+
+def export_inference_graph(model_path: str, output_path: str = None, quantize: bool = False):
+    """
+    Freeze and optimize a retinanet inference model.
+
+    Parameters
+    ----------
+    model_path : str
+        keras inference h5, e.g. SeedInference.h5
+    output_path : str
+        graph file to write. Defaults to frozen_graph_path(model_path, quantize)
+    quantize : bool
+        store the weights as int8, see QUANTIZE_TRANSFORMS
+
+    Returns
+    -------
+    str
+        path of the written graph
+    """
+    if output_path is None:
+        output_path = frozen_graph_path(model_path, quantize)
+
+    keras.backend.clear_session()
+    keras.backend.set_learning_phase(0)
+    model = models.load_model(model_path, backbone_name="resnet50")
+    session = keras.backend.get_session()
+    input_names = [t.op.name for t in model.inputs]
+    output_names = [t.op.name for t in model.outputs]
+
+    # not tf.graph_util.remove_training_nodes, which drops Identity nodes as well
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+    transforms = TRANSFORMS + (QUANTIZE_TRANSFORMS if quantize else [])
+    graph_def = TransformGraph(graph_def, input_names, output_names, transforms)
+
+    with tf.gfile.GFile(output_path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    with open(os.path.splitext(output_path)[0] + ".json", "w") as f:
+        json.dump({"source": os.path.basename(model_path),
+                   "inputs": [t.name for t in model.inputs],
+                   "outputs": [t.name for t in model.outputs],
+                   "quantized": quantize}, f, indent=4)
+    keras.backend.clear_session()
+    print("Exported " + model_path + " to " + output_path)
+    return output_path
+
+
+class FrozenGraph:
+    """Exported inference graph with the predict_on_batch interface of the keras model"""
+
+    def __init__(self, graph_path: str, intra_op_threads: int = None, inter_op_threads: int = None):
+        with open(os.path.splitext(graph_path)[0] + ".json") as f:
+            meta = json.load(f)
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph, config=session_config(intra_op_threads, inter_op_threads))
+        self.inputs = [self.graph.get_tensor_by_name(n) for n in meta["inputs"]]
+        self.outputs = [self.graph.get_tensor_by_name(n) for n in meta["outputs"]]
+        self.quantized = meta["quantized"]
+
+    def predict_on_batch(self, batch: np.ndarray):
+        return self.session.run(self.outputs, feed_dict={self.inputs[0]: batch})
+
+
+class KerasModel:
+    """Keras model whose predict_on_batch can be called from any thread"""
+
+    def __init__(self, model, session=None):
+        self.model = model
+        # tensorflow's default graph is per thread, so remember the one the model was loaded into
+        self.graph = tf.get_default_graph()
+        self.session = keras.backend.get_session() if session is None else session
+        # keras builds the predict function lazily, and not thread-safely
+        self.model._make_predict_function()
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, batch: np.ndarray):
+        with self._lock, self.graph.as_default(), self.session.as_default():
+            return self.model.predict_on_batch(batch)
+
+
+def benchmark(model_path: str, image_paths: list, quantized: bool = False, runs: int = 5, intra_op_threads: int = None,
+              inter_op_threads: int = None, confidence_cutoff: float = 0.3):
+    """
+    Compare latency and detections of the keras model and its exported graph on the same images.
+
+    Returns
+    -------
+    dict
+        mean seconds per image of both backends, and the worst score difference and lowest box IoU between their
+        detections above confidence_cutoff
+    """
+    images = []
+    for path in image_paths:
+        image, _ = resize_image(preprocess_image(cv2.imread(path)))
+        images.append(np.expand_dims(image, axis=0))
+
+    keras.backend.tensorflow_backend.set_session(get_session(intra_op_threads, inter_op_threads))
+    keras_model = models.load_model(model_path, backbone_name="resnet50")
+    frozen_model = FrozenGraph(frozen_graph_path(model_path, quantized), intra_op_threads, inter_op_threads)
+
+    def time_model(model):
+        model.predict_on_batch(images[0])  # warm up
+        outputs = []
+        start = time.time()
+        for _ in range(runs):
+            outputs = [model.predict_on_batch(image) for image in images]
+        return (time.time() - start) / (runs * len(images)), outputs
+
+    keras_time, keras_outputs = time_model(keras_model)
+    frozen_time, frozen_outputs = time_model(frozen_model)
+
+    max_score_difference = 0.0
+    min_iou = 1.0
+    for (k_boxes, k_scores, _), (f_boxes, f_scores, _) in zip(keras_outputs, frozen_outputs):
+        keep = k_scores[0] >= confidence_cutoff
+        if not keep.any():
+            continue
+        max_score_difference = max(max_score_difference, float(np.abs(k_scores[0][keep] - f_scores[0][keep]).max()))
+        a, b = k_boxes[0][keep], f_boxes[0][keep]
+        w = np.maximum(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0)
+        h = np.maximum(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0)
+        intersection = w * h
+        union = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) + (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]) - intersection
+        min_iou = min(min_iou, float((intersection / np.maximum(union, 1e-9)).min()))
+
+    result = {"keras_seconds": keras_time, "frozen_seconds": frozen_time, "speedup": keras_time / frozen_time,
+              "max_score_difference": max_score_difference, "min_box_iou": min_iou}
+    print("keras: {keras_seconds:.3f} s/image, frozen: {frozen_seconds:.3f} s/image, speedup {speedup:.2f}x, "
+          "max score difference {max_score_difference:.4f}, min box IoU {min_box_iou:.4f}".format(**result))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export retinanet models to optimized inference graphs")
+    parser.add_argument("command", choices=["export", "benchmark"])
+    parser.add_argument("model_path", help="keras inference h5")
+    parser.add_argument("images", nargs="*", help="images to benchmark on")
+    parser.add_argument("-q", "--quantize", action="store_true", help="store the weights as int8, dequantized to float when loaded")
+    parser.add_argument("--intra_op_threads", type=int, default=None)
+    parser.add_argument("--inter_op_threads", type=int, default=None)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_inference_graph(args.model_path, quantize=args.quantize)
+    else:
+        benchmark(args.model_path, args.images, quantized=args.quantize, runs=args.runs,
+                  intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
@@ -1,10 +1,13 @@
 from keras_retinanet import models
+import keras
 import cv2
 from keras_retinanet.utils.image import preprocess_image, resize_image
 import time
 import numpy as np
 from src.myutilities.image import Image
+import src.myutilities.image as image_util
 import src.myutilities.io as io
+import src.retnet.export as export
 from abc import ABC, abstractmethod
 import os
 import skimage
@@ -12,10 +15,36 @@ from skimage import morphology
 
 class Model(ABC):
 
-    def __init__(self, model_path: str, confidence_cutoff=0.5):
+    def __init__(self, model_path: str, confidence_cutoff=0.5, backend: str = "keras", quantized: bool = False,
+                 intra_op_threads: int = None, inter_op_threads: int = None):
+        """
+        Parameters
+        ----------
+        model_path : str
+            path of the keras inference h5
+        backend : str
+            "keras" loads the h5. "frozen" loads the graph exported from it by retnet.export, which is faster on CPU.
+            "auto" uses the exported graph if there is one.
+        quantized : bool
+            use the export with int8 weights, which are dequantized to float when loaded
+        intra_op_threads, inter_op_threads : int
+            tensorflow thread pool sizes. None lets tensorflow decide
+        """
         self.model_path = model_path
-        print("Loading MODEL: {}".format(model_path))
-        self.model = models.load_model(model_path, backbone_name="resnet50")
+        frozen_path = export.frozen_graph_path(model_path, quantized)
+        if backend == "auto":
+            backend = "frozen" if os.path.isfile(frozen_path) else "keras"
+        if backend == "frozen":
+            print("Loading MODEL: {}".format(frozen_path))
+            self.model = export.FrozenGraph(frozen_path, intra_op_threads, inter_op_threads)
+        elif backend == "keras":
+            print("Loading MODEL: {}".format(model_path))
+            if intra_op_threads is not None or inter_op_threads is not None:
+                keras.backend.tensorflow_backend.set_session(export.get_session(intra_op_threads, inter_op_threads))
+            self.model = models.load_model(model_path, backbone_name="resnet50")
+        else:
+            raise ValueError("Unknown backend " + str(backend))
+        self.backend = backend
         self._confidence_cutoff = confidence_cutoff
         model_name = os.path.normpath(model_path)
         self.model_name = os.path.split(model_name)[1]
@@ -123,7 +152,32 @@ class QrModel(Model):
 
 class SeedModel(Model):
 
-    def detect(self, image_path: str=None, image_output_path=None, image_arr:np.ndarray=None, sort:bool=False):
+    def detect(self, image_path: str=None, image_output_path=None, image_arr:np.ndarray=None, sort:bool=False,
+               tile_size: int=None, tile_overlap: int=256, tile_scale: float=1.0, iou_threshold: float=0.5):
+        """
+        Detect seeds in an image.
+
+        By default the image is resized so its short side is about 800 pixels and run through the model once. With tile_size
+        set, the image is instead cut into overlapping tile_size x tile_size tiles that are run as one batch at tile_scale
+        times native resolution, and the detections of all tiles are merged with non-maximum suppression.
+
+        Parameters
+        ----------
+        tile_size : int
+            tile edge length in native pixels. None disables tiling.
+        tile_overlap : int
+            overlap between neighbouring tiles in native pixels. Should be larger than a seed.
+        tile_scale : float
+            scale tiles are resized by before detection, 1.0 is native resolution
+        iou_threshold : float
+            boxes from different tiles overlapping more than this are merged
+
+        Returns
+        -------
+        tuple
+            list of image.Roi regions of the seeds in frame coordinates, sorted by x1 if sort is set, and the list of their
+            scores in descending order
+        """
 
         if image_arr is not None:
             mi = Image(image_arr)
@@ -141,66 +195,150 @@ class SeedModel(Model):
                     int(height[0] * np.shape(mi.image)[0]),
                     int(height[1] * np.shape(mi.image)[0]))
 
-        # create copy to draw on
-        draw = mi.image.copy()
-
         # load label to names mapping for visualization purposes
         label_dictionary = {0: 'seed'}
 
-        image = preprocess_image(mi.crop)
-        image, scale = resize_image(image)
-
         start = time.time()
+        if tile_size is None:
+            image = preprocess_image(mi.crop)
+            image, scale = resize_image(image)
 
-        # expects image array with 4 dimensions, so we must add one more dimension.
-        boxes, scores, labels = self.model.predict_on_batch(np.expand_dims(image, axis=0))
-        print("SEED RETINANET processing time: ", time.time() - start)
-
-        # correct for image scale
-        # equivalent to boxes = boxes/scale
-        boxes /= scale
-
-        seed_images = []
-        scores_list = []
-
-        for box, score, label in zip(boxes[0], scores[0], labels[0]):
-            # score values are sorted
-            if score < self._confidence_cutoff:
-                break
+            # expects image array with 4 dimensions, so we must add one more dimension.
+            boxes, scores, labels = self.model.predict_on_batch(np.expand_dims(image, axis=0))
 
-            # round box coords to integers
-            b = box.astype(int)
-
-            coords = mi.get_transform_crop_coords(b[0], b[2], b[1], b[3])
-
-            mi1 = Image(mi.image)
-            mi1.set_crop(coords.x1, coords.x2, coords.y1, coords.y2)
-            
-            #keep list of all seeds as well as their associated score
-            seed_images.append(mi1)
-            scores_list.append(score)
+            # correct for image scale
+            # equivalent to boxes = boxes/scale
+            boxes /= scale
+            boxes, scores, labels = boxes[0], scores[0], labels[0]
+        else:
+            boxes, scores, labels = self._detect_tiled(mi.crop, tile_size, tile_overlap, tile_scale, iou_threshold)
+        print("SEED RETINANET processing time: ", time.time() - start)
 
+        # score values are sorted, keep the boxes above the cutoff and move them into frame coordinates all at once
+        keep = int(np.searchsorted(-np.asarray(scores), -self._confidence_cutoff, side="right"))
+        bounds = image_util.boxes_to_bounds(boxes[:keep], origin=mi)
+        scores_list = list(scores[:keep])
 
-            if image_output_path is not None:
+        if image_output_path is not None:
+            # create copy to draw on
+            draw = mi.image.copy()
+            for (x1, x2, y1, y2), score, label in zip(bounds, scores_list, labels[:keep]):
                 # Add boxes and captions
                 color = (255, 0, 0)
                 thickness = 2
-                cv2.rectangle(draw, (coords.x1, coords.y1), (coords.x2, coords.y2), color, thickness, cv2.LINE_AA)
+                cv2.rectangle(draw, (int(x1), int(y1)), (int(x2), int(y2)), color, thickness, cv2.LINE_AA)
                 caption = "{} {:.3f}".format(label_dictionary[label], score)
 
                 # black outline with red text
-                cv2.putText(draw, caption, (coords.x1, coords.y1 - 10), cv2.FONT_HERSHEY_COMPLEX, 1, (0, 0, 0), 2)
-                cv2.putText(draw, caption, (coords.x1, coords.y1 - 10), cv2.FONT_HERSHEY_COMPLEX, 1, (255, 0, 0), 1)
+                cv2.putText(draw, caption, (int(x1), int(y1) - 10), cv2.FONT_HERSHEY_COMPLEX, 1, (0, 0, 0), 2)
+                cv2.putText(draw, caption, (int(x1), int(y1) - 10), cv2.FONT_HERSHEY_COMPLEX, 1, (255, 0, 0), 1)
 
-        if image_output_path is not None:
             image_output_path = image_output_path + "/seed.png"
             io.save_image_from_array(draw, image_output_path)
             print("processing time: " + image_output_path)
 
         if sort:
-            seed_images.sort(key=lambda i:i.x1)
+            # only the regions are sorted, the scores stay in confidence order as Box.init_seeds expects
+            bounds = bounds[np.argsort(bounds[:, image_util.X1], kind="stable")]
+
+        # the regions are views of one bounds array and do not keep the frame alive
+        return image_util.views(bounds), scores_list
+
+    def _detect_tiled(self, image: np.ndarray, tile_size: int, tile_overlap: int, tile_scale: float, iou_threshold: float):
+        """
+        Run the model on overlapping tiles of image in a single batch.
+
+        Returns
+        -------
+        tuple
+            boxes (n, 4) in image coordinates, scores (n,) and labels (n,), sorted by descending score
+        """
+        image_height, image_width = np.shape(image)[:2]
+        origins = [(y, x) for y in self.tile_origins(image_height, tile_size, tile_overlap)
+                   for x in self.tile_origins(image_width, tile_size, tile_overlap)]
+
+        tiles = []
+        kept_origins = []
+        for y, x in origins:
+            tile = image[y:y + tile_size, x:x + tile_size]
+            # regions blacked out before detection carry no seeds
+            if not tile.any():
+                continue
+            if np.shape(tile)[:2] != (tile_size, tile_size):
+                padded = np.zeros((tile_size, tile_size) + np.shape(tile)[2:], dtype=tile.dtype)
+                padded[:np.shape(tile)[0], :np.shape(tile)[1]] = tile
+                tile = padded
+            tile = preprocess_image(tile)
+            if tile_scale != 1.0:
+                tile = cv2.resize(tile, None, fx=tile_scale, fy=tile_scale, interpolation=cv2.INTER_AREA)
+            tiles.append(tile)
+            kept_origins.append((y, x))
+
+        if not tiles:
+            return np.empty((0, 4)), np.empty(0), np.empty(0, dtype=int)
+
+        boxes, scores, labels = self.model.predict_on_batch(np.stack(tiles))
+        boxes = boxes / tile_scale
+
+        all_boxes, all_scores, all_labels = [], [], []
+        edge = 2
+        for (y, x), tile_boxes, tile_scores, tile_labels in zip(kept_origins, boxes, scores, labels):
+            valid = tile_scores >= self._confidence_cutoff
+            tile_boxes = tile_boxes[valid]
+            # boxes cut by a tile border that is not an image border are partial, a neighbouring tile sees the whole seed
+            inner = np.zeros(len(tile_boxes), dtype=bool)
+            if x > 0:
+                inner |= tile_boxes[:, 0] <= edge
+            if y > 0:
+                inner |= tile_boxes[:, 1] <= edge
+            if x + tile_size < image_width:
+                inner |= tile_boxes[:, 2] >= tile_size - edge
+            if y + tile_size < image_height:
+                inner |= tile_boxes[:, 3] >= tile_size - edge
+            all_boxes.append(tile_boxes[~inner] + np.array([x, y, x, y]))
+            all_scores.append(tile_scores[valid][~inner])
+            all_labels.append(tile_labels[valid][~inner])
+
+        boxes = np.concatenate(all_boxes)
+        scores = np.concatenate(all_scores)
+        labels = np.concatenate(all_labels)
+        keep = self.non_max_suppression(boxes, scores, iou_threshold)
+        return boxes[keep], scores[keep], labels[keep]
 
-        return seed_images, scores_list
+    @staticmethod
+    def tile_origins(length: int, tile_size: int, tile_overlap: int):
+        """
+        :return: start offsets of tiles covering length pixels with at least tile_overlap pixels of overlap
+        """
+        if length <= tile_size:
+            return [0]
+        step = max(tile_size - tile_overlap, 1)
+        origins = list(range(0, length - tile_size + 1, step))
+        if origins[-1] != length - tile_size:
+            origins.append(length - tile_size)
+        return origins
+
+    @staticmethod
+    def non_max_suppression(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float = 0.5):
+        """
+        :param boxes: (n, 4) array of x1, y1, x2, y2
+        :param scores: (n,) array of scores
+        :return: indices of the boxes to keep, by descending score
+        """
+        order = np.argsort(scores)[::-1]
+        x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+        areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        keep = []
+        while order.size:
+            i = order[0]
+            keep.append(i)
+            rest = order[1:]
+            w = np.maximum(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0)
+            h = np.maximum(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0)
+            intersection = w * h
+            iou = intersection / np.maximum(areas[i] + areas[rest] - intersection, 1e-9)
+            order = rest[iou <= iou_threshold]
+        return np.array(keep, dtype=int)
 
     def preprocessing(self, **args):
         pass
@@ -10,68 +10,157 @@ from os.path import isfile, join
 import numpy as np
 import subprocess
 import cv2
-from pyzbar.pyzbar import decode, ZBarSymbol
 import shutil
 from pathlib import Path
 import zipfile
 import random
-import tensorflow as tf
 import keras
 from keras_retinanet import models
 from keras_retinanet.utils.image import preprocess_image, resize_image 
+import src.retnet.export as export
+import src.qr_decoding as qr
+import src.preclassifier as pc
+import src.video_segments as vs
+import src.journal as jn
+import src.frame_hashes as fh
+import src.myutilities.timeline as tl
+import src.myutilities.util as util
 import time
-from PIL import Image
-
-
-def init(robot, boxes_per_shelf):
-    """ Declare constants for save paths"""
-
-    global ARCHIVE_PATH
-    global MOUNTED_BUCKET_STAGING_PATH
-    global UNSORTED_UNLABELED_PATH
-    global SORTED_UNLABELED_PATH
-    global CURRENT_EXP_PATH
-    global FINISHED_EXP_PATH
-    global JUNK_EXP_PATH
-    global JUNK_REVIEW_PATH
-    global FINAL_VIDEO_PATH
-    global QR_MODEL_PATH
-    global QR_MODEL
-    global BOXES_PER_SHELF
-    global STABILIZED_VIDEO_PATH
-
-    abspath = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
-    INSTALL_PATH = os.path.dirname(abspath)
-    DATA_PATH = os.path.join(INSTALL_PATH, "data", "robot", "")
-    MOUNTED_BUCKET_STAGING_PATH = os.path.join(INSTALL_PATH, "data", "unsorted_unlabeled_zipped", "")
-    ARCHIVE_PATH = os.path.join(INSTALL_PATH, "data", "unsorted_unlabeled_processed", "")
-    UNSORTED_UNLABELED_PATH = os.path.join(DATA_PATH, "master_data", "unsorted_unlabeled", "")
-    SORTED_UNLABELED_PATH = os.path.join(DATA_PATH, "master_data", "sorted_unlabeled", "")
-    CURRENT_EXP_PATH = os.path.join(DATA_PATH, "master_data", "current_exp", "")
-    FINISHED_EXP_PATH = os.path.join(DATA_PATH, "master_data", "finished_exp", "")
-    JUNK_EXP_PATH = os.path.join(DATA_PATH, "master_data", "junk_exp", "")
-    JUNK_REVIEW_PATH = os.path.join(DATA_PATH, "master_data", "junk_review", "")
-    FINAL_VIDEO_PATH = os.path.join(INSTALL_PATH, "data", "videos", "unstabilized", "")
-    STABILIZED_VIDEO_PATH = os.path.join(INSTALL_PATH, "data", "videos", "stabilized", "")
-    BOXES_PER_SHELF = int(boxes_per_shelf)
-    
+import functools
+import threading
+import concurrent.futures
+from typing import NamedTuple
+
+# the QR detector gets frames decoded at 1/QR_DETECTION_REDUCTION resolution
+QR_DETECTION_REDUCTION = 2
+REDUCED_COLOR_FLAGS = {1: cv2.IMREAD_COLOR,
+                       2: cv2.IMREAD_REDUCED_COLOR_2,
+                       4: cv2.IMREAD_REDUCED_COLOR_4,
+                       8: cv2.IMREAD_REDUCED_COLOR_8}
+# decoded frames kept by a frame_reader, enough for the detection candidates of one box
+FRAME_CACHE_SIZE = 12
+
+# background copies between the mounted buckets and local scratch
+_BACKGROUND_EXECUTOR = None
+_BACKGROUND_LOCK = threading.Lock()
+_PREFETCHES = {}
+_ARCHIVE_TASKS = []
+
+
+class Config(NamedTuple):
+    """ Paths and settings of one robot's pipeline, made by make_config. Every directory path ends with a separator. """
+    robot: str
+    boxes_per_shelf: int
+    data_path: str
+    mounted_bucket_staging_path: str
+    archive_path: str
+    staging_scratch_path: str
+    unsorted_unlabeled_path: str
+    sorted_unlabeled_path: str
+    current_exp_path: str
+    finished_exp_path: str
+    junk_exp_path: str
+    junk_review_path: str
+    final_video_path: str
+    stabilized_video_path: str
+    preview_proxy_path: str
+    preview_contact_sheet_path: str
+    preview_retention_days: float
+    qr_model_path: str
+    qr_decode_stats_path: str
+    preclassifier_calibration_path: str
+    preclassifier_report_path: str
+    dedup_report_path: str
+    journal_path: str
+    qr_model: object = None
+
+
+def make_config(robot, boxes_per_shelf, install_path=None, preview_retention_days=30):
+    """ Absolute paths for a robot, without loading the QR model
+
+        install_path defaults to the directory this repository is installed in. Proxy videos
+        and contact sheets older than preview_retention_days are removed after each final
+        transfer, None keeps them.
+    """
+    if install_path is None:
+        abspath = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
+        install_path = os.path.dirname(abspath)
+    install_path = os.path.abspath(install_path)
+    data_path = os.path.join(install_path, "data", "robot", "")
+    return Config(
+        robot=robot.strip("/"),
+        boxes_per_shelf=int(boxes_per_shelf),
+        data_path=data_path,
+        mounted_bucket_staging_path=os.path.join(install_path, "data", "unsorted_unlabeled_zipped", ""),
+        archive_path=os.path.join(install_path, "data", "unsorted_unlabeled_processed", ""),
+        staging_scratch_path=os.path.join(install_path, "data", "staging_scratch", ""),
+        unsorted_unlabeled_path=os.path.join(data_path, "master_data", "unsorted_unlabeled", ""),
+        sorted_unlabeled_path=os.path.join(data_path, "master_data", "sorted_unlabeled", ""),
+        current_exp_path=os.path.join(data_path, "master_data", "current_exp", ""),
+        finished_exp_path=os.path.join(data_path, "master_data", "finished_exp", ""),
+        junk_exp_path=os.path.join(data_path, "master_data", "junk_exp", ""),
+        junk_review_path=os.path.join(data_path, "master_data", "junk_review", ""),
+        final_video_path=os.path.join(install_path, "data", "videos", "unstabilized", ""),
+        stabilized_video_path=os.path.join(install_path, "data", "videos", "stabilized", ""),
+        preview_proxy_path=os.path.join(install_path, "data", "videos", "preview", "proxy", ""),
+        preview_contact_sheet_path=os.path.join(install_path, "data", "videos", "preview", "contact_sheets", ""),
+        preview_retention_days=preview_retention_days,
+        qr_model_path=os.path.join(install_path, "data", "models", "qrInference.h5"),
+        qr_decode_stats_path=os.path.join(data_path, "qr_decode_stats.json"),
+        preclassifier_calibration_path=os.path.join(data_path, "preclassifier_calibration.json"),
+        preclassifier_report_path=os.path.join(data_path, "preclassifier_reports", ""),
+        dedup_report_path=os.path.join(data_path, "dedup_reports", ""),
+        journal_path=os.path.join(data_path, "journals", ""))
+
+
+def load_qr_model(config, backend="keras", intra_op_threads=None, inter_op_threads=None, quantized=False):
+    """ Copy of the config with the QR model loaded
+
+        backend selects how the QR model is loaded: "keras" for the h5, "frozen" for the optimized graph
+        exported by src.retnet.export, "auto" for the graph if it has been exported. quantized uses the graph
+        exported with int8 weights (export --quantize) instead. The thread counts size tensorflow's thread
+        pools, None lets tensorflow decide. Either model can be used from several threads.
+    """
+    frozen_path = export.frozen_graph_path(config.qr_model_path, quantized)
+    if backend == "frozen" or (backend == "auto" and os.path.isfile(frozen_path)):
+        model = export.FrozenGraph(frozen_path, intra_op_threads, inter_op_threads)
+    else:
+        keras.backend.tensorflow_backend.set_session(get_session(intra_op_threads, inter_op_threads))
+        model = export.KerasModel(models.load_model(config.qr_model_path, backbone_name='resnet50'))
+    return config._replace(qr_model=model)
 
-    # load all retinanet models
-    keras.backend.tensorflow_backend.set_session(get_session())
-    QR_MODEL_PATH = os.path.join(INSTALL_PATH, "data", "models", "qrInference.h5")
-    QR_MODEL = models.load_model(QR_MODEL_PATH, backbone_name='resnet50')
 
+def init(robot, boxes_per_shelf, backend="keras", intra_op_threads=None, inter_op_threads=None, preview_retention_days=30,
+         quantized=False):
+    """ Config for a robot with its QR model loaded, see make_config and load_qr_model """
+    return load_qr_model(make_config(robot, boxes_per_shelf, preview_retention_days=preview_retention_days),
+                         backend, intra_op_threads, inter_op_threads, quantized)
 
-def sort(base_path, shelves):
+
+def sort(config, base_path, shelves, journal=None):
+    """ Sort the images of a run into one folder per box position.
+
+        With a journal, the planned moves are recorded before any file is moved, and a
+        sort that was interrupted replays that plan instead of planning again.
+    """
     
     # number of boxes in this experiment.
-    num_boxes = BOXES_PER_SHELF * int(shelves)
+    num_boxes = config.boxes_per_shelf * int(shelves)
 
     # where unsorted, unlabelled images are located
-    mypathin = UNSORTED_UNLABELED_PATH + base_path
+    mypathin = config.unsorted_unlabeled_path + base_path
    
     # mypathout is the directory where the sorted but unlabelled images will go
-    mypathout = SORTED_UNLABELED_PATH + base_path
+    mypathout = config.sorted_unlabeled_path + base_path
+
+    plan = journal.find("sort_plan") if journal is not None else None
+    if plan is not None:
+        print("Resuming sort of " + base_path + " from its journal.")
+        for x in range(plan["boxes"]):
+            os.makedirs(mypathout + "/" + str(x + 1), exist_ok=True)
+        jn.apply_moves(plan["moves"])
+        journal.mark_done("sort")
+        return
 
     # create onlyfiles w column list with file name in first column and parsed image # as second column
     # create a list of all the files in the image directory
@@ -83,7 +172,6 @@ def sort(base_path, shelves):
     # final list
     files=list(zip(onlyfiles,filenum))
     files=sorted(files,key=lambda l:l[1], reverse=False)
-    os.chdir("/home")
 
     # this will make the out directory
     if not os.path.isdir(mypathout):
@@ -97,13 +185,13 @@ def sort(base_path, shelves):
     timestamps.sort()
     # this will make a number of directories in the out directory equal to the number of boxes, names 1\, 2\, 3\, etc
     for x in range(num_boxes):
-        os.mkdir(mypathout+"/"+str(x+1))
-    os.chdir("/home")
+        os.makedirs(mypathout+"/"+str(x+1), exist_ok=True)
 
     # this double loop will loop over the sequence 1:len(onlyfiles),
     # while also saving each file to the appropriate folder in the
     # out directory
     count = 0
+    moves = []
 
     # Changed to move instead of copy files when sorting
     for z in range(1,int(len(files)/num_boxes)*num_boxes,num_boxes):
@@ -111,17 +199,28 @@ def sort(base_path, shelves):
         for y in range(num_boxes):
             savefile=mypathout + "/" + str(y+1) + "/" + str(100000000 + count)[-8:] + "_" + str(timestamps[z+y-1]) + ".png"
             filename = mypathin + "/" + files[z+y-1][0]
-            shutil.move(filename, savefile)
-    os.chdir("/home")
+            moves.append([filename, savefile])
+    if journal is not None:
+        journal.record("sort_plan", boxes=num_boxes, moves=moves)
+    jn.apply_moves(moves)
+    if journal is not None:
+        journal.mark_done("sort")
+
 
+def label(config, base_path, journal=None):
+    """ Detect and decode the QR code of every box position and move its images to its experiment or to junk.
 
-def label(base_path):
-    current_exp_path = CURRENT_EXP_PATH
-    mypathout = SORTED_UNLABELED_PATH + base_path
-    junk_exp_path=JUNK_EXP_PATH
-    junk_review_path = JUNK_REVIEW_PATH
-    finished_exp_path = FINISHED_EXP_PATH
-    mypathin = UNSORTED_UNLABELED_PATH + base_path
+        With a journal, the moves decided for a position are recorded before they are made,
+        and positions that were decided before an interruption are not detected again.
+        Frames whose bytes are already in the experiment they are merged into are skipped,
+        see src/frame_hashes.py, and listed in a report in dedup_report_path.
+    """
+    current_exp_path = config.current_exp_path
+    mypathout = config.sorted_unlabeled_path + base_path
+    junk_exp_path = config.junk_exp_path
+    junk_review_path = config.junk_review_path
+    finished_exp_path = config.finished_exp_path
+    mypathin = config.unsorted_unlabeled_path + base_path
         
     # make current exp path, finished exp path, and junk exp path directory if they don't already exist.
     if not os.path.isdir(current_exp_path):
@@ -131,80 +230,122 @@ def label(base_path):
     if not os.path.isdir(finished_exp_path):
         os.mkdir(finished_exp_path)
 
+    # frames decoded for this label call only, other labels running in threads keep their own
+    read_frame = frame_reader()
+
     # This is intended to loop over all folders in sorted, unlabelled directory.
     # It will scan for QR codes until 3 codes are found, then take the modal code and move the images into the current
     # sorted-labelled directory.
     dirlist = [x[0] for x in os.walk(mypathout)]
     #print(dirlist)
+    qr_stats = qr.QrDecodeStats(config.qr_decode_stats_path, config.robot)
+    preclassifier = pc.PreClassifier(config.preclassifier_calibration_path, config.robot)
+    skipped = []
 
     # starting at index 1 skips the parent directory, which os.walk includes.  
     for d in dirlist[1:]:
-        # change to each subdirectory of sorted, unlabelled data
-        os.chdir(d)
-        im_list = random.choices(listdir_nohidden(d), k=10)
-        crop_sum=0
+        position = os.path.basename(d)
+        decided = journal.find("box", position=position) if journal is not None else None
+        if decided is not None:
+            skipped.extend(decided.get("skipped", []))
+            if journal.find("box_done", position=position) is None:
+                print("Position " + position + " was labelled before the restart, finishing its moves.")
+                jn.apply_moves(decided["moves"])
+                journal.record("box_done", position=position)
+            continue
 
-        for img in im_list:
-            box = qr_detection(d + "/" + img)
-            image_name = img
-            if len(box) > 0:
-                break
+        # each subdirectory of sorted, unlabelled data
+        frames = listdir_nohidden(d)
+        crop_sum=0
+        box = []
+        hashes = {}
+        box_skipped = []
+        exp_path = None
+
+        # positions that are confidently empty go straight to junk without running the detector,
+        # except for a few audited ones that keep the calibration honest
+        features = pc.position_features([d + "/" + f for f in frames], read_frame)
+        skip = preclassifier.is_empty(features) and random.random() >= pc.AUDIT_RATE
+        if skip:
+            preclassifier.record(os.path.basename(d), features, skipped=True)
+        else:
+            im_list = random.choices(frames, k=10)
+            for img in im_list:
+                box = qr_detection(config, d + "/" + img, read_frame=read_frame)
+                image_name = img
+                if len(box) > 0:
+                    break
+            preclassifier.record(os.path.basename(d), features, skipped=False, occupied=len(box) > 0)
         
         if len(box) > 0:
             
-            img = cv2.imread(d + "/" + image_name, 0)
+            img = read_frame(d + "/" + image_name, cv2.IMREAD_GRAYSCALE)
             box = box.astype(float)
             box = box.astype(int)
-            thr = []
-            blur = cv2.GaussianBlur(img[box[1]:box[3],box[0]:box[2]],(3,3),0)
-         
-            #try several preprocessing approaches and see if any work
-            thr.append(img)
-            thr.append(blur)
-            thr.append(cv2.adaptiveThreshold(blur, 255,cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,69,2))
-            thr.append(cv2.adaptiveThreshold(blur, 255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,69,2))    
-            thr.append(cv2.threshold(blur, 0, 255, cv2.THRESH_OTSU)[1])    
-            thr.append(cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,89,2))    
-            thr.append(cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,31,11))   
-            thr.append(cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,55,11))   
-            
-            counter = 0
-            for t in thr:
-                barcode = decode(t, symbols=[ZBarSymbol.QRCODE])
-                if len(barcode)>0:
-                    print("threshold technique: " + str(counter))
-                    break
-                counter = counter + 1 
+
+            # decode only the detected crop, trying the preprocessing that works best on this robot first
+            data, technique = qr.decode_qr(img, box, qr_stats)
+            exp_name = None
+            if data is not None:
+                print("threshold technique: " + technique)
+                try:
+                    exp_name = int(data)
+                except ValueError:
+                    print("QR code read as " + repr(data) + ", which is not an experiment number.")
                 
             crop_sum = crop_sum + np.sum(img[box[1]:box[3],box[0]:box[2]])
-            if len(barcode)>0:
-                exp_name = (int((str(barcode[0][0]).split('\'')[1::2])[0])) 
+            if exp_name is not None:
                 print("Position number = " + str(os.path.basename(d)))
                 print("Box number = " + str(exp_name))
                 temp_path = current_exp_path + "/" + str(exp_name)
+                exp_path = temp_path
                 if not os.path.isdir(temp_path):
-                    os.chdir("/home")
-                    shutil.move(d, temp_path)
+                    moves = [[d, temp_path]]
                 else:
                     onlyfiles = listdir_nohidden(temp_path)
                     base = len(onlyfiles)
-                    new_files = listdir_nohidden(".")
-                    for g in new_files:
-                        file_counter = int(g[0:8])
-                        stamps = g.split("_")[1]
+                    # frames already in the experiment are left behind, the others keep consecutive numbers
+                    kept, duplicates = fh.find_duplicates([d + "/" + g for g in frames], temp_path)
+                    moves = []
+                    for file_counter, (path, digest) in enumerate(kept, 1):
+                        stamps = os.path.basename(path).split("_")[1]
                         savefile = temp_path + "/" + str(100000000 + file_counter + base)[-8:] + "_" + stamps 
-                        shutil.move(g, savefile)
+                        moves.append([path, savefile])
+                        hashes[os.path.basename(savefile)] = digest
+                    box_skipped = [{"experiment": str(exp_name), "frame": os.path.basename(path), "duplicate_of": name}
+                                   for path, name in duplicates]
             else:
                 print("QR code exists but barcode could not be read! See Junk Review.")
-                os.chdir("/home")
-                shutil.move(d, junk_review_path + "/" + os.path.splitext(os.path.basename(d))[0] + "_" + os.path.basename(mypathin) + "_" + str(crop_sum))
+                moves = [[d, junk_review_path + "/" + os.path.splitext(os.path.basename(d))[0] + "_" + os.path.basename(mypathin) + "_" + str(crop_sum)]]
         else:
-            print("QR not found, box may be placeholder or missing. Moving to Junk Exp.")
-            os.chdir("/home")
-            shutil.move(d, junk_exp_path + "/" + os.path.splitext(os.path.basename(d))[0] + "_" + os.path.basename(mypathin) + "_" + str(crop_sum))
-        os.chdir("/home")
-
-    shutil.rmtree(mypathin)
+            if skip:
+                print("Position " + str(os.path.basename(d)) + " looks empty, box may be placeholder or missing. Moving to Junk Exp.")
+            else:
+                print("QR not found, box may be placeholder or missing. Moving to Junk Exp.")
+            moves = [[d, junk_exp_path + "/" + os.path.splitext(os.path.basename(d))[0] + "_" + os.path.basename(mypathin) + "_" + str(crop_sum)]]
+
+        # record the decision before anything moves, so a restart finishes it instead of detecting again
+        if journal is not None:
+            journal.record("box", position=position, moves=moves, skipped=box_skipped)
+        jn.apply_moves(moves)
+        if hashes:
+            fh.record(temp_path, hashes)
+        if exp_path is not None:
+            # a new experiment gets its timeline built from the moved folder
+            tl.append(exp_path, [os.path.basename(destination) for source, destination in moves])
+        skipped.extend(box_skipped)
+        if journal is not None:
+            journal.record("box_done", position=position)
+        read_frame.cache_clear()
+
+    if skipped:
+        fh.write_report(config.dedup_report_path + os.path.basename(mypathin) + ".json", skipped)
+    qr_stats.save()
+    preclassifier.save()
+    preclassifier.report(os.path.join(config.preclassifier_report_path, os.path.basename(mypathin) + ".json"))
+    # already gone if label is finishing after a restart
+    if os.path.isdir(mypathin):
+        shutil.rmtree(mypathin)
     
     # cleanup sorted_unlabelled
     try:
@@ -214,20 +355,22 @@ def label(base_path):
         print(e)
     except Exception as e:
         print(e)
+    if journal is not None:
+        journal.mark_done("label")
         
-def qr_detection(image_path):
+def qr_detection(config, image_path, reduction=QR_DETECTION_REDUCTION, read_frame=cv2.imread):
+    """
+        Run the QR retinanet on an image decoded at 1/reduction resolution. The detector
+        downsizes its input to about 800px anyway, so decoding at full size buys nothing.
+        read_frame(path, flags) decodes the image, e.g. a frame_reader shared with decoding.
+        Returns the box of the most confident QR code in full resolution pixels, or [].
+    """
     
     confidence_cutoff = 0.1
     
-    model = QR_MODEL
+    model = config.qr_model
     
-    image = cv2.imread(image_path)    
-    image = image.copy()
-            
-    width = [0, 1]
-
-    image = (image[:,int(width[0]*np.shape(image)[1]):int(width[1]*np.shape(image)[1])])
-    draw = image.copy()
+    image = read_frame(image_path, REDUCED_COLOR_FLAGS[reduction])
         
     image = preprocess_image(image)
     image, scale = resize_image(image)
@@ -238,6 +381,7 @@ def qr_detection(image_path):
     print("QR RETINANET processing time: ", time.time() - start)
 
     boxes /= scale
+    boxes *= reduction
         
     top = np.argmax(scores[0])
     box = boxes[0][top]
@@ -246,22 +390,43 @@ def qr_detection(image_path):
         
     if score >= confidence_cutoff:
         print("QR code has been found!!! ")
-           
-        color = (255, 0, 0)
-        thickness = 2
-        box = box.astype(int) 
-        cv2.rectangle(draw, (box[0], box[1]), (box[2], box[3]), color, thickness, cv2.LINE_AA)
-
-        # draw = Image.fromarray(draw)
-        # draw.save("/qrbox.png")
-        # box = np.append(box, image_name)
         return box
     return []
 
 
+def frame_reader(maxsize=FRAME_CACHE_SIZE):
+    """
+        read_frame(path, flags) with its own cache of decoded frames, shared by the
+        pre-classification, detection and decoding stages of one label() call so a
+        frame is decoded at most once per resolution. Every call gets a new cache,
+        so labels running in other threads neither evict nor clear its frames. The
+        cached arrays are shared and must not be modified. label() clears the cache
+        after every box, because the box directories are moved.
+    """
+    @functools.lru_cache(maxsize=maxsize)
+    def read_frame(path, flags=cv2.IMREAD_COLOR):
+        return cv2.imread(path, flags)
+    return read_frame
+
+
+def open_journal(config, run_name):
+    """ Journal of a run, see src/journal.py. Empty for a run that has not been started """
+    return jn.RunJournal(config.journal_path, run_name)
+
+
+def encode_segments(config):
+    """ Encode the frames each experiment in current_exp gained this run as a new video segment """
+    for exp in listdir_nohidden(config.current_exp_path):
+        try:
+            vs.encode_new_frames(config.current_exp_path + exp)
+        except (subprocess.CalledProcessError, OSError) as e:
+            # final_transfer encodes whatever is missing, so a failed segment only costs time later
+            print("Could not encode new frames of " + exp + " as a segment.")
+            print(e)
 
-def junk_review():
-    count = len(listdir_nohidden(JUNK_REVIEW_PATH))-1
+
+def junk_review(config):
+    count = len(listdir_nohidden(config.junk_review_path))-1
     if count > 0:
         print("\n*****************")
         print("There are " + str(count) + " experiment folders that have been sent to junk_review. Please manually move these experiments to the 're_merge' folder in 'junk_review' if you wish to keep them and rename the experiments with the correct experiment number.")
@@ -271,50 +436,67 @@ def junk_review():
         print("No experiments in junk review.")
         return False
 
-def re_merge():
+def re_merge(config):
+    """ Merge experiments moved to junk_review/re_merge back into current_exp, skipping frames that are already there """
+    skipped = []
     try:
-        for x in (listdir_nohidden(JUNK_REVIEW_PATH+"/re_merge/")):
-            src = JUNK_REVIEW_PATH+"/re_merge/" + x
-            dst = CURRENT_EXP_PATH + x
+        for x in (listdir_nohidden(config.junk_review_path + "re_merge/")):
+            src = config.junk_review_path + "re_merge/" + x
+            dst = config.current_exp_path + x
             if not os.path.exists(dst):
-                shutil.move(src, CURRENT_EXP_PATH)
+                shutil.move(src, config.current_exp_path)
                 print(str(x) + " successfully moved!")
             else:
                 dst_list = [f for f in listdir_nohidden(dst) if not f.startswith('.')]
                 dst_len = len(dst_list)
                 files_list = [f for f in listdir_nohidden(src) if not f.startswith('.')]
+                kept, duplicates = fh.find_duplicates([src + "/" + f for f in files_list], dst)
                 count = dst_len
-                for f in files_list:
+                hashes = {}
+                for path, digest in kept:
                     count += 1
-                    filenamesplit = f.split("_")
-                    os.rename(src + "/" + f, dst + "/" + str(100000000 + count)[-8:] + "_" + filenamesplit[1])
+                    filenamesplit = os.path.basename(path).split("_")
+                    name = str(100000000 + count)[-8:] + "_" + filenamesplit[1]
+                    os.rename(path, dst + "/" + name)
+                    hashes[name] = digest
+                fh.record(dst, hashes)
+                tl.append(dst, list(hashes))
+                if duplicates:
+                    # the same bytes are in dst already, the copies go to junk_exp and are cleared with it
+                    duplicate_path = config.junk_exp_path + x + "_duplicates"
+                    os.makedirs(duplicate_path, exist_ok=True)
+                    for path, name in duplicates:
+                        shutil.move(path, duplicate_path)
+                        skipped.append({"experiment": x, "frame": os.path.basename(path), "duplicate_of": name})
     except Exception as e:
         print("No experiments found to re-merge.")
         print(e)
+    if skipped:
+        fh.write_report(config.dedup_report_path + "re_merge_" + time.strftime("%Y%m%d_%H%M%S") + ".json", skipped)
     
 # initializes 2D array names temp_list in which the first element is the number of the exp and the second is the
 # len of the exp (number of images)
-def update(current_list):
-    temp_list = sorted(listdir_nohidden(CURRENT_EXP_PATH))
+def update(config, current_list):
+    temp_list = sorted(listdir_nohidden(config.current_exp_path))
     for x in temp_list:
-        current_list.append([x, len(listdir_nohidden(CURRENT_EXP_PATH + x))])
+        current_list.append([x, len(listdir_nohidden(config.current_exp_path + x))])
     return current_list
 
 
-def final_transfer(current_exp_list, stabilize = True):
+def final_transfer(config, current_exp_list, stabilize = True):
     if len(current_exp_list) == 0:
-        current_exp_list = update(current_exp_list)
+        current_exp_list = update(config, current_exp_list)
         print(current_exp_list)
     else:
         print(current_exp_list)
         for x in range(len(current_exp_list)):
             
             current_exp_name = current_exp_list[x][0]
-            if len(listdir_nohidden(CURRENT_EXP_PATH + current_exp_list[x][0])) == current_exp_list[x][1]:
+            if len(listdir_nohidden(config.current_exp_path + current_exp_list[x][0])) == current_exp_list[x][1]:
                 print("No new images were added to " + current_exp_list[x][0] + ", moving to finished_exp")
                 
                 try:
-                    shutil.move(CURRENT_EXP_PATH + current_exp_list[x][0], FINISHED_EXP_PATH)
+                    shutil.move(config.current_exp_path + current_exp_list[x][0], config.finished_exp_path)
                 except FileExistsError as e:
                     print("WARNING: Experiment " +str(current_exp_list[x][0])+" already has a finished experiment folder")
                     print(e)
@@ -328,41 +510,65 @@ def final_transfer(current_exp_list, stabilize = True):
                 #     shutil.copy(FINISHED_EXP_PATH + current_exp_name + "/qrbox.png", FINAL_SHOWCASE_PATH + current_exp_name)
                 #     os.remove(FINISHED_EXP_PATH + current_exp_name + "/qrbox.png")
 
-                # make video and move it
-                src = FINISHED_EXP_PATH + current_exp_list[x][0] + "/"
-                os.chdir(src)
+                # join the segments encoded after every run into the video, encoding only frames added since the last run
+                src = config.finished_exp_path + current_exp_name + "/"
   
                 start = time.time()
 
-                src = FINISHED_EXP_PATH + current_exp_name + "/"
-                os.chdir(src)
-                command = 'ffmpeg -framerate 15 -pattern_type glob -i \"*.png\" -c:v libx264 -crf 24 -pix_fmt yuv420p outfile.mp4'
-                subprocess.call(command,shell=True)     
+                try:
+                    joined = vs.join_segments(src, src + "outfile.mp4", src + "proxy.mp4")
+                except (subprocess.CalledProcessError, OSError) as e:
+                    print("Could not join the video segments of " + current_exp_name + ", encoding all frames.")
+                    print(e)
+                    joined = False
+                if not joined:
+                    # one decode feeds both the full resolution video and the proxy
+                    vs.encode_frames([src + f for f in util.frame_names(src)], src + "outfile.mp4", proxy_path=src + "proxy.mp4")
+                vs.remove_segments(src)
+                make_previews(config, src + "proxy.mp4", current_exp_name, len(util.frame_names(src)))
                 
                 if stabilize:
                     command = 'ffmpeg -i outfile.mp4 -vf vidstabdetect=stepsize=32:shakiness=10:accuracy=10:result=transforms.trf -f null -'
-                    subprocess.call(command,shell=True)
+                    subprocess.call(command,shell=True,cwd=src)
                     
                     command = 'ffmpeg -i outfile.mp4 -vf vidstabtransform=smoothing:input=\"transforms.trf\" outfile_stabilized.mp4'
-                    subprocess.call(command,shell=True)
+                    subprocess.call(command,shell=True,cwd=src)
 
-                    shutil.copy(FINISHED_EXP_PATH + current_exp_list[x][0] + "/outfile_stabilized.mp4", STABILIZED_VIDEO_PATH + current_exp_name + ".mp4")
-                    os.remove(FINISHED_EXP_PATH + current_exp_list[x][0] + "/outfile_stabilized.mp4") 
-                    os.remove(FINISHED_EXP_PATH + current_exp_list[x][0] + "/transforms.trf")  
+                    shutil.copy(config.finished_exp_path + current_exp_list[x][0] + "/outfile_stabilized.mp4", config.stabilized_video_path + current_exp_name + ".mp4")
+                    os.remove(config.finished_exp_path + current_exp_list[x][0] + "/outfile_stabilized.mp4") 
+                    os.remove(config.finished_exp_path + current_exp_list[x][0] + "/transforms.trf")  
                 else:
-                    shutil.copy(FINISHED_EXP_PATH + current_exp_list[x][0] + "/outfile.mp4", STABILIZED_VIDEO_PATH + current_exp_name + ".mp4") 
+                    shutil.copy(config.finished_exp_path + current_exp_list[x][0] + "/outfile.mp4", config.stabilized_video_path + current_exp_name + ".mp4") 
                 
-                shutil.copy(FINISHED_EXP_PATH + current_exp_list[x][0] + "/outfile.mp4", FINAL_VIDEO_PATH + current_exp_name + ".mp4") 
-                os.remove(FINISHED_EXP_PATH + current_exp_list[x][0] + "/outfile.mp4")   
+                shutil.copy(config.finished_exp_path + current_exp_list[x][0] + "/outfile.mp4", config.final_video_path + current_exp_name + ".mp4") 
+                os.remove(config.finished_exp_path + current_exp_list[x][0] + "/outfile.mp4")   
                 
                 print("Video processing time: ", time.time() - start)            
+
+    vs.prune(config.preview_proxy_path, config.preview_retention_days)
+    vs.prune(config.preview_contact_sheet_path, config.preview_retention_days)
+
+
+def make_previews(config, proxy_path, exp_name, n_frames):
+    """ Move an experiment's proxy video to the preview directory and tile a contact sheet from it """
+    if not os.path.isfile(proxy_path):
+        print("No proxy video was made for " + str(exp_name))
+        return
+    for d in (config.preview_proxy_path, config.preview_contact_sheet_path):
+        os.makedirs(d, exist_ok=True)
+    try:
+        vs.contact_sheet(proxy_path, config.preview_contact_sheet_path + str(exp_name) + ".jpg", n_frames)
+    except subprocess.CalledProcessError as e:
+        print("Could not make a contact sheet for " + str(exp_name))
+        print(e)
+    shutil.move(proxy_path, config.preview_proxy_path + str(exp_name) + ".mp4")
         
 
-def clear_junk():
+def clear_junk(config):
     """ Clears out junk review and junk experiment folders """
-    junk_exp_path = JUNK_EXP_PATH
-    junk_review_path = JUNK_REVIEW_PATH
-    remerge_path = JUNK_REVIEW_PATH + "re_merge/"
+    junk_exp_path = config.junk_exp_path
+    junk_review_path = config.junk_review_path
+    remerge_path = config.junk_review_path + "re_merge/"
     
     print("Clearing out junk folders")
     for file in listdir_nohidden(junk_exp_path):
@@ -386,27 +592,128 @@ def sort_date(elem):
     return summation
 
 
-def transfer_to_instance(run_name):
+def transfer_to_instance(config, run_name):
     """
         Function to unzip experimental runs from the staging area.
         It will make a directory in the unsorted_unlabelled directory in
         master data (if it isn't there already)
+
+        The zip is extracted from a local scratch copy, which prefetch_staged_zip
+        may already have made while the previous run was processed.
     """
     directory = (os.path.splitext(run_name)[0])
     print(directory)
     try:
-        os.makedirs(UNSORTED_UNLABELED_PATH + directory)
+        os.makedirs(config.unsorted_unlabeled_path + directory)
     except Exception as e:
         print("file exists")
         print(e)
-    with zipfile.ZipFile(MOUNTED_BUCKET_STAGING_PATH + run_name,"r") as zip_ref:
-        zip_ref.extractall(UNSORTED_UNLABELED_PATH + directory)
-    os.chdir("/home")
+    local_zip = prefetch_staged_zip(config, run_name).result()
+    with zipfile.ZipFile(local_zip,"r") as zip_ref:
+        zip_ref.extractall(config.unsorted_unlabeled_path + directory)
+
+
+def prefetch_staged_zip(config, run_name):
+    """
+        Copy a zip from the mounted staging bucket to local scratch in the background,
+        so network I/O overlaps with sorting, labeling and encoding of the current run.
+        Returns a future resolving to the local path. Calling it again for the same zip
+        returns the same future, and a complete copy left by an earlier run is reused.
+    """
+    executor = _background_executor()
+    with _BACKGROUND_LOCK:
+        key = (config.mounted_bucket_staging_path, run_name)
+        future = _PREFETCHES.get(key)
+        if future is None:
+            future = executor.submit(_copy_to_scratch, config, run_name)
+            _PREFETCHES[key] = future
+        return future
+
+
+def _copy_to_scratch(config, run_name):
+    staged = config.mounted_bucket_staging_path + run_name
+    local = config.staging_scratch_path + run_name
+    if os.path.isfile(local) and os.path.getsize(local) == os.path.getsize(staged):
+        print("Using prefetched copy of " + run_name)
+        return local
+    os.makedirs(config.staging_scratch_path, exist_ok=True)
+    start = time.time()
+    partial = config.staging_scratch_path + "." + run_name + ".part"
+    shutil.copyfile(staged, partial)
+    os.replace(partial, local)
+    print("Prefetched " + run_name + " to scratch in " + str(round(time.time() - start)) + " s")
+    return local
 
 
-def clear_staging_bucket(zip_to_remove):
-    #os.remove(MOUNTED_BUCKET_STAGING_PATH + "/" + zip_to_remove)
-    shutil.move(MOUNTED_BUCKET_STAGING_PATH + "/" + zip_to_remove, ARCHIVE_PATH + "/" + zip_to_remove)
+def clear_staging_bucket(config, zip_to_remove, wait=False):
+    """
+        Archive the processed zip and remove it from the staging bucket in the background.
+        The archive copy is written from the local scratch copy, so the zip is not read over
+        the mount a second time, and the staged zip is only deleted once the archive copy has
+        been verified. Returns the future of the background task; wait_for_background_io
+        waits for all of them.
+    """
+    future = _background_executor().submit(_archive_staged_zip, config, zip_to_remove)
+    with _BACKGROUND_LOCK:
+        _ARCHIVE_TASKS.append(future)
+    if wait:
+        future.result()
+    return future
+
+
+def _archive_staged_zip(config, zip_to_remove):
+    staged = config.mounted_bucket_staging_path + zip_to_remove
+    archived = config.archive_path + zip_to_remove
+    local = config.staging_scratch_path + zip_to_remove
+    if not os.path.isfile(local):
+        #os.remove(config.mounted_bucket_staging_path + "/" + zip_to_remove)
+        shutil.move(staged, archived)
+        return archived
+
+    size = os.path.getsize(local)
+    if os.path.getsize(staged) != size:
+        raise IOError("Scratch copy of " + zip_to_remove + " does not match the staged zip, not archiving.")
+    with zipfile.ZipFile(local) as zip_ref:
+        bad = zip_ref.testzip()
+    if bad is not None:
+        raise IOError("Scratch copy of " + zip_to_remove + " is corrupt at " + bad + ", not archiving.")
+
+    partial = config.archive_path + "." + zip_to_remove + ".part"
+    shutil.copyfile(local, partial)
+    os.replace(partial, archived)
+    if os.path.getsize(archived) != size:
+        raise IOError("Archived copy of " + zip_to_remove + " has the wrong size, keeping the staged zip.")
+    os.remove(staged)
+    os.remove(local)
+    with _BACKGROUND_LOCK:
+        _PREFETCHES.pop((config.mounted_bucket_staging_path, zip_to_remove), None)
+    print("Archived " + zip_to_remove)
+    return archived
+
+
+def wait_for_background_io():
+    """
+        Wait for all prefetches and archive tasks. Returns False if any of them failed.
+    """
+    with _BACKGROUND_LOCK:
+        futures = list(_PREFETCHES.values()) + _ARCHIVE_TASKS
+    ok = True
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print("Background transfer failed:")
+            print(e)
+            ok = False
+    return ok
+
+
+def _background_executor():
+    global _BACKGROUND_EXECUTOR
+    with _BACKGROUND_LOCK:
+        if _BACKGROUND_EXECUTOR is None:
+            _BACKGROUND_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        return _BACKGROUND_EXECUTOR
 
 
 def listdir_nohidden(path):
@@ -414,8 +721,6 @@ def listdir_nohidden(path):
     return [f for f in sorted(os.listdir(path)) if not f.startswith('.')]
 
 
-def get_session():
+def get_session(intra_op_threads=None, inter_op_threads=None):
     """ only needs to be called once """
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
-    return tf.Session(config=config)
+    return export.get_session(intra_op_threads, inter_op_threads)
@@ -0,0 +1,203 @@
+"""
+    Module for incremental video encoding of experiments that grow over many robot runs.
+
+    After every run the frames added to an experiment are encoded as one H.264
+    segment, always with the same parameters, and kept in a hidden .segments
+    folder inside the experiment. When the experiment is finished the segments
+    are joined with ffmpeg's concat demuxer, which copies the streams instead
+    of re-encoding them.
+
+    The same decode also feeds a low resolution proxy encode, so every segment
+    has a proxy and the proxies are joined the same way. Contact sheets are
+    tiled from the joined proxy.
+
+"""
+
+import os
+import json
+import time
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+
+from src.myutilities import timeline
+from src.myutilities import util
+
+SEGMENT_DIR = ".segments"
+MANIFEST = "segments.json"
+FRAMERATE = 15
+# must stay the same for every segment of an experiment, or the segments cannot be joined without re-encoding
+ENCODE_ARGS = ["-c:v", "libx264", "-crf", "24", "-pix_fmt", "yuv420p", "-r", str(FRAMERATE)]
+PROXY_WIDTH = 640
+PROXY_ARGS = ["-c:v", "libx264", "-crf", "28", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-r", str(FRAMERATE)]
+# columns x rows of frames, evenly spaced over the experiment, and the width of every tile
+CONTACT_SHEET_TILES = (6, 4)
+CONTACT_SHEET_TILE_WIDTH = 320
+
+
+def load_manifest(exp_path):
+    try:
+        with open(os.path.join(exp_path, SEGMENT_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"segments": []}
+
+
+def save_manifest(exp_path, manifest):
+    path = os.path.join(exp_path, SEGMENT_DIR, MANIFEST)
+    with open(path + ".part", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(path + ".part", path)
+
+
+def encoded_frames(manifest):
+    return [name for segment in manifest["segments"] for name in segment["frames"]]
+
+
+def encode_frames(frame_paths, output_path, extra_args=(), proxy_path=None, durations=None):
+    """
+        Encode frames, in order, at FRAMERATE. The frames are linked into a temporary folder
+        under sequential names so the image2 demuxer gives every frame exactly one slot.
+        With proxy_path, the decoded frames are split and also encoded at PROXY_WIDTH.
+        With durations, seconds of video per frame, the frames are read with the concat demuxer
+        instead and shown for their duration, repeated or dropped to fit the FRAMERATE slots.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(output_path)) as tmp:
+        if durations is None:
+            for i, path in enumerate(frame_paths):
+                os.symlink(os.path.abspath(path), os.path.join(tmp, "%08d.png" % i))
+            command = ["ffmpeg", "-y", "-loglevel", "error", "-framerate", str(FRAMERATE), "-i", os.path.join(tmp, "%08d.png")]
+        else:
+            list_path = os.path.join(tmp, "frames.txt")
+            with open(list_path, "w") as f:
+                for path, duration in zip(frame_paths, durations):
+                    f.write("file '" + os.path.abspath(path) + "'\nduration " + repr(float(duration)) + "\n")
+                # the concat demuxer ignores the duration of the last entry unless the file is listed again
+                f.write("file '" + os.path.abspath(frame_paths[-1]) + "'\n")
+            command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path]
+        if proxy_path is None:
+            command += ENCODE_ARGS + list(extra_args) + [output_path]
+        else:
+            command += ["-filter_complex", "[0:v]split=2[full][small];[small]scale=" + str(PROXY_WIDTH) + ":-2[proxy]",
+                        "-map", "[full]"] + ENCODE_ARGS + list(extra_args) + [output_path] \
+                + ["-map", "[proxy]"] + PROXY_ARGS + list(extra_args) + [proxy_path]
+        subprocess.run(command, check=True)
+
+
+def encode_new_frames(exp_path):
+    """
+        Encode the frames added to an experiment since its last segment as a new segment.
+        If the existing segments no longer match the start of the frame list (frames were
+        renamed or removed) they are thrown away and everything is encoded again.
+        Returns the path of the new segment, or None if there were no new frames.
+    """
+    segment_path = os.path.join(exp_path, SEGMENT_DIR)
+    frames = util.frame_names(exp_path)
+    manifest = load_manifest(exp_path)
+    done = encoded_frames(manifest)
+    if frames[:len(done)] != done:
+        print("Segments of " + exp_path + " do not match its frames, re-encoding from the start.")
+        shutil.rmtree(segment_path, ignore_errors=True)
+        manifest = {"segments": []}
+        done = []
+    new = frames[len(done):]
+    if not new:
+        return None
+
+    os.makedirs(segment_path, exist_ok=True)
+    name = "%06d.mp4" % (len(manifest["segments"]) + 1)
+    proxy = "%06d_proxy.mp4" % (len(manifest["segments"]) + 1)
+    partial = os.path.join(segment_path, "." + name)
+    partial_proxy = os.path.join(segment_path, "." + proxy)
+    encode_frames([os.path.join(exp_path, f) for f in new], partial, ["-f", "mp4"], partial_proxy)
+    os.replace(partial_proxy, os.path.join(segment_path, proxy))
+    os.replace(partial, os.path.join(segment_path, name))
+    manifest["segments"].append({"file": name, "proxy": proxy, "frames": new})
+    save_manifest(exp_path, manifest)
+    print("Encoded " + str(len(new)) + " new frames of " + os.path.basename(os.path.normpath(exp_path)) + " as segment " + name)
+    return os.path.join(segment_path, name)
+
+
+def encode_timeline(exp_path, output_path, start=None, end=None, speedup=None, proxy_path=None):
+    """
+        Encode the frames of an experiment taken in [start, end) with every frame shown for
+        the time until the next one, so the video plays at a constant speed in real time even
+        where frames are missing. start and end are unix times or datetimes, see the timeline
+        module. speedup is real seconds per video second, by default the median frame interval
+        lasts one FRAMERATE slot. Returns False if no frames were taken in the window.
+    """
+    frames = timeline.Timeline.load(exp_path)
+    positions = frames.window(start, end)
+    if len(positions) == 0:
+        return False
+    durations = frames.durations(positions)
+    if speedup is None:
+        speedup = float(np.median(durations)) * FRAMERATE
+    names = frames.names
+    encode_frames([os.path.join(exp_path, names[i]) for i in positions], output_path, proxy_path=proxy_path,
+                  durations=durations / speedup)
+    return True
+
+
+def concat(paths, list_path, output_path):
+    """ join videos encoded with the same parameters without re-encoding """
+    with open(list_path, "w") as f:
+        for path in paths:
+            f.write("file '" + path + "'\n")
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path]
+    subprocess.run(command, check=True)
+
+
+def join_segments(exp_path, output_path, proxy_path=None):
+    """
+        Bring the segments of an experiment up to date and join them into output_path
+        without re-encoding, and their proxies into proxy_path if given.
+        Returns False if the experiment has no frames.
+    """
+    encode_new_frames(exp_path)
+    manifest = load_manifest(exp_path)
+    if not manifest["segments"]:
+        return False
+    segment_path = os.path.join(exp_path, SEGMENT_DIR)
+    concat([os.path.join(segment_path, segment["file"]) for segment in manifest["segments"]],
+           os.path.join(segment_path, "concat.txt"), output_path)
+    if proxy_path is not None:
+        if all(segment.get("proxy") for segment in manifest["segments"]):
+            concat([os.path.join(segment_path, segment["proxy"]) for segment in manifest["segments"]],
+                   os.path.join(segment_path, "concat_proxy.txt"), proxy_path)
+        else:
+            # segments encoded before proxies existed, scale the joined video down instead
+            command = ["ffmpeg", "-y", "-loglevel", "error", "-i", output_path, "-vf", "scale=" + str(PROXY_WIDTH) + ":-2"] \
+                + PROXY_ARGS + [proxy_path]
+            subprocess.run(command, check=True)
+    return True
+
+
+def contact_sheet(video_path, output_path, n_frames):
+    """ Tile CONTACT_SHEET_TILES frames spread evenly over a video of n_frames frames into one image """
+    columns, rows = CONTACT_SHEET_TILES
+    step = max(1, n_frames // (columns * rows))
+    vf = "select=not(mod(n\\," + str(step) + ")),scale=" + str(CONTACT_SHEET_TILE_WIDTH) + ":-2,tile=" + str(columns) + "x" + str(rows)
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-i", video_path, "-vf", vf, "-frames:v", "1", "-vsync", "vfr", output_path]
+    subprocess.run(command, check=True)
+
+
+def prune(directory, retention_days):
+    """ Remove files older than retention_days from a preview directory, None keeps everything """
+    if retention_days is None or not os.path.isdir(directory):
+        return []
+    cutoff = time.time() - retention_days * 24 * 60 * 60
+    removed = []
+    for f in os.listdir(directory):
+        path = os.path.join(directory, f)
+        if not f.startswith(".") and os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed.append(f)
+    if removed:
+        print("Removed " + str(len(removed)) + " previews older than " + str(retention_days) + " days from " + directory)
+    return removed
+
+
+def remove_segments(exp_path):
+    shutil.rmtree(os.path.join(exp_path, SEGMENT_DIR), ignore_errors=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported as src.<module>, as when the scripts are run from code/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,124 @@
+import os
+import sys
+import types
+import importlib
+import concurrent.futures
+import numpy as np
+import cv2
+
+
+def importable(name):
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        return False
+    return True
+
+
+def stub_missing(names):
+    """
+    Empty modules for the model libraries that cannot be imported. The QR model is faked below, so sorting and labelling
+    never call into them.
+    """
+    stubbed = []
+    for name in names:
+        if name.split(".")[0] in stubbed or not importable(name):
+            sys.modules[name] = types.ModuleType(name)
+            stubbed.append(name)
+    for name in stubbed:
+        parent, _, child = name.rpartition(".")
+        if parent in stubbed:
+            setattr(sys.modules[parent], child, sys.modules[name])
+    return stubbed
+
+
+STUBBED = stub_missing(["tensorflow", "tensorflow.tools", "tensorflow.tools.graph_transforms", "keras",
+                        "keras_retinanet", "keras_retinanet.models", "keras_retinanet.utils", "keras_retinanet.utils.image",
+                        "pyzbar", "pyzbar.pyzbar"])
+for module, attributes in (("tensorflow.tools.graph_transforms", ["TransformGraph"]),
+                           ("keras_retinanet.utils.image", ["preprocess_image", "resize_image"]),
+                           ("pyzbar.pyzbar", ["decode", "ZBarSymbol"])):
+    if module in STUBBED:
+        for attribute in attributes:
+            setattr(sys.modules[module], attribute, None)
+
+import src.sorting_functions as sf
+import src.qr_decoding as qr
+
+# the modules above keep their references, later imports see the real libraries or fail as usual
+for name in STUBBED:
+    del sys.modules[name]
+
+INSTALLS = 3
+SHELVES = 1
+BOXES_PER_SHELF = 2
+FRAMES_PER_BOX = 3
+RUN = "run_1"
+
+
+def experiment_number(install):
+    return 100 + install
+
+
+def stage_run(config, install):
+    """images of one run as the robot writes them, position 1 holding the box of the install and position 2 empty"""
+    path = config.unsorted_unlabeled_path + RUN
+    os.makedirs(path)
+    os.makedirs(config.sorted_unlabeled_path)
+    rng = np.random.RandomState(install)
+    for i in range(BOXES_PER_SHELF * SHELVES * FRAMES_PER_BOX):
+        cv2.imwrite(os.path.join(path, "img-%04d.png" % i), rng.randint(0, 255, (64, 64, 3)).astype(np.uint8))
+
+
+def fake_decode_qr(image, box, stats=None):
+    # the fake detector puts the install number in the x of the box
+    return str(experiment_number(int(box[0]))), "fake"
+
+
+def test_installs_sort_and_label_concurrently(tmp_path, monkeypatch):
+    configs = [sf.make_config("robot", BOXES_PER_SHELF, install_path=str(tmp_path / str(i))) for i in range(INSTALLS)]
+    install_of = {config.data_path: install for install, config in enumerate(configs)}
+
+    def fake_qr_detection(config, image_path, *args, **kwargs):
+        # a QR code in the first position only
+        if os.path.basename(os.path.dirname(image_path)) != "1":
+            return []
+        install = install_of[config.data_path]
+        return np.array([install, 0, install + 10, 10])
+
+    monkeypatch.setattr(sf, "qr_detection", fake_qr_detection)
+    monkeypatch.setattr(qr, "decode_qr", fake_decode_qr)
+    chdirs = []
+    monkeypatch.setattr(os, "chdir", lambda path: chdirs.append(path))
+    cwd = os.getcwd()
+
+    for install, config in enumerate(configs):
+        stage_run(config, install)
+
+    def process(config):
+        sf.sort(config, RUN, SHELVES)
+        sf.label(config, RUN)
+        return os.getcwd()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=INSTALLS) as executor:
+        cwds = list(executor.map(process, configs))
+
+    assert chdirs == []
+    assert cwds == [cwd] * INSTALLS
+    assert os.getcwd() == cwd
+    for install, config in enumerate(configs):
+        assert sf.listdir_nohidden(config.current_exp_path) == [str(experiment_number(install))]
+        frames = sf.listdir_nohidden(os.path.join(config.current_exp_path, str(experiment_number(install))))
+        assert len(frames) == FRAMES_PER_BOX
+        assert len(sf.listdir_nohidden(config.junk_exp_path)) == 1
+        assert not os.path.exists(config.unsorted_unlabeled_path + RUN)
+
+
+def test_frame_readers_keep_their_own_frames(tmp_path):
+    path = str(tmp_path / "frame.png")
+    cv2.imwrite(path, np.zeros((8, 8, 3), np.uint8))
+    first, second = sf.frame_reader(), sf.frame_reader()
+    assert first(path) is first(path)
+    second(path)
+    second.cache_clear()
+    assert first.cache_info().currsize == 1
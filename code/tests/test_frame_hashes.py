@@ -0,0 +1,12 @@
+import src.frame_hashes as fh
+
+
+def test_index_holds_only_frames(tmp_path):
+    for name in ("00000001_1600000000.png", "00000002_1600000600.png"):
+        (tmp_path / name).write_bytes(name.encode())
+    # current_exp folders also hold the encoded videos
+    (tmp_path / "outfile.mp4").write_bytes(b"video")
+    assert sorted(fh.update_index(str(tmp_path))) == ["00000001_1600000000.png", "00000002_1600000600.png"]
+
+    kept, duplicates = fh.find_duplicates([str(tmp_path / "outfile.mp4")], str(tmp_path))
+    assert duplicates == [] and len(kept) == 1
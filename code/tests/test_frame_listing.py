@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import cv2
+import pytest
+
+pytest.importorskip("plantcv")
+pytest.importorskip("keras_retinanet")
+
+from src.myutilities import timeline, tip_tracer, frame_stats
+from src.myutilities.box import Box, Seed
+from src.myutilities.image import Roi
+
+T0 = 1600000000
+
+
+def test_other_files_do_not_shift_frames(tmp_path):
+    exp_path = tmp_path / "1234"
+    os.makedirs(str(exp_path))
+    for i in range(6):
+        cv2.imwrite(str(exp_path / ("%08d_%d.png" % (i + 1, T0 + 600 * i))), np.full((8, 8), 10 * (i + 1), np.uint8))
+    # sorts between the frames
+    (exp_path / "00000003_notes.txt").write_text("not a frame")
+
+    box = Box(str(exp_path), str(tmp_path / "out"))
+    assert len(box.images) == 6
+    assert box.frame_names() == timeline.Timeline.load(str(exp_path)).names
+    np.testing.assert_array_equal(box.frame_stats.medians, [np.median(image) for image in box.images])
+
+
+def test_confident_germination_does_not_load_frame_stats(tmp_path, monkeypatch):
+    exp_path = tmp_path / "1234"
+    os.makedirs(str(exp_path))
+    for i in range(3):
+        cv2.imwrite(str(exp_path / ("%08d_%d.png" % (i + 1, T0 + 600 * i))), np.full((8, 8), 10, np.uint8))
+    box = Box(str(exp_path), str(tmp_path / "out"))
+    box.seeds = [Seed(Roi(x1=0, y1=0, x2=4, y2=4), 1234, 1)]
+    monkeypatch.setattr(tip_tracer, "germination_detection_init", lambda seed, images, threshold_multiplier: (1, 2, 2, 1.0))
+    monkeypatch.setattr(frame_stats.FrameStats, "get", lambda path: pytest.fail("frame stats loaded"))
+    box.germination_detection()
+    assert box.seeds[0].germination_frame == 1
@@ -0,0 +1,25 @@
+import os
+
+from src.journal import RunJournal
+
+
+def test_finished_journal_is_retired(tmp_path):
+    journal = RunJournal(str(tmp_path), "run_1")
+    journal.mark_done("transfer")
+    journal.finish()
+    assert not os.path.exists(journal.path)
+    assert os.path.isfile(os.path.join(str(tmp_path), "finished", "run_1.jsonl"))
+
+    # a zip staged again under the same name starts from scratch
+    again = RunJournal(str(tmp_path), "run_1")
+    assert not again.started and not again.is_done("transfer")
+
+
+def test_journal_finished_before_a_crash_is_retired_on_open(tmp_path):
+    journal = RunJournal(str(tmp_path), "run_1")
+    journal.mark_done("label")
+    journal.mark_done(RunJournal.FINISHED)
+
+    reopened = RunJournal(str(tmp_path), "run_1")
+    assert not reopened.started
+    assert not os.path.exists(reopened.path)
@@ -0,0 +1,49 @@
+import os
+import time
+
+from src.myutilities import quantification as q
+
+
+def test_lease_is_given_back_without_overwriting_a_new_one(tmp_path, monkeypatch):
+    lease_dir = str(tmp_path)
+    path = os.path.join(lease_dir, "1234" + q.LEASE_SUFFIX)
+    with open(path, "w") as f:
+        f.write("old")
+    os.utime(path, (time.time() - 100, time.time() - 100))
+
+    rename = os.rename
+
+    def take_over_meanwhile(source, destination):
+        # another machine renews the lease we are renaming away, then a third one creates a new lease
+        rename(source, destination)
+        if destination.endswith(".stale"):
+            os.utime(destination)
+            with open(path, "w") as f:
+                f.write("new")
+
+    monkeypatch.setattr(os, "rename", take_over_meanwhile)
+    assert not q.acquire_lease(lease_dir, "1234", ttl=10)
+    with open(path) as f:
+        assert f.read() == "new"
+    assert os.listdir(lease_dir) == ["1234" + q.LEASE_SUFFIX]
+
+
+def test_renewed_lease_is_given_back(tmp_path, monkeypatch):
+    lease_dir = str(tmp_path)
+    path = os.path.join(lease_dir, "1234" + q.LEASE_SUFFIX)
+    with open(path, "w") as f:
+        f.write("owner")
+    os.utime(path, (time.time() - 100, time.time() - 100))
+
+    rename = os.rename
+
+    def renew_meanwhile(source, destination):
+        rename(source, destination)
+        if destination.endswith(".stale"):
+            os.utime(destination)
+
+    monkeypatch.setattr(os, "rename", renew_meanwhile)
+    assert not q.acquire_lease(lease_dir, "1234", ttl=10)
+    with open(path) as f:
+        assert f.read() == "owner"
+    assert os.listdir(lease_dir) == ["1234" + q.LEASE_SUFFIX]
@@ -0,0 +1,30 @@
+import numpy as np
+
+import src.preclassifier as pc
+
+
+def calibrated(tmp_path, occupied, empty):
+    classifier = pc.PreClassifier(str(tmp_path / "calibration.json"), "robot1/")
+    for i, (magenta, edges) in enumerate(occupied):
+        classifier.record("o" + str(i), {"magenta_coverage": magenta, "edge_density": edges}, False, occupied=True)
+    for i, (magenta, edges) in enumerate(empty):
+        classifier.record("e" + str(i), {"magenta_coverage": magenta, "edge_density": edges}, False, occupied=False)
+    classifier.save()
+    return pc.PreClassifier(classifier.path, "robot1/")
+
+
+def test_separated_empty_positions_raise_the_thresholds(tmp_path):
+    occupied = [(0.4, 0.2)] * pc.MIN_CALIBRATION_SAMPLES
+    without_empty = calibrated(tmp_path, occupied, [])
+    assert without_empty.thresholds == {"magenta_coverage": 0.2, "edge_density": 0.1}
+
+    with_empty = calibrated(tmp_path, occupied, [(0.2, 0.1)] * pc.MIN_EMPTY_SAMPLES)
+    np.testing.assert_allclose([with_empty.thresholds[f] for f in pc.FEATURES], [0.3, 0.15])
+    assert with_empty.error_rates == {"occupied_called_empty": 0.0, "empty_not_called_empty": 0.0}
+
+
+def test_overlapping_empty_positions_keep_the_margin(tmp_path):
+    occupied = [(0.4, 0.2)] * pc.MIN_CALIBRATION_SAMPLES
+    classifier = calibrated(tmp_path, occupied, [(0.1, 0.05)] * 5 + [(0.5, 0.3)] * 5)
+    assert classifier.thresholds == {"magenta_coverage": 0.2, "edge_density": 0.1}
+    assert classifier.error_rates == {"occupied_called_empty": 0.0, "empty_not_called_empty": 0.5}
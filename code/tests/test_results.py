@@ -0,0 +1,56 @@
+import os
+import types
+import numpy as np
+
+from src.myutilities import results
+
+
+def traced_seed(curling_start_frame=None):
+    return types.SimpleNamespace(tip_coords_pcv=[[1, 1], [1, 2], [1, 3], [1, 4]], _tracking_start_frame=2,
+                                 curling_start_frame=curling_start_frame, tip_interpolated=[False] * 4)
+
+
+def test_curling_follows_curled(tmp_path):
+    seed = traced_seed(curling_start_frame=3)
+    np.testing.assert_array_equal(results.seed_rows(seed, 1)["curling"], [False, False, True, True])
+    assert not results.seed_rows(seed, 1, curled=False)["curling"].any()
+
+    results.write_seed("1234", seed, 1, results_path=str(tmp_path), curled=False)
+    assert not results.query(["1234"], results_path=str(tmp_path))["curling"].any()
+
+
+def test_index_picks_up_saved_seeds(tmp_path):
+    path = str(tmp_path)
+    results.write_seed("1234", traced_seed(), 1, results_path=path)
+    assert results.load_index(path)["1234"]["seeds"] == [1]
+    assert os.path.isfile(os.path.join(path, results.INDEX_FILE))
+
+    # saving seeds does not touch index.json, loading it notices the changed and added experiments
+    results.write_seed("1234", traced_seed(), 2, results_path=path)
+    results.write_seed("5678", traced_seed(), 1, results_path=path)
+    index = results.load_index(path)
+    assert index["1234"]["seeds"] == [1, 2] and index["5678"]["seeds"] == [1]
+    assert len(results.query(results_path=path)["seed"]) == 12
+
+
+def test_residuals_and_growths_are_stored(tmp_path):
+    path = str(tmp_path)
+    seed = traced_seed()
+    seed.tip_residuals = [np.nan, 0.5, 1.5, 3.0]
+    seed.tip_growths = [0, 0, 1, 2]
+    results.write_seed("1234", seed, 1, results_path=path)
+    rows = results.query(["1234"], results_path=path)
+    np.testing.assert_allclose(rows["residual"], seed.tip_residuals)
+    np.testing.assert_array_equal(rows["growths"], seed.tip_growths)
+
+
+def test_rows_stored_before_residuals_read_as_not_predicted(tmp_path):
+    path = str(tmp_path)
+    results.write_seed("1234", traced_seed(), 1, results_path=path)
+    for name in ("residual", "growths"):
+        os.remove(os.path.join(path, "1234", name + ".bin"))
+    assert np.isnan(results.query(["1234"], results_path=path)["residual"]).all()
+
+    results.write_seed("1234", traced_seed(), 2, results_path=path)
+    rows = results.query(["1234"], seeds=[1], results_path=path)
+    assert np.isnan(rows["residual"]).all() and not rows["growths"].any()
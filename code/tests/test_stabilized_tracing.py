@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import cv2
+import pytest
+
+pytest.importorskip("plantcv")
+pytest.importorskip("keras_retinanet")
+
+import src.myutilities.constants as c
+from src.myutilities import stabilization
+from src.myutilities.box import Box, Seed
+from src.myutilities.image import Roi
+
+FRAMES = 12
+
+
+def make_experiment(path):
+    """frames of a root growing 4 pixels down per frame from (150, 80), with a small shift between frames"""
+    os.makedirs(path)
+    rng = np.random.RandomState(0)
+    base = rng.randint(30, 60, (300, 300)).astype(np.uint8)
+    for i in range(FRAMES):
+        frame = base.copy()
+        cv2.line(frame, (150, 60), (150, 80 + 4 * i), 200, 7)
+        frame = np.roll(frame, i % 3, axis=1)
+        cv2.imwrite(os.path.join(str(path), "%08d_%d.png" % (i + 1, 1600000000 + 600 * i)), frame)
+
+
+@pytest.mark.parametrize("stabilize", [False, True])
+def test_tip_trace_pcv(tmp_path, monkeypatch, stabilize):
+    exp_path = tmp_path / "1234"
+    make_experiment(exp_path)
+    out_path = tmp_path / "out"
+    os.makedirs(str(out_path / "stabilized_videos_single_seed"))
+    monkeypatch.setattr(c, "QUANTIFICATION_OUT_PATH", str(out_path))
+
+    box = Box(str(exp_path), str(out_path), load_images=False, stabilize=stabilize)
+    seed = Seed(Roi(120, 180, 30, 100), "1234", 1)
+    seed.germination_indicator = True
+    seed._tracking_start_frame = 1
+    seed.germination_x, seed.germination_y = 150, 84
+    box.seeds = [seed]
+
+    box.tip_trace_pcv(length=FRAMES - 2)
+
+    assert isinstance(box.images, stabilization.FrameSequence) == stabilize
+    assert len(seed.tip_coords_pcv) == FRAMES - 1
+    assert seed.final_trace_img is not None
+    assert os.path.exists(str(out_path / "stabilized_videos_single_seed" / "1234_1.mp4"))
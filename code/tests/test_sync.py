@@ -0,0 +1,72 @@
+import os
+import shutil
+
+import pytest
+
+from src.myutilities import sync
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    for name in ("a.csv", "b.csv"):
+        (source / name).write_text(name * 100)
+    return str(source), sync.LocalDestination(str(tmp_path / "dest")), str(tmp_path / "manifests")
+
+
+def run(source, dest, manifests):
+    return sync.sync(source, dest, manifest_dir=manifests, verbose=False)
+
+
+def test_second_sync_copies_nothing(dirs):
+    first = run(*dirs)
+    assert first.copied == ["a.csv", "b.csv"]
+    second = run(*dirs)
+    assert second.copied == [] and second.failed == []
+    assert second.skipped == ["a.csv", "b.csv"]
+    assert second.bytes_saved == first.bytes_copied
+
+
+def test_touched_file_with_same_content_is_skipped(dirs, monkeypatch):
+    source, dest, manifests = dirs
+    run(*dirs)
+    st = os.stat(os.path.join(source, "a.csv"))
+    os.utime(os.path.join(source, "a.csv"), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    puts = []
+    monkeypatch.setattr(dest, "put", lambda path, name: puts.append(name))
+    report = run(*dirs)
+    assert puts == [] and report.copied == []
+    assert report.skipped == ["a.csv", "b.csv"]
+    # the new mtime is recorded, so the next sync does not hash the file again
+    monkeypatch.setattr(sync, "file_hash", lambda path: pytest.fail("hashed " + path))
+    assert run(*dirs).skipped == ["a.csv", "b.csv"]
+
+
+def test_changed_file_is_copied_again(dirs):
+    source, dest, manifests = dirs
+    run(*dirs)
+    with open(os.path.join(source, "b.csv"), "a") as f:
+        f.write("more")
+    report = run(*dirs)
+    assert report.copied == ["b.csv"] and report.skipped == ["a.csv"]
+    with open(os.path.join(dest.path, "b.csv")) as f:
+        assert f.read().endswith("more")
+
+
+def test_failed_copy_leaves_no_partial_file(dirs, monkeypatch):
+    source, dest, manifests = dirs
+
+    def copy_half(src, dst):
+        with open(src, "rb") as f, open(dst, "wb") as out:
+            out.write(f.read()[:10])
+        raise OSError("disk full")
+
+    monkeypatch.setattr(shutil, "copy2", copy_half)
+    report = run(*dirs)
+    assert report.copied == [] and report.failed == ["a.csv", "b.csv"]
+    assert os.listdir(dest.path) == []
+
+    # nothing was recorded for the failed files, so they are copied once copying works again
+    monkeypatch.undo()
+    assert run(*dirs).copied == ["a.csv", "b.csv"]
@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import cv2
+import pytest
+
+pytest.importorskip("plantcv")
+pytest.importorskip("keras_retinanet")
+
+import src.myutilities.constants as c
+from src.myutilities import results
+from src.myutilities.box import Box, Seed
+from src.myutilities.image import Roi
+
+T0 = 1600000000
+INTERVAL = 600
+
+
+def test_windowed_box_stores_experiment_frames(tmp_path, monkeypatch):
+    exp_path = tmp_path / "1234"
+    os.makedirs(str(exp_path))
+    for i in range(10):
+        cv2.imwrite(str(exp_path / ("%08d_%d.png" % (i + 1, T0 + INTERVAL * i))), np.zeros((8, 8), np.uint8))
+    out_path = tmp_path / "out"
+    os.makedirs(str(out_path / "tip_coordinates"))
+    monkeypatch.setattr(c, "QUANTIFICATION_OUT_PATH", str(out_path))
+    monkeypatch.setattr(c, "RESULTS_PATH", str(tmp_path / "results"))
+
+    # frames 3 to 8 of the experiment
+    box = Box(str(exp_path), str(out_path), load_images=False, time_window=(T0 + 3 * INTERVAL, T0 + 9 * INTERVAL))
+    seed = Seed(Roi(0, 8, 0, 8), "1234", 1)
+    seed._tracking_start_frame = 1
+    seed.tip_coords_pcv = [[1, 1], [1, 2], [1, 3], [1, 4]]
+    box.save_tip_coordinates(seed, 1, curled=False)
+
+    rows = results.query(["1234"])
+    np.testing.assert_array_equal(rows["frame"], [4, 4, 5, 6])
+    np.testing.assert_array_equal(rows["timestamp"], T0 + INTERVAL * np.array([4, 4, 5, 6]))
+
+
+def test_snapshot_keeps_residuals_and_growths(tmp_path):
+    exp_path = tmp_path / "1234"
+    os.makedirs(str(exp_path))
+    box = Box(str(exp_path), str(tmp_path / "out"), load_images=False)
+    seed = Seed(Roi(0, 8, 0, 8), "1234", 1)
+    seed.tip_coords_pcv = [[1, 1], [1, 2], [1, 3]]
+    seed.tip_interpolated = [False] * 3
+    seed.tip_residuals = [np.nan, 0.5, 2.0]
+    seed.tip_growths = [0, 0, 1]
+    box.seeds.append(seed)
+
+    loaded = Box.load_snapshot(box.save_snapshot(str(tmp_path / "box.npz"))).seeds[0]
+    np.testing.assert_allclose(loaded.tip_residuals, seed.tip_residuals)
+    assert loaded.tip_growths == seed.tip_growths